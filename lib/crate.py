@@ -21,23 +21,314 @@ BitBake 'Fetch' implementation for crates.io
 #
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
+import errno
+import fcntl
 import hashlib
 import json
+import multiprocessing
 import os
+import posixpath
 import shutil
-import subprocess
+import tarfile
+import time
 import bb
-from   bb.fetch2 import logger, subprocess_setup, UnpackError
+from   concurrent.futures import ProcessPoolExecutor
+from   bb.fetch2 import logger, UnpackError, FetchError
 from   bb.fetch2.wget import Wget
+from   crate_mirror import CrateMirror, MirrorError, sha256_file
+
+# read size used when hashing and extracting crate contents
+CHUNK_SIZE = 1024 * 1024
+
+
+def extract_crate(cratefile, destdir, prefix=None):
+    """
+    Extracts a .crate tarball into destdir without changing the working
+    directory. Ownership is never restored (like tar --no-same-owner).
+
+    If prefix is given (the NAME-VERSION top directory of the crate), returns
+    a dict of {path relative to prefix: SHA256} for every regular file below
+    it, suitable for the 'files' entry of .cargo-checksum.json. The hashes are
+    computed while the data is written out, so no second pass is needed.
+    """
+    files = {}
+    destdir = os.path.realpath(destdir)
+    with tarfile.open(cratefile, 'r:gz') as tar:
+        for member in tar:
+            name = posixpath.normpath(member.name)
+            if name.startswith('/') or name == '..' or name.startswith('../'):
+                raise ValueError("unsafe path %s in %s" % (member.name, cratefile))
+            target = os.path.join(destdir, *name.split('/'))
+
+            if member.isdir():
+                bb.utils.mkdirhier(target)
+                continue
+            bb.utils.mkdirhier(os.path.dirname(target))
+            if os.path.lexists(target):
+                os.unlink(target)
+
+            if member.issym():
+                linkpath = posixpath.normpath(posixpath.join(posixpath.dirname(name), member.linkname))
+                if member.linkname.startswith('/') or linkpath == '..' or linkpath.startswith('../'):
+                    raise ValueError("unsafe link %s in %s" % (member.name, cratefile))
+                os.symlink(member.linkname, target)
+                continue
+            if not member.isfile():
+                raise ValueError("unsupported member %s in %s" % (member.name, cratefile))
+
+            sha = hashlib.sha256()
+            src = tar.extractfile(member)
+            with open(target, 'wb') as dst:
+                while True:
+                    data = src.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    sha.update(data)
+                    dst.write(data)
+            os.chmod(target, member.mode & 0o777)
+            os.utime(target, (member.mtime, member.mtime))
+
+            if prefix and name.startswith(prefix + '/'):
+                files[name[len(prefix) + 1:]] = sha.hexdigest()
+    return files
+
+
+# linux/fs.h: FICLONE = _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dst):
+    """
+    Creates dst with the contents of src, preferring a hardlink, then a
+    reflink, then a plain copy
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def _cache_extract(cratefile, tmpdir, prefix):
+    """
+    Process pool worker: extracts one crate into a cache staging directory
+    """
+    files = extract_crate(cratefile, tmpdir, prefix)
+    size = 0
+    for root, dirs, names in os.walk(tmpdir):
+        for name in names:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return files, size
+
+
+class CrateCache(object):
+    """
+    Shared cache of extracted crates, keyed by the SHA256 of the .crate file
+
+    Layout of each entry:
+      ROOT/<sha256>/meta.json       per-file checksums, size; mtime = last use
+      ROOT/<sha256>/NAME-VERSION/   the extracted crate
+
+    Recipes populate their cargo_home from an entry with hardlinks (reflinks
+    or copies across filesystems), so a crate is extracted once per build
+    host rather than once per recipe. Entries are evicted least recently
+    used first once the total size exceeds max_size bytes.
+    """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        bb.utils.mkdirhier(root)
+
+    def _entry(self, sha):
+        return os.path.join(self.root, sha)
+
+    def lookup(self, sha):
+        """
+        Returns the per-file checksums of a cached crate, or None on a miss
+        """
+        meta = os.path.join(self._entry(sha), 'meta.json')
+        try:
+            with open(meta) as f:
+                files = json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            return None
+        # the mtime of meta.json records the last use for LRU eviction
+        os.utime(meta)
+        return files
+
+    def add(self, crates, jobs=1):
+        """
+        Extracts missing crates into the cache
+
+        crates is a list of (cratefile, sha256, prefix). Misses are extracted
+        in parallel by a pool of jobs processes.
+        """
+        missing = {}
+        for cratefile, sha, prefix in crates:
+            if sha not in missing and self.lookup(sha) is None:
+                missing[sha] = (cratefile, prefix)
+        if not missing:
+            return
+
+        staging = {}
+        for sha, (cratefile, prefix) in missing.items():
+            staging[sha] = os.path.join(self.root, '%s.tmp-%d' % (sha, os.getpid()))
+            shutil.rmtree(staging[sha], ignore_errors=True)
+            bb.utils.mkdirhier(staging[sha])
+
+        jobs = max(1, min(jobs, len(missing)))
+        try:
+            if jobs == 1:
+                results = {sha: _cache_extract(cratefile, staging[sha], prefix)
+                           for sha, (cratefile, prefix) in missing.items()}
+            else:
+                context = multiprocessing.get_context('fork')
+                shas = list(missing)
+                with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+                    extracted = pool.map(_cache_extract,
+                                         [missing[sha][0] for sha in shas],
+                                         [staging[sha] for sha in shas],
+                                         [missing[sha][1] for sha in shas],
+                                         chunksize=max(1, len(shas) // (jobs * 4)))
+                    results = dict(zip(shas, extracted))
+
+            for sha, (files, size) in results.items():
+                with open(os.path.join(staging[sha], 'meta.json'), 'w') as f:
+                    json.dump({'files': files, 'size': size}, f)
+                try:
+                    os.rename(staging[sha], self._entry(sha))
+                except OSError as e:
+                    # another build added the same crate meanwhile
+                    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+        finally:
+            for tmp in staging.values():
+                shutil.rmtree(tmp, ignore_errors=True)
+        bb.note("Extracted %d crates into %s" % (len(missing), self.root))
+
+    def populate(self, sha, prefix, destdir):
+        """
+        Recreates the cached NAME-VERSION tree of a crate below destdir
+        """
+        src = os.path.join(self._entry(sha), prefix)
+        dst = os.path.join(destdir, prefix)
+        if os.path.lexists(dst):
+            shutil.rmtree(dst)
+        for root, dirs, names in os.walk(src):
+            target = os.path.join(dst, os.path.relpath(root, src))
+            bb.utils.mkdirhier(target)
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                else:
+                    link_or_copy(path, os.path.join(target, name))
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits max_size
+        """
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for sha in os.listdir(self.root):
+                if '.tmp-' in sha:
+                    continue
+                meta = os.path.join(self._entry(sha), 'meta.json')
+                try:
+                    with open(meta) as f:
+                        size = json.load(f)['size']
+                    used = os.stat(meta).st_mtime
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((used, size, sha))
+                total += size
+            if total <= self.max_size:
+                return
+
+            entries.sort()
+            removed = 0
+            for used, size, sha in entries:
+                if total <= self.max_size:
+                    break
+                # entries populated into a recipe just now are never evicted
+                if time.time() - used < 60:
+                    break
+                shutil.rmtree(self._entry(sha), ignore_errors=True)
+                total -= size
+                removed += 1
+            bb.note("Evicted %d crates from %s" % (removed, self.root))
 
 
 class Crate(Wget):
 
     """Class to fetch crates via wget"""
 
+    # rootdirs whose crate:// SRC_URI entries were already batch extracted
+    _prefetched = set()
+
+    # {localpath: (size, mtime, sha256)} of crates hashed by this process
+    _hashes = {}
+
     def _cargo_bitbake_path(self, rootdir):
         return os.path.join(rootdir, "cargo_home", "bitbake")
 
+    def _crate_sha256(self, path):
+        st = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[:2] == (st.st_size, st.st_mtime):
+            return cached[2]
+        sha = sha256_file(path)
+        self._hashes[path] = (st.st_size, st.st_mtime, sha)
+        return sha
+
+    def _crate_cache(self, d):
+        """
+        Returns the shared extracted-crate cache, or None if it is disabled
+
+        CRATE_CACHE_DIR     cache location (default ${TMPDIR}/crate-cache)
+        CRATE_CACHE_MAX_SIZE  size limit in MiB (default 4096, "0" disables)
+        """
+        max_size = int(d.getVar('CRATE_CACHE_MAX_SIZE') or 4096)
+        if max_size <= 0:
+            return None
+        root = d.getVar('CRATE_CACHE_DIR') or os.path.join(d.getVar('TMPDIR'), 'crate-cache')
+        return CrateCache(root, max_size * 1024 * 1024)
+
+    def _crate_prefetch(self, cache, rootdir, d):
+        """
+        Extracts every dependency crate of the recipe that is not cached yet
+        in one parallel batch, so that the following per-URL unpack calls
+        only have to populate from the cache
+        """
+        if rootdir in self._prefetched:
+            return
+        self._prefetched.add(rootdir)
+
+        urls = [u for u in (d.getVar('SRC_URI') or '').split() if u.startswith('crate://')]
+        pn = d.getVar('BPN')
+        crates = []
+        for ud in bb.fetch2.Fetch(urls, d).ud.values():
+            if ud.crate_name == pn or not os.path.exists(ud.localpath):
+                continue
+            cratepath = os.path.splitext(os.path.basename(ud.localpath))[0]
+            crates.append((ud.localpath, self._crate_sha256(ud.localpath), cratepath))
+
+        jobs = min(int(d.getVar('BB_NUMBER_THREADS') or 1), os.cpu_count() or 1)
+        try:
+            cache.add(crates, jobs)
+        except (OSError, ValueError, tarfile.TarError) as e:
+            raise UnpackError("Extracting crates into %s failed: %s" % (cache.root, e), rootdir)
+        cache.evict()
+
     def supports(self, ud, d):
         """
         Check to see if a given url is for this fetcher
@@ -68,23 +359,62 @@ class Crate(Wget):
         if len(parts) < 5:
             raise bb.fetch2.ParameterError("Invalid URL: Must be crate://HOST/NAME/VERSION", ud.url)
 
-        # last field is version
-        version = parts[len(parts) - 1]
+        # last field is version, ignoring url parameters (handled by the fetcher core)
+        version = parts[len(parts) - 1].split(';')[0]
         # second to last field is name
         name = parts[len(parts) - 2]
         # host (this is to allow custom crate registries to be specified
         host = '/'.join(parts[2:len(parts) - 2])
 
+        # a local mirror root can be given as the host (crate:///srv/crates/NAME/VERSION);
+        # CRATE_MIRROR_DIR makes crates.io URLs resolve from a local mirror first
+        ud.crate_mirror = None
+        ud.crate_version = version
+        if host.startswith('/'):
+            ud.crate_mirror = host
+        elif host == 'crates.io' and d.getVar('CRATE_MIRROR_DIR'):
+            mirror = CrateMirror(d.getVar('CRATE_MIRROR_DIR'))
+            if mirror.lookup(name, version) is not None:
+                ud.crate_mirror = mirror.root
+
         # if using upstream just fix it up nicely
         if host == 'crates.io':
             host = 'crates.io/api/v1/crates'
 
-        ud.url = "https://%s/%s/%s/download" % (host, name, version)
+        if ud.crate_mirror:
+            ud.url = "file://%s" % CrateMirror(ud.crate_mirror).crate_path(name, version)
+        else:
+            ud.url = "https://%s/%s/%s/download" % (host, name, version)
         ud.parm['downloadfilename'] = "%s-%s.crate" % (name, version)
-        ud.parm['name'] = name
+        # an explicit ;name= (e.g. NAME-VERSION from cargo-lock-crates.bbclass) selects
+        # the SRC_URI[<name>.sha256sum] checksum; ud.crate_name is always the crate name
+        ud.crate_name = name
+        ud.parm.setdefault('name', name)
 
         logger.debug(2, "Fetching %s to %s" % (ud.url, ud.parm['downloadfilename']))
 
+    def download(self, ud, d):
+        """
+        Fetches a crate, from the local mirror without network access if it
+        resolved to one
+        """
+        if not getattr(ud, 'crate_mirror', None):
+            return super(Crate, self).download(ud, d)
+
+        name = ud.crate_name
+        try:
+            CrateMirror(ud.crate_mirror).fetch(name, ud.crate_version, ud.localpath,
+                                               d.getVarFlag('SRC_URI', '%s.sha256sum' % ud.parm['name']))
+        except (OSError, MirrorError) as e:
+            raise FetchError("Fetching %s %s from %s failed: %s"
+                             % (name, ud.crate_version, ud.crate_mirror, e), ud.url)
+        return True
+
+    def checkstatus(self, fetch, ud, d, try_again=True):
+        if not getattr(ud, 'crate_mirror', None):
+            return super(Crate, self).checkstatus(fetch, ud, d, try_again)
+        return CrateMirror(ud.crate_mirror).lookup(ud.crate_name, ud.crate_version) is not None
+
     def unpack(self, ud, rootdir, d):
         """
         Uses the crate to build the necessary paths for cargo to utilize it
@@ -99,51 +429,46 @@ class Crate(Wget):
         Unpacks a crate
         """
         thefile = ud.localpath
+        cratepath = os.path.splitext(os.path.basename(thefile))[0]
 
         # possible metadata we need to write out
         metadata = {}
 
-        # change to the rootdir to unpack but save the old working dir
-        save_cwd = os.getcwd()
-        os.chdir(rootdir)
-
         pn = d.getVar('BPN')
-        if pn == ud.parm.get('name'):
-            cmd = "tar -xz --no-same-owner -f %s" % thefile
+        if pn == ud.crate_name:
+            destdir = rootdir
+            prefix = None
         else:
-            cargo_bitbake = self._cargo_bitbake_path(rootdir)
-
-            cmd = "tar -xz --no-same-owner -f %s -C %s" % (thefile, cargo_bitbake)
+            destdir = self._cargo_bitbake_path(rootdir)
+            prefix = cratepath
 
             # ensure we've got these paths made
-            bb.utils.mkdirhier(cargo_bitbake)
-
-            # generate metadata necessary
-            with open(thefile, 'rb') as f:
-                # get the SHA256 of the original tarball
-                tarhash = hashlib.sha256(f.read()).hexdigest()
-
-            metadata['files'] = {}
-            metadata['package'] = tarhash
-
-        # path it
-        path = d.getVar('PATH')
-        if path:
-            cmd = "PATH=\"%s\" %s" % (path, cmd)
-        bb.note("Unpacking %s to %s/" % (thefile, os.getcwd()))
+            bb.utils.mkdirhier(destdir)
 
-        ret = subprocess.call(cmd, preexec_fn=subprocess_setup, shell=True)
+            # get the SHA256 of the original tarball
+            metadata['package'] = self._crate_sha256(thefile)
 
-        os.chdir(save_cwd)
+        bb.note("Unpacking %s to %s/" % (thefile, destdir))
 
-        if ret != 0:
-            raise UnpackError("Unpack command %s failed with return value %s" % (cmd, ret), ud.url)
+        cache = self._crate_cache(d) if prefix else None
+        try:
+            if cache:
+                self._crate_prefetch(cache, rootdir, d)
+                sha = metadata['package']
+                files = cache.lookup(sha)
+                if files is None:
+                    cache.add([(thefile, sha, prefix)])
+                    files = cache.lookup(sha)
+                cache.populate(sha, prefix, destdir)
+            else:
+                files = extract_crate(thefile, destdir, prefix)
+        except (OSError, ValueError, tarfile.TarError) as e:
+            raise UnpackError("Unpacking %s failed: %s" % (thefile, e), ud.url)
 
         # if we have metadata to write out..
         if len(metadata) > 0:
-            cratepath = os.path.splitext(os.path.basename(thefile))[0]
-            bbpath = self._cargo_bitbake_path(rootdir)
+            metadata['files'] = files
             mdfile = '.cargo-checksum.json'
-            mdpath = os.path.join(bbpath, cratepath, mdfile)
+            mdpath = os.path.join(destdir, cratepath, mdfile)
             with open(mdpath, "w") as f:
                 json.dump(metadata, f)
@@ -0,0 +1,249 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+"""
+Local file-based crate registry mirror
+
+Layout of a mirror root (the index follows the cargo sparse-index layout):
+
+  ROOT/config.json                      {"dl": "file://ROOT/crates/{crate}/{crate}-{version}.crate"}
+  ROOT/index/1/a                        one JSON line per published version
+  ROOT/index/2/ab
+  ROOT/index/3/a/abc
+  ROOT/index/ab/cd/abcd...
+  ROOT/crates/NAME/NAME-VERSION.crate   the .crate blobs
+
+Index lines carry name, vers and cksum (the SHA256 of the .crate). The
+crate:// fetcher in crate.py resolves and verifies crates against it; this
+module has no BitBake dependency so scripts/crate-mirror.py can use it too.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class MirrorError(Exception):
+    pass
+
+
+def sha256_file(path):
+    """
+    Returns the SHA256 of a file, reading it in chunks
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+
+def index_relpath(name):
+    """
+    Returns the sparse-index path of a crate name
+    """
+    name = name.lower()
+    if len(name) <= 2:
+        return os.path.join(str(len(name)), name)
+    if len(name) == 3:
+        return os.path.join('3', name[0], name)
+    return os.path.join(name[0:2], name[2:4], name)
+
+
+def read_cargo_lock(path):
+    """
+    Returns every [[package]] of a Cargo.lock as a dict of its string keys
+    (name, version, source, checksum)
+
+    Cargo.lock is a flat list of [[package]] tables of simple key = "value"
+    pairs, so it is parsed directly instead of requiring a toml module.
+    """
+    packages = []
+    current = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == '[[package]]':
+                current = {}
+                packages.append(current)
+                continue
+            if line.startswith('['):
+                current = None
+                continue
+            m = re.match(r'^([A-Za-z_-]+)\s*=\s*"(.*)"$', line)
+            if current is not None and m:
+                current[m.group(1)] = m.group(2)
+    return packages
+
+
+def parse_cargo_lock(path):
+    """
+    Returns the registry packages of a Cargo.lock as a list of
+    (name, version, checksum, source). Path and git dependencies are skipped.
+    """
+    result = []
+    for pkg in read_cargo_lock(path):
+        source = pkg.get('source', '')
+        if not source.startswith('registry+') and not source.startswith('sparse+'):
+            continue
+        result.append((pkg['name'], pkg['version'], pkg.get('checksum'), source))
+    return result
+
+
+def link_or_copy(src, dst):
+    """
+    Places src at dst (hardlink if possible), replacing dst atomically
+    """
+    tmp = '%s.tmp-%d' % (dst, os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CrateMirror(object):
+
+    """A local crate registry mirror rooted at a directory"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def exists(self):
+        return os.path.isdir(os.path.join(self.root, 'index'))
+
+    def crate_path(self, name, version):
+        return os.path.join(self.root, 'crates', name, '%s-%s.crate' % (name, version))
+
+    def index_path(self, name):
+        return os.path.join(self.root, 'index', index_relpath(name))
+
+    def entries(self, name):
+        """
+        Returns the index entries of a crate as {version: entry}
+        """
+        try:
+            with open(self.index_path(name)) as f:
+                lines = [json.loads(l) for l in f if l.strip()]
+        except FileNotFoundError:
+            return {}
+        return {e['vers']: e for e in lines if e.get('name', '').lower() == name.lower()}
+
+    def lookup(self, name, version):
+        """
+        Returns the index entry of NAME VERSION, or None if not mirrored
+        """
+        entry = self.entries(name).get(version)
+        if entry is None or not os.path.exists(self.crate_path(name, version)):
+            return None
+        return entry
+
+    def fetch(self, name, version, dest, checksum=None):
+        """
+        Verifies a mirrored crate against the index (and checksum, e.g. from
+        Cargo.lock, if given) and places it at dest
+        """
+        entry = self.lookup(name, version)
+        if entry is None:
+            raise MirrorError("%s %s is not in the crate mirror %s" % (name, version, self.root))
+        blob = self.crate_path(name, version)
+        actual = sha256_file(blob)
+        for expected in (entry.get('cksum'), checksum):
+            if expected and expected != actual:
+                raise MirrorError("checksum mismatch for %s: expected %s, got %s"
+                                  % (blob, expected, actual))
+        dirname = os.path.dirname(dest)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        link_or_copy(blob, dest)
+        return actual
+
+    def prefetch_lockfile(self, lockfile, dl_dir):
+        """
+        Places every registry crate of a Cargo.lock into dl_dir (as the
+        crate:// fetcher names them), verified against the index and the
+        lockfile checksums. Returns the list of (name, version) not mirrored.
+        """
+        missing = []
+        for name, version, checksum, source in parse_cargo_lock(lockfile):
+            dest = os.path.join(dl_dir, '%s-%s.crate' % (name, version))
+            if self.lookup(name, version) is None:
+                missing.append((name, version))
+                continue
+            if os.path.exists(dest) and checksum and sha256_file(dest) == checksum:
+                continue
+            self.fetch(name, version, dest, checksum)
+        return missing
+
+    # ==================== populate / trim ====================
+
+    def _write_config(self):
+        config = os.path.join(self.root, 'config.json')
+        if not os.path.exists(config):
+            with open(config, 'w') as f:
+                json.dump({'dl': 'file://%s/crates/{crate}/{crate}-{version}.crate' % self.root}, f)
+
+    def _write_index(self, name, entries):
+        path = self.index_path(name)
+        if not entries:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.tmp-%d' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            for version in sorted(entries):
+                f.write(json.dumps(entries[version], sort_keys=True) + '\n')
+        os.replace(tmp, path)
+
+    def add(self, cratefile, name, version, checksum=None):
+        """
+        Adds a .crate file to the mirror; returns False if it was already
+        mirrored with the same checksum
+        """
+        actual = sha256_file(cratefile)
+        if checksum and checksum != actual:
+            raise MirrorError("checksum mismatch for %s: expected %s, got %s"
+                              % (cratefile, checksum, actual))
+        entries = self.entries(name)
+        if version in entries and entries[version].get('cksum') == actual \
+                and os.path.exists(self.crate_path(name, version)):
+            return False
+
+        blob = self.crate_path(name, version)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        link_or_copy(cratefile, blob)
+        entries[version] = {'name': name, 'vers': version, 'cksum': actual,
+                            'deps': [], 'features': {}, 'yanked': False}
+        self._write_index(name, entries)
+        self._write_config()
+        return True
+
+    def remove(self, name, version):
+        entries = self.entries(name)
+        entries.pop(version, None)
+        self._write_index(name, entries)
+        blob = self.crate_path(name, version)
+        if os.path.exists(blob):
+            os.unlink(blob)
+        try:
+            os.rmdir(os.path.dirname(blob))
+        except OSError:
+            pass
+
+    def all_crates(self):
+        """
+        Yields (name, version) of every mirrored crate
+        """
+        crates_dir = os.path.join(self.root, 'crates')
+        if not os.path.isdir(crates_dir):
+            return
+        for name in sorted(os.listdir(crates_dir)):
+            for version in sorted(self.entries(name)):
+                yield name, version
@@ -0,0 +1,183 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS vsock 命令通道自身的基准测试
+#
+# 测量 OEVsockTarget.run() 与客户机 vsock-server（popen 执行命令）之间的开销，
+# 与被测命令无关：
+# - 空命令（true）的往返延迟分布，会话模式与短连接模式分别测量
+# - 建立 vsock 连接的耗时
+# - 命令输出的批量吞吐（MB/s），负载从 1 KB 到 100 MB
+# 由 runtime/cases/transport.py 调用，结果随内核构建保存，用于跟踪 virtio-vsock 驱动的性能
+
+import time
+
+from starryperf import summarize, change_percent
+
+# 吞吐测试的默认负载大小
+DEFAULT_SIZES = ('1K', '64K', '1M', '10M', '100M')
+
+UNITS = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+def parse_size(text):
+    """'64K' -> 65536"""
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for suffix in ('G', 'M', 'K'):
+        if size >= UNITS[suffix] and size % UNITS[suffix] == 0:
+            return f"{size // UNITS[suffix]}{suffix}"
+    return str(size)
+
+
+class VsockBenchmarkError(Exception):
+    pass
+
+
+class VsockBenchmark(object):
+    """对一个 OEVsockTarget 的命令通道做基准测试，所有时间单位为毫秒"""
+
+    def __init__(self, target, logger, timeout=600):
+        self.target = target
+        self.logger = logger
+        self.timeout = timeout
+
+    def _run(self, command, **kwargs):
+        status, output = self.target.run_stream(command, self.timeout, **kwargs)
+        if status != 0:
+            raise VsockBenchmarkError(f"'{command}' failed (status={status}): {output[-200:]}")
+        return output
+
+    def round_trip(self, count, session=True):
+        """执行 count 次空命令，返回每次的往返时间
+
+        session=False 时强制短连接模式（每条命令一次 connect + popen）。
+        """
+        saved = self.target.use_session
+        self.target.use_session = session
+        try:
+            if not session:
+                self.target.close_session()
+            # 首次调用包含建立会话的开销，不计入
+            self._run('true')
+            samples = []
+            for _ in range(count):
+                start = time.perf_counter()
+                self._run('true')
+                samples.append((time.perf_counter() - start) * 1000.0)
+            return samples
+        finally:
+            self.target.use_session = saved
+
+    def connect(self, count):
+        """建立并关闭 count 次 vsock 连接，返回每次的连接耗时"""
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            sock = self.target._connect(timeout=10)
+            elapsed = (time.perf_counter() - start) * 1000.0
+            if sock is None:
+                raise VsockBenchmarkError(f"connect to CID={self.target.cid} failed")
+            sock.close()
+            samples.append(elapsed)
+        return samples
+
+    def throughput(self, size, repeats):
+        """客户机输出 size 字节，返回 [{'seconds', 'first_byte', 'bytes', 'mbps'}]
+
+        输出只保留末尾少量字符，宿主机内存占用与负载大小无关。
+        """
+        results = []
+        for _ in range(repeats):
+            received = [0]
+            first_byte = []
+
+            def count(text):
+                if not first_byte:
+                    first_byte.append(time.perf_counter())
+                received[0] += len(text)
+
+            start = time.perf_counter()
+            # /dev/zero 的 NUL 是合法的单字节 UTF-8，解码后字符数等于字节数
+            self._run(f'head -c {size} /dev/zero', callback=count, tail_size=1)
+            seconds = time.perf_counter() - start
+            if received[0] < size:
+                raise VsockBenchmarkError(f"expected {size} bytes, received {received[0]}")
+            results.append({
+                'seconds': seconds,
+                'first_byte': (first_byte[0] - start) * 1000.0 if first_byte else None,
+                'bytes': received[0],
+                'mbps': received[0] / seconds / (1024 * 1024),
+            })
+        return results
+
+    def run(self, roundtrips=200, connects=50, sizes=DEFAULT_SIZES, repeats=3):
+        """执行全部测量，返回可 JSON 序列化的结果（延迟为毫秒的统计摘要）"""
+        results = {'round_trip': {}, 'throughput': {}}
+        for mode, session in (('session', True), ('oneshot', False)):
+            self.logger.info(f"vsock round trip ({mode}): {roundtrips} empty commands")
+            results['round_trip'][mode] = summarize(self.round_trip(roundtrips, session))
+        # 服务端不支持会话时，'session' 实际也是短连接
+        results['session_supported'] = self.target._session_supported is not False
+
+        self.logger.info(f"vsock connect: {connects} connections")
+        results['connect'] = summarize(self.connect(connects))
+
+        for text in sizes:
+            size = parse_size(text)
+            self.logger.info(f"vsock throughput: {format_size(size)} x {repeats}")
+            runs = self.throughput(size, repeats)
+            results['throughput'][format_size(size)] = {
+                'bytes': size,
+                'mbps': summarize([r['mbps'] for r in runs]),
+                'first_byte': summarize([r['first_byte'] for r in runs
+                                         if r['first_byte'] is not None]),
+                'seconds': summarize([r['seconds'] for r in runs]),
+            }
+        return results
+
+
+def _change(current, previous):
+    change = change_percent(current, previous)
+    return f"{change:+.1f}%" if change is not None else ''
+
+
+def format_report(results, previous=None, title='vsock transport'):
+    """生成文本报告，previous 为上一次结果时附带中位数的变化"""
+    def prev(*keys):
+        value = previous
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    lines = [title, '',
+             f"{'Latency (ms)':<24} {'median':>10} {'95% CI':>21} {'p99':>10} {'max':>10} {'vs prev':>9}"]
+    rows = [(f'round trip ({mode})', ('round_trip', mode)) for mode in results['round_trip']]
+    rows.append(('connect', ('connect',)))
+    for label, keys in rows:
+        stats = results
+        for key in keys:
+            stats = stats[key]
+        ci = f"[{stats['median_ci'][0]:.3f}, {stats['median_ci'][1]:.3f}]"
+        lines.append(f"{label:<24} {stats['median']:>10.3f} {ci:>21} {stats['p99']:>10.3f} "
+                     f"{stats['max']:>10.3f} {_change(stats['median'], prev(*keys, 'median')):>9}")
+    if not results.get('session_supported', True):
+        lines.append("(vsock-server does not support sessions, both modes used one-shot connections)")
+
+    lines += ['', f"{'Throughput':<24} {'MB/s':>10} {'min':>10} {'max':>10} "
+                  f"{'first byte ms':>14} {'vs prev':>9}"]
+    for size, entry in results['throughput'].items():
+        mbps = entry['mbps']
+        first = entry['first_byte'].get('median')
+        first = f"{first:.3f}" if first is not None else '-'
+        lines.append(f"{size:<24} {mbps['median']:>10.1f} {mbps['min']:>10.1f} {mbps['max']:>10.1f} "
+                     f"{first:>14} "
+                     f"{_change(mbps['median'], prev('throughput', size, 'mbps', 'median')):>9}")
+    return lines
@@ -0,0 +1,520 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS 内核采样分析（经 QMP，无需在内核中加入分析代码）
+#
+# 每次采样：
+#   1. QMP stop 暂停客户机
+#   2. HMP "info registers -a" 读取每个 vCPU 的 PC / 返回地址寄存器 / 帧指针
+#   3. 沿帧指针链用 HMP "x" 读取栈帧，得到调用链（需要 -C force-frame-pointers，
+#      ARCEOS_DWARF = "y" 时 arceos.bbclass 会打开）
+#   4. QMP cont 恢复运行
+# 地址用 starry.elf 的符号表（nm）符号化，输出 folded stacks（flamegraph.pl、
+# speedscope、inferno 均可读取）与自包含的 SVG 火焰图。
+#
+# OEQemuVsockTarget 通过 CaseProfiler 按测试用例挂接：测试用例 id 匹配
+# STARRY_PROFILE_TESTS 中的通配符时，在其命令执行期间采样。
+
+import os
+import re
+import time
+import zlib
+import shutil
+import struct
+import bisect
+import fnmatch
+import threading
+import subprocess
+from collections import Counter
+from xml.sax.saxutils import escape, quoteattr
+
+from oeqa.controllers.vsocktrace import current_test
+
+# ==================== 架构相关 ====================
+# pc / lr / fp 为寄存器名的候选（HMP 输出中的名字，小写）；frame 为栈帧中
+# (上一帧 FP, 返回地址) 相对当前 FP 的偏移：
+#   x86_64 / aarch64       FP 指向保存的 (FP, 返回地址)
+#   riscv64 / loongarch64  FP 指向帧顶（CFA），[FP-16] 为上一帧 FP，[FP-8] 为返回地址
+ARCH_REGISTERS = {
+    'x86_64':      {'pc': ('rip',), 'lr': (), 'fp': ('rbp',), 'frame': 0},
+    'aarch64':     {'pc': ('pc',), 'lr': ('x30', 'lr'), 'fp': ('x29', 'fp'), 'frame': 0},
+    'riscv64':     {'pc': ('pc',), 'lr': ('ra', 'x1'), 'fp': ('s0', 'fp', 'x8'), 'frame': -16},
+    'loongarch64': {'pc': ('pc',), 'lr': ('ra', 'r1'), 'fp': ('fp', 's9', 'r22'), 'frame': -16},
+}
+
+# ELF 头的 e_machine
+ELF_MACHINES = {62: 'x86_64', 183: 'aarch64', 243: 'riscv64', 258: 'loongarch64'}
+
+# 相邻栈帧的最大间距，超过时认为帧指针链已损坏
+MAX_FRAME_SIZE = 1024 * 1024
+
+# 不在内核代码段内的 PC（用户态）与无法符号化的内核地址
+USER_FRAME = '[user]'
+UNKNOWN_FRAME = '[unknown]'
+
+CPU_RE = re.compile(r'^CPU#(\d+)', re.MULTILINE)
+REGISTER_RE = re.compile(r'([A-Za-z][\w/]*)\s*[=:]?\s*(?:0x)?([0-9a-fA-F]{16})\b')
+MEMORY_RE = re.compile(r'0x([0-9a-fA-F]+)')
+RUST_HASH_RE = re.compile(r'::h[0-9a-f]{16}$')
+
+
+class ProfileError(Exception):
+    pass
+
+
+def elf_arch(path):
+    """从 ELF 头读取架构名（ARCH_REGISTERS 的键）"""
+    with open(path, 'rb') as f:
+        header = f.read(20)
+    if len(header) < 20 or header[:4] != b'\x7fELF':
+        raise ProfileError(f"{path} is not an ELF file")
+    byteorder = '<' if header[5] == 1 else '>'
+    machine, = struct.unpack_from(f'{byteorder}H', header, 18)
+    if machine not in ELF_MACHINES:
+        raise ProfileError(f"unsupported ELF machine {machine} in {path}")
+    return ELF_MACHINES[machine]
+
+
+def parse_registers(text):
+    """解析 HMP "info registers [-a]" 的输出，返回 {cpu_index: {寄存器名: 值}}
+
+    名字统一为小写，riscv 的 "x1/ra" 同时以 "x1" 与 "ra" 登记。
+    """
+    marks = list(CPU_RE.finditer(text))
+    if not marks:
+        sections = [(0, text)]
+    else:
+        sections = [(int(m.group(1)), text[m.end():marks[i + 1].start() if i + 1 < len(marks) else None])
+                    for i, m in enumerate(marks)]
+
+    cpus = {}
+    for index, section in sections:
+        regs = {}
+        for m in REGISTER_RE.finditer(section):
+            value = int(m.group(2), 16)
+            for name in m.group(1).lower().split('/'):
+                regs.setdefault(name, value)
+        if regs:
+            cpus[index] = regs
+    return cpus
+
+
+def parse_memory(text):
+    """解析 HMP "x /Ngx addr" 的输出，返回读到的值列表（读取失败时为空）"""
+    values = []
+    for line in text.splitlines():
+        if ':' in line:
+            values += [int(v, 16) for v in MEMORY_RE.findall(line.split(':', 1)[1])]
+    return values
+
+
+def _register(regs, names):
+    for name in names:
+        if name in regs:
+            return regs[name]
+    return None
+
+
+# ==================== 符号化 ====================
+
+def find_nm():
+    """查找可读取任意架构 ELF 的 nm（环境变量 STARRY_PROFILE_NM 优先）"""
+    for tool in (os.environ.get('STARRY_PROFILE_NM'), 'llvm-nm', 'rust-nm', 'nm'):
+        if tool and shutil.which(tool):
+            return tool
+    raise ProfileError("no nm found (set STARRY_PROFILE_NM)")
+
+
+class SymbolTable(object):
+    """内核 ELF 的函数符号表，按地址二分查找"""
+
+    def __init__(self, symbols):
+        # symbols: [(start, end 或 None, name)]，end 为 None 时取下一个符号的起始地址
+        symbols = sorted(symbols)
+        self.starts = [s[0] for s in symbols]
+        # folded 格式以 ';' 分隔栈帧，Rust 类型中的 "[u8; 4]" 需替换
+        self.names = [s[2].replace(';', ',') for s in symbols]
+        self.ends = []
+        for i, (start, end, _) in enumerate(symbols):
+            if not end or end <= start:
+                end = symbols[i + 1][0] if i + 1 < len(symbols) else start + 1
+            self.ends.append(end)
+        self.low = self.starts[0] if symbols else 0
+        self.high = max(self.ends) if symbols else 0
+        self._memo = {}
+
+    @classmethod
+    def load(cls, elf, nm=None):
+        """用 nm 读取 ELF 中的代码符号（Rust 符号去掉 ::h<hash> 后缀）"""
+        argv = [nm or find_nm(), '--defined-only', '--numeric-sort', '--print-size', '--demangle', elf]
+        try:
+            result = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    universal_newlines=True, errors='replace')
+        except OSError as e:
+            raise ProfileError(f"failed to run {argv[0]}: {e}")
+        if result.returncode:
+            raise ProfileError(f"{' '.join(argv)} failed: {result.stderr.strip()}")
+
+        symbols = []
+        for line in result.stdout.splitlines():
+            fields = line.split(None, 3)
+            if len(fields) == 4 and len(fields[2]) == 1:
+                addr, size, kind, name = fields
+                size = int(size, 16)
+            elif len(fields) >= 3 and len(fields[1]) == 1:
+                addr, kind, name = line.split(None, 2)
+                size = 0
+            else:
+                continue
+            if kind not in 'tTwW':
+                continue
+            start = int(addr, 16)
+            symbols.append((start, start + size if size else None, RUST_HASH_RE.sub('', name.strip())))
+        if not symbols:
+            raise ProfileError(f"no function symbols in {elf}")
+        return cls(symbols)
+
+    def contains(self, addr):
+        """地址是否在内核代码范围内"""
+        return self.low <= addr < self.high
+
+    def lookup(self, addr):
+        """返回地址所在的函数名，找不到返回 None"""
+        if addr in self._memo:
+            return self._memo[addr]
+        name = None
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr < self.ends[i]:
+            name = self.names[i]
+        self._memo[addr] = name
+        return name
+
+
+# ==================== 采样 ====================
+
+class SamplingProfiler(object):
+    """经 QMP 周期性暂停客户机并记录每个 vCPU 的内核调用栈
+
+    monitor(command, args) 执行 QMP 命令并返回 return 字段（OEQemuVsockTarget.monitor）。
+    采样在后台线程中进行，resume() / pause() 控制是否采样，take() 取出并清空结果。
+    """
+
+    def __init__(self, monitor, symbols, arch, logger, frequency=49, max_depth=64):
+        if arch not in ARCH_REGISTERS:
+            raise ProfileError(f"unsupported architecture {arch}")
+        self.monitor = monitor
+        self.symbols = symbols
+        self.arch = ARCH_REGISTERS[arch]
+        self.logger = logger
+        self.interval = 1.0 / frequency
+        self.max_depth = max_depth
+
+        self.stacks = Counter()
+        self.samples = 0
+        self.errors = 0
+        self.paused_seconds = 0.0
+
+        self._active = False
+        self._closed = False
+        self._cond = threading.Condition()
+        # 采样进行中持有，pause() 借此等待当前采样结束
+        self._sampling = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name='starry-profiler', daemon=True)
+        self._thread.start()
+
+    def _hmp(self, command):
+        return self.monitor('human-monitor-command', {'command-line': command}) or ''
+
+    def _read_frame(self, fp):
+        """读取 fp 对应栈帧中的 (上一帧 FP, 返回地址)，失败返回 None"""
+        values = parse_memory(self._hmp(f"x /2gx {fp + self.arch['frame']:#x}"))
+        return tuple(values[:2]) if len(values) >= 2 else None
+
+    def _frame_name(self, addr):
+        return self.symbols.lookup(addr) or UNKNOWN_FRAME
+
+    def _stack(self, regs):
+        """由一个 vCPU 的寄存器得到调用栈（根在前）"""
+        pc = _register(regs, self.arch['pc'])
+        if pc is None:
+            return None
+        if not self.symbols.contains(pc):
+            return [USER_FRAME]
+
+        returns = []
+        fp = _register(regs, self.arch['fp'])
+        while fp and fp % 8 == 0 and len(returns) < self.max_depth:
+            frame = self._read_frame(fp)
+            if frame is None:
+                break
+            next_fp, ret = frame
+            if not self.symbols.contains(ret):
+                break
+            returns.append(ret)
+            # 栈向低地址增长，调用者的帧在更高的地址
+            if not fp < next_fp <= fp + MAX_FRAME_SIZE:
+                break
+            fp = next_fp
+
+        # 叶函数可能没有建立栈帧，此时直接调用者只在返回地址寄存器中
+        lr = _register(regs, self.arch['lr'])
+        if (lr is not None and self.symbols.contains(lr) and (not returns or lr != returns[0])
+                and self.symbols.lookup(lr - 1) != self.symbols.lookup(pc)):
+            returns.insert(0, lr)
+
+        # 返回地址指向 call 的下一条指令，减 1 落在调用点所在的函数内
+        frames = [self._frame_name(pc)] + [self._frame_name(ret - 1) for ret in returns]
+        frames.reverse()
+        return frames
+
+    def sample(self):
+        """暂停客户机采样一次，返回每个 vCPU 的调用栈"""
+        start = time.perf_counter()
+        self.monitor('stop')
+        try:
+            cpus = parse_registers(self._hmp('info registers -a'))
+            stacks = [self._stack(cpus[index]) for index in sorted(cpus)]
+        finally:
+            self.monitor('cont')
+            self.paused_seconds += time.perf_counter() - start
+        return [s for s in stacks if s]
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._active and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            start = time.monotonic()
+            with self._sampling:
+                if self._active:
+                    self._sample_once()
+            time.sleep(max(0.0, self.interval - (time.monotonic() - start)))
+
+    def _sample_once(self):
+        try:
+            stacks = self.sample()
+        except Exception as e:
+            # QEMU 退出或正在从快照恢复等：跳过本次采样
+            self.errors += 1
+            log = self.logger.warning if self.errors == 1 else self.logger.debug
+            log(f"Profiler sample failed: {e}")
+            return
+        self.samples += 1
+        for stack in stacks:
+            self.stacks[';'.join(stack)] += 1
+
+    def resume(self):
+        with self._cond:
+            self._active = True
+            self._cond.notify()
+
+    def pause(self):
+        """停止采样，返回前等待进行中的采样结束（客户机已恢复运行）"""
+        with self._cond:
+            self._active = False
+        with self._sampling:
+            pass
+
+    def take(self):
+        """取出并清空结果，返回 (stacks, stats)"""
+        with self._sampling:
+            stacks = self.stacks
+            stats = {'samples': self.samples, 'errors': self.errors,
+                     'paused_seconds': self.paused_seconds}
+            self.stacks = Counter()
+            self.samples = self.errors = 0
+            self.paused_seconds = 0.0
+        return stacks, stats
+
+    def close(self):
+        with self._cond:
+            self._active = False
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+# ==================== 输出 ====================
+
+def write_folded(path, stacks):
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f"{stack} {count}\n")
+
+
+def top_functions(stacks, count=10):
+    """按自身时间（栈顶函数）排序，返回 [(函数, 采样数)]"""
+    leaves = Counter()
+    for stack, n in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += n
+    return leaves.most_common(count)
+
+
+# 火焰图布局（像素）
+SVG_WIDTH = 1200
+SVG_PAD = 10
+FRAME_HEIGHT = 16
+FONT_SIZE = 12
+CHAR_WIDTH = 7
+
+
+def _color(name):
+    """按函数名哈希的暖色（与 flamegraph.pl 的 hot 配色相近），同名函数颜色一致"""
+    h = zlib.crc32(name.encode('utf-8'))
+    return f"rgb({205 + h % 50},{(h >> 8) % 230},{(h >> 16) % 55})"
+
+
+def render_flamegraph(stacks, title='StarryOS kernel profile'):
+    """由 folded stacks 生成 SVG 火焰图（根在底部，同层按函数名排序）"""
+    total = sum(stacks.values())
+    root = [0, {}]
+    for stack, count in stacks.items():
+        node = root
+        node[0] += count
+        for frame in stack.split(';'):
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += count
+
+    def depth(node):
+        return 1 + max((depth(child) for child in node[1].values()), default=0)
+
+    levels = depth(root)
+    height = levels * FRAME_HEIGHT + 3 * SVG_PAD + FONT_SIZE
+    scale = (SVG_WIDTH - 2 * SVG_PAD) / total if total else 0
+    out = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" height="{height}" '
+           f'viewBox="0 0 {SVG_WIDTH} {height}" font-family="monospace" font-size="{FONT_SIZE}">',
+           f'<rect width="100%" height="100%" fill="#f8f8f8"/>',
+           f'<text x="{SVG_WIDTH // 2}" y="{SVG_PAD + FONT_SIZE}" text-anchor="middle">'
+           f'{escape(title)} ({total} samples)</text>']
+
+    def draw(name, node, x, level):
+        width = node[0] * scale
+        if width < 0.5:
+            return
+        y = height - SVG_PAD - (level + 1) * FRAME_HEIGHT
+        label = f"{name} ({node[0]} samples, {100.0 * node[0] / total:.2f}%)"
+        out.append(f'<g><title>{escape(label)}</title>'
+                   f'<rect x="{x:.1f}" y="{y}" width="{width:.1f}" height="{FRAME_HEIGHT - 1}" '
+                   f'fill={quoteattr(_color(name))} rx="2"/>')
+        chars = int((width - 4) // CHAR_WIDTH)
+        if chars >= 3:
+            text = name if len(name) <= chars else name[:chars - 2] + '..'
+            out.append(f'<text x="{x + 2:.1f}" y="{y + FRAME_HEIGHT - 4}">{escape(text)}</text>')
+        out.append('</g>')
+        for child in sorted(node[1]):
+            draw(child, node[1][child], x, level + 1)
+            x += node[1][child][0] * scale
+
+    if total:
+        draw('all', root, SVG_PAD, 0)
+    out.append('</svg>')
+    return '\n'.join(out) + '\n'
+
+
+# ==================== 按测试用例挂接 ====================
+
+class CaseProfiler(object):
+    """在匹配的 OEQA 测试用例执行命令期间采样
+
+    target 在每条命令前后调用 enter() / exit()；测试用例变化或 close() 时把上一个
+    测试用例的结果写入 directory：profile-<测试用例 id>.folded 与 .svg。
+    patterns 为测试用例 id 的通配符列表，例如 ["stress.*", "*unixbench*"]。
+    符号表在第一次匹配时才加载，加载失败只记录警告并关闭分析，不影响测试。
+    """
+
+    def __init__(self, monitor, elf, directory, logger, patterns, frequency=49, max_depth=64):
+        self.monitor = monitor
+        self.elf = elf
+        self.directory = directory
+        self.logger = logger
+        self.patterns = list(patterns)
+        self.frequency = frequency
+        self.max_depth = max_depth
+        self.outputs = []
+        self._sampler = None
+        self._test = None
+        self._enabled = False
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def _matches(self, test):
+        return bool(test) and any(fnmatch.fnmatchcase(test, p) for p in self.patterns)
+
+    def _start_sampler(self):
+        try:
+            symbols = SymbolTable.load(self.elf)
+            arch = elf_arch(self.elf)
+            self._sampler = SamplingProfiler(self.monitor, symbols, arch, self.logger,
+                                             self.frequency, self.max_depth)
+        except (ProfileError, OSError) as e:
+            self.logger.warning(f"Kernel profiling disabled: {e}")
+            self.patterns = []
+            return False
+        self.logger.info(f"Kernel profiling {arch} at {self.frequency:g} Hz, "
+                         f"{len(symbols.starts)} symbols from {self.elf}")
+        return True
+
+    def enter(self):
+        """命令开始；返回是否计入采样，作为 exit() 的参数"""
+        test = current_test()
+        with self._lock:
+            if test != self._test:
+                self._finish()
+                self._test = test
+                self._enabled = self._matches(test) and (self._sampler is not None
+                                                         or self._start_sampler())
+            if not self._enabled:
+                return False
+            self._active += 1
+            if self._active == 1:
+                self._sampler.resume()
+            return True
+
+    def exit(self, counted):
+        if not counted:
+            return
+        with self._lock:
+            if self._active:
+                self._active -= 1
+                if not self._active:
+                    self._sampler.pause()
+
+    def _finish(self):
+        """写出当前测试用例的结果（调用方持有 _lock）"""
+        if not self._enabled:
+            return
+        self._enabled = False
+        self._active = 0
+        self._sampler.pause()
+        stacks, stats = self._sampler.take()
+        if not stacks:
+            self.logger.info(f"Profile {self._test}: no samples")
+            return
+
+        base = os.path.join(self.directory, f"profile-{self._test}")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_folded(f"{base}.folded", stacks)
+            with open(f"{base}.svg", 'w') as f:
+                f.write(render_flamegraph(stacks, f"StarryOS kernel profile: {self._test}"))
+        except OSError as e:
+            self.logger.warning(f"Failed to write profile for {self._test}: {e}")
+            return
+        self.outputs.append((f"{base}.folded", f"{base}.svg"))
+
+        total = sum(stacks.values())
+        pause = 1000.0 * stats['paused_seconds'] / stats['samples'] if stats['samples'] else 0.0
+        self.logger.info(f"Profile {self._test}: {stats['samples']} samples ({total} vCPU stacks), "
+                         f"mean pause {pause:.1f} ms, {stats['errors']} errors, {base}.svg")
+        for name, count in top_functions(stacks, 5):
+            self.logger.info(f"  {100.0 * count / total:5.1f}%  {name}")
+
+    def close(self):
+        with self._lock:
+            self._finish()
+            self._test = None
+            if self._sampler:
+                self._sampler.close()
+                self._sampler = None
@@ -0,0 +1,455 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS vsock 传输层：长连接会话（多路复用）与流式输出接收
+
+import time
+import queue
+import codecs
+import asyncio
+import struct
+import socket
+import threading
+import itertools
+from collections import deque
+
+# ==================== 会话协议 ====================
+# 与 vsock-server.c 保持一致：
+# - 宿主机先发送握手行 "@session 1\n"，服务端回复 "SESSION OK 1\n"
+# - 之后双方交换帧：[req_id:u32][type:u8][length:u32] + payload（网络字节序）
+# - 旧版服务端会把握手行当作普通命令执行，据此判断是否支持会话模式
+SESSION_HELLO = b'@session 1\n'
+SESSION_ACK = b'SESSION OK 1\n'
+
+FRAME_HEADER = struct.Struct('!IBI')
+FRAME_EXEC = 1      # 宿主机 -> 服务端: 执行命令，payload 为命令字符串
+FRAME_DATA = 2      # 服务端 -> 宿主机: 命令输出片段
+FRAME_EXIT = 3      # 服务端 -> 宿主机: 命令结束，payload 为 int32 退出码
+
+EXIT_STATUS = struct.Struct('!i')
+
+# 单个命令帧的长度上限，需与 vsock-server.c 的 MAX_COMMAND_SIZE 一致
+MAX_COMMAND_SIZE = 1024 * 1024
+
+# 短连接模式的响应结尾: "EXIT_CODE: N\n"
+EXIT_MARKER = b'EXIT_CODE:'
+
+
+class VsockSessionError(Exception):
+    """会话不可用（握手失败或连接中断）"""
+
+
+class VsockSessionUnsupported(VsockSessionError):
+    """服务端不支持会话模式（旧版 vsock-server）"""
+
+
+def recv_exact(sock, size):
+    """从 socket 读取恰好 size 字节，对端关闭时抛出 ConnectionResetError"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionResetError("vsock peer closed the connection")
+        received += n
+    return bytes(buf)
+
+
+class OutputSink(object):
+    """命令输出的增量接收端
+
+    - 按 UTF-8 增量解码，跨片段的多字节字符不会被截断
+    - 每个片段解码后立即交给 callback
+    - 片段存入列表，最后一次性拼接（线性时间）；指定 tail_size 时
+      只保留末尾约 tail_size 个字符，内存占用与输出总量无关
+    """
+
+    def __init__(self, callback=None, tail_size=None):
+        self.callback = callback
+        self.tail_size = tail_size
+        self.total_bytes = 0
+        # 收到第一段输出的时刻（time.perf_counter()），用于命令计时
+        self.first_data = None
+        self.truncated = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._chunks = deque()
+        self._size = 0
+
+    def feed(self, data):
+        if not data:
+            return
+        if self.first_data is None:
+            self.first_data = time.perf_counter()
+        self.total_bytes += len(data)
+        self._append(self._decoder.decode(data))
+
+    def _append(self, text):
+        if not text:
+            return
+        if self.callback:
+            self.callback(text)
+        self._chunks.append(text)
+        self._size += len(text)
+        if self.tail_size is not None:
+            while len(self._chunks) > 1 and self._size - len(self._chunks[0]) >= self.tail_size:
+                self._size -= len(self._chunks.popleft())
+                self.truncated = True
+
+    def getvalue(self):
+        """返回保留的输出（首次调用时冲刷解码器）"""
+        self._append(self._decoder.decode(b'', True))
+        text = ''.join(self._chunks)
+        if self.tail_size is not None and len(text) > self.tail_size:
+            self.truncated = True
+            text = text[-self.tail_size:]
+        return text
+
+
+class TrailerScanner(object):
+    """增量检测短连接模式响应结尾的 "EXIT_CODE: N\\n"
+
+    每次只扫描新到达的数据，加上与上一片段重叠的 len(EXIT_MARKER)-1 字节，
+    结尾之前的数据可以立即交付；整体为线性时间。
+    """
+
+    def __init__(self):
+        self._pending = bytearray()
+        self._in_trailer = False
+        self.found = False
+        self.status = 0
+
+    def feed(self, data):
+        """输入新数据，返回可以交付给调用方的输出（不含结尾）"""
+        buf = self._pending
+        buf += data
+        if not self._in_trailer:
+            idx = buf.find(EXIT_MARKER)
+            if idx < 0:
+                cut = max(0, len(buf) - (len(EXIT_MARKER) - 1))
+                out = bytes(buf[:cut])
+                del buf[:cut]
+                return out
+            out = bytes(buf[:idx])
+            del buf[:idx]
+            self._in_trailer = True
+        else:
+            out = b''
+
+        if b'\n' in buf:
+            self._parse_trailer(bytes(buf[:buf.index(b'\n')]))
+        return out
+
+    def eof(self):
+        """连接关闭，返回残留的输出"""
+        if self._in_trailer and not self.found:
+            self._parse_trailer(bytes(self._pending))
+            return b''
+        out = bytes(self._pending)
+        self._pending.clear()
+        return out
+
+    def _parse_trailer(self, line):
+        self.found = True
+        self._pending.clear()
+        try:
+            self.status = int(line.split(b':', 1)[1].strip())
+        except (IndexError, ValueError):
+            pass
+
+
+class PendingCommand(object):
+    """一个已发出、尚未完成的会话请求
+
+    接收线程把输出片段放入队列，由等待结果的调用方线程取出，
+    因此输出回调总是在调用 run 的线程中执行。
+    """
+
+    __slots__ = ('req_id', 'command', 'status', 'error', 'chunks')
+
+    def __init__(self, req_id, command):
+        self.req_id = req_id
+        self.command = command
+        self.status = None
+        self.error = None
+        self.chunks = queue.SimpleQueue()
+
+    def feed(self, data):
+        self.chunks.put(data)
+
+    def finish(self, status):
+        self.status = status
+        self.chunks.put(None)
+
+    def abort(self, error):
+        self.error = error
+        self.chunks.put(None)
+
+    def iter_chunks(self, timeout):
+        """按到达顺序产出输出片段
+
+        与短连接模式的 socket 超时一致，timeout 是相邻两个片段之间的最长等待，
+        超时抛出 socket.timeout。
+        """
+        while True:
+            try:
+                data = self.chunks.get(timeout=timeout)
+            except queue.Empty:
+                raise socket.timeout("timed out waiting for command output")
+            if data is None:
+                return
+            yield data
+
+
+class VsockSession(object):
+    """基于单条 vsock 连接的命令会话
+
+    - 每个请求带 req_id，可同时有多个请求在途（流水线）
+    - 后台线程负责接收并按 req_id 分发响应帧
+    - 连接中断后由调用方重新 open()，即可透明重连
+    """
+
+    def __init__(self, sock, logger, max_inflight=8):
+        self.sock = sock
+        self.logger = logger
+        self.max_inflight = max_inflight
+        self.pending = {}
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._reader = None
+        self._close_reason = None
+
+    @classmethod
+    def open(cls, sock, logger, timeout, max_inflight=8):
+        """在已连接的 socket 上完成握手并启动接收线程"""
+        sock.settimeout(timeout)
+        sock.sendall(SESSION_HELLO)
+        ack = b''
+        while not ack.endswith(b'\n') and len(ack) < 256:
+            chunk = sock.recv(1)
+            if not chunk:
+                break
+            ack += chunk
+        if ack != SESSION_ACK:
+            raise VsockSessionUnsupported(
+                "vsock-server does not support session mode: %r" % ack[:64])
+
+        sock.settimeout(None)
+        session = cls(sock, logger, max_inflight)
+        session._reader = threading.Thread(target=session._read_loop,
+                                           name='vsock-session-reader',
+                                           daemon=True)
+        session._reader.start()
+        return session
+
+    def _send_frame(self, req_id, ftype, payload=b''):
+        header = FRAME_HEADER.pack(req_id, ftype, len(payload))
+        with self._send_lock:
+            self.sock.sendall(header + payload)
+
+    def submit(self, command):
+        """发送一个命令请求，返回 PendingCommand
+
+        发送失败时抛出 VsockSessionError，此时命令保证未被服务端执行。
+        """
+        payload = command.encode('utf-8')
+        if len(payload) > MAX_COMMAND_SIZE:
+            raise ValueError("command too long for vsock session (%d bytes)" % len(payload))
+
+        self._slots.acquire()
+        with self._lock:
+            if self.closed:
+                self._slots.release()
+                raise VsockSessionError("session closed")
+            req_id = next(self._ids) & 0xffffffff
+            pending = PendingCommand(req_id, command)
+            self.pending[req_id] = pending
+
+        try:
+            self._send_frame(req_id, FRAME_EXEC, payload)
+        except OSError as e:
+            self._release(req_id)
+            self.close("Connection lost: send failed")
+            raise VsockSessionError("send failed: %s" % e)
+        return pending
+
+    def _release(self, req_id):
+        with self._lock:
+            if self.pending.pop(req_id, None) is not None:
+                self._slots.release()
+
+    def _read_loop(self):
+        error = "Connection lost: session closed by peer"
+        try:
+            while True:
+                req_id, ftype, length = FRAME_HEADER.unpack(
+                    recv_exact(self.sock, FRAME_HEADER.size))
+                payload = recv_exact(self.sock, length) if length else b''
+
+                with self._lock:
+                    pending = self.pending.get(req_id)
+                if pending is None:
+                    self.logger.debug(f"vsock session: dropping frame {ftype} for unknown request {req_id}")
+                    continue
+
+                if ftype == FRAME_DATA:
+                    pending.feed(payload)
+                elif ftype == FRAME_EXIT:
+                    status = EXIT_STATUS.unpack(payload)[0] if len(payload) == EXIT_STATUS.size else 255
+                    self._release(req_id)
+                    pending.finish(status)
+        except (OSError, ValueError, struct.error) as e:
+            with self._lock:
+                reason = self._close_reason
+            error = reason or f"Connection lost: {e}"
+        finally:
+            self._abort_all(error)
+
+    def _abort_all(self, error):
+        with self._lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for p in pending:
+            self._slots.release()
+            p.abort(error)
+
+    def close(self, reason="Connection lost: session reset"):
+        with self._lock:
+            already = self.closed
+            self.closed = True
+            if not already:
+                self._close_reason = reason
+        if not already:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class AsyncPendingCommand(object):
+    """AsyncVsockSession 中一个尚未完成的请求"""
+
+    __slots__ = ('req_id', 'command', 'status', 'error', 'chunks')
+
+    def __init__(self, req_id, command):
+        self.req_id = req_id
+        self.command = command
+        self.status = None
+        self.error = None
+        self.chunks = asyncio.Queue()
+
+    def finish(self, status):
+        self.status = status
+        self.chunks.put_nowait(None)
+
+    def abort(self, error):
+        self.error = error
+        self.chunks.put_nowait(None)
+
+    async def iter_chunks(self, timeout):
+        """语义同 PendingCommand.iter_chunks"""
+        while True:
+            try:
+                data = await asyncio.wait_for(self.chunks.get(), timeout)
+            except asyncio.TimeoutError:
+                raise socket.timeout("timed out waiting for command output")
+            if data is None:
+                return
+            yield data
+
+
+class AsyncVsockSession(object):
+    """VsockSession 的 asyncio 版本，协议相同
+
+    接收由事件循环中的任务完成，不占用线程；对象只能在创建它的事件循环中使用。
+    """
+
+    def __init__(self, reader, writer, logger):
+        self.reader = reader
+        self.writer = writer
+        self.logger = logger
+        self.pending = {}
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._task = None
+        self._close_reason = None
+
+    @classmethod
+    async def open(cls, reader, writer, logger, timeout):
+        """完成握手并启动接收任务"""
+        writer.write(SESSION_HELLO)
+        await writer.drain()
+        ack = await asyncio.wait_for(reader.readline(), timeout)
+        if ack != SESSION_ACK:
+            writer.close()
+            raise VsockSessionUnsupported(
+                "vsock-server does not support session mode: %r" % ack[:64])
+        session = cls(reader, writer, logger)
+        session._task = asyncio.ensure_future(session._read_loop())
+        return session
+
+    async def submit(self, command):
+        """发送一个命令请求，返回 AsyncPendingCommand"""
+        payload = command.encode('utf-8')
+        if len(payload) > MAX_COMMAND_SIZE:
+            raise ValueError("command too long for vsock session (%d bytes)" % len(payload))
+        if self.closed:
+            raise VsockSessionError("session closed")
+
+        req_id = next(self._ids) & 0xffffffff
+        pending = AsyncPendingCommand(req_id, command)
+        self.pending[req_id] = pending
+        try:
+            self.writer.write(FRAME_HEADER.pack(req_id, FRAME_EXEC, len(payload)) + payload)
+            await self.writer.drain()
+        except OSError as e:
+            self.pending.pop(req_id, None)
+            self.close("Connection lost: send failed")
+            raise VsockSessionError("send failed: %s" % e)
+        return pending
+
+    async def _read_loop(self):
+        error = "Connection lost: session closed by peer"
+        try:
+            while True:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                req_id, ftype, length = FRAME_HEADER.unpack(header)
+                payload = await self.reader.readexactly(length) if length else b''
+
+                pending = self.pending.get(req_id)
+                if pending is None:
+                    self.logger.debug(f"vsock session: dropping frame {ftype} for unknown request {req_id}")
+                    continue
+                if ftype == FRAME_DATA:
+                    pending.chunks.put_nowait(payload)
+                elif ftype == FRAME_EXIT:
+                    status = EXIT_STATUS.unpack(payload)[0] if len(payload) == EXIT_STATUS.size else 255
+                    del self.pending[req_id]
+                    pending.finish(status)
+        except (OSError, asyncio.IncompleteReadError, struct.error) as e:
+            error = self._close_reason or f"Connection lost: {e}"
+        except asyncio.CancelledError:
+            error = self._close_reason or "Connection lost: session reset"
+            # 清理（finally）后继续传播，任务的状态保持为已取消
+            raise
+        finally:
+            self.closed = True
+            pending, self.pending = list(self.pending.values()), {}
+            for p in pending:
+                p.abort(error)
+
+    def close(self, reason="Connection lost: session reset"):
+        if not self.closed:
+            self.closed = True
+            self._close_reason = reason
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self.writer.close()
@@ -0,0 +1,356 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS OEQA 分片并行执行（多个客户机同时运行测试）
+
+import os
+import json
+import time
+import fcntl
+import heapq
+import shutil
+import logging
+import tempfile
+import traceback
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# ==================== CID 分配 ====================
+# 宿主机范围内用 flock 锁文件协调，进程退出时锁自动释放；
+# 0-2 为保留 CID，103 留给手动 runqemu 的客户机，从 CID_BASE 开始分配
+CID_BASE = 1000
+CID_COUNT = 4096
+CID_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'starry-vsock-cids')
+
+# 没有历史耗时记录的测试用例按该时长（秒）估算
+DEFAULT_DURATION = 30.0
+
+# 自动分片时的最大客户机数
+MAX_SHARDS = 16
+
+
+class CidLease(object):
+    """一个已分配的 guest CID，持有期间其他进程不会分配到同一个 CID"""
+
+    def __init__(self, cid, fd):
+        self.cid = cid
+        self._fd = fd
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def allocate_cid(lock_dir=CID_LOCK_DIR):
+    """分配一个本机未被占用的 guest CID，返回 CidLease"""
+    os.makedirs(lock_dir, exist_ok=True)
+    # 从与 pid 相关的位置开始找，减少并发分配时的冲突
+    offset = os.getpid() % CID_COUNT
+    for i in range(CID_COUNT):
+        cid = CID_BASE + (offset + i) % CID_COUNT
+        fd = os.open(os.path.join(lock_dir, f'{cid}.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        return CidLease(cid, fd)
+    raise RuntimeError(f"no free vsock CID in {CID_BASE}-{CID_BASE + CID_COUNT - 1}")
+
+
+def make_overlay(rootfs, workdir):
+    """为客户机创建 rootfs 的写时复制副本（reflink），返回路径
+
+    文件系统不支持 reflink 时返回 None，此时各客户机共享只读的 rootfs，
+    由 QEMU -snapshot（testimage 默认丢弃写入）提供各自的临时覆盖层。
+    """
+    path = os.path.join(workdir, os.path.basename(rootfs))
+    result = subprocess.run(['cp', '--reflink=always', '--sparse=always', rootfs, path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode:
+        if os.path.exists(path):
+            os.unlink(path)
+        return None
+    return path
+
+
+# ==================== 分片规划 ====================
+
+class DurationHistory(object):
+    """测试用例的历史耗时（JSON：{test_id: seconds}）"""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.durations = json.load(f)
+        except (OSError, ValueError):
+            self.durations = {}
+
+    def estimate(self, test_id):
+        return self.durations.get(test_id, DEFAULT_DURATION)
+
+    def update(self, results):
+        """用本次结果更新历史（与旧值平均，平滑偶发的波动）"""
+        for test_id, result in results.items():
+            duration = result.get('duration')
+            if duration is None or result.get('status') == 'SKIPPED':
+                continue
+            old = self.durations.get(test_id)
+            self.durations[test_id] = duration if old is None else (old + duration) / 2
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.durations, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def plan_shards(tests, history, count):
+    """按历史耗时做最长优先（LPT）装箱，返回 count 个以内的测试列表
+
+    每个分片内保持原有顺序，以便同一测试类的用例仍然相邻执行。
+    """
+    count = max(1, min(count, len(tests)))
+    order = {test: i for i, test in enumerate(tests)}
+    bins = [(0.0, i, []) for i in range(count)]
+    heapq.heapify(bins)
+    for test in sorted(tests, key=lambda t: (-history.estimate(t), order[t])):
+        load, index, members = heapq.heappop(bins)
+        members.append(test)
+        heapq.heappush(bins, (load + history.estimate(test), index, members))
+
+    shards = sorted(bins, key=lambda b: b[1])
+    return [sorted(members, key=order.get) for _, _, members in shards if members]
+
+
+def iter_tests(suite):
+    """展开 unittest 套件，逐个返回测试用例"""
+    for test in suite:
+        if hasattr(test, '__iter__'):
+            yield from iter_tests(test)
+        else:
+            yield test
+
+
+# ==================== 执行与合并 ====================
+
+def collect_results(result):
+    """把 OETestResult 转换为 testresults.json 格式的 {test_id: {status, log, duration}}"""
+    results = {}
+
+    def add(items, status):
+        for item in items:
+            test, log = item if isinstance(item, tuple) else (item, '')
+            results[test.id()] = {'status': status, 'log': log or ''}
+
+    # OETestResult.successes 已是 (test, None) 元组；unexpectedSuccesses 只有测试本身
+    add(getattr(result, 'successes', []), 'PASSED')
+    add(result.failures, 'FAILED')
+    add(result.errors, 'ERROR')
+    add(result.skipped, 'SKIPPED')
+    add(result.expectedFailures, 'EXPECTEDFAIL')
+    add([(t, '') for t in result.unexpectedSuccesses], 'UNEXPECTEDSUCCESS')
+
+    starttime = getattr(result, 'starttime', {})
+    endtime = getattr(result, 'endtime', {})
+    for test_id, entry in results.items():
+        if test_id in starttime and test_id in endtime:
+            entry['duration'] = round(endtime[test_id] - starttime[test_id], 3)
+    return results
+
+
+def run_shard(index, tests, job):
+    """子进程中运行一个分片：启动独立的客户机并执行其中的测试
+
+    返回 (results, trace_files)，后者为该客户机导出的 vsock 命令计时文件（见 vsocktrace.py）。
+    """
+    from oeqa.runtime.context import OERuntimeTestContext
+    from oeqa.controllers.vsocktarget import OEQemuVsockTarget
+
+    logger = logging.getLogger(f'starry.shard{index}')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler = logging.FileHandler(os.path.join(job['log_dir'], f'shard-{index}.log'))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(handler)
+
+    kwargs = dict(job['target_kwargs'])
+    kwargs['bootlog'] = os.path.join(job['log_dir'], f'qemu_boot_log.shard{index}')
+    workdir = tempfile.mkdtemp(prefix=f'starry-shard{index}-', dir=job['work_dir'])
+    target = None
+    try:
+        overlay = make_overlay(kwargs['rootfs'], workdir)
+        if overlay:
+            # 热启动快照按原始镜像缓存，不随每次运行的 overlay 重新保存
+            kwargs['snapshot_image'] = kwargs['rootfs']
+            kwargs['rootfs'] = overlay
+        target = OEQemuVsockTarget(logger, None, job['server_ip'], **kwargs)
+        logger.info(f"Shard {index}: {len(tests)} tests on CID={target.cid}, rootfs {kwargs['rootfs']}")
+        tc = OERuntimeTestContext(job['td'], logger, target, job['packages'], job['extract_dir'])
+        tc.loadTests(job['module_paths'], modules=job['modules'], tests=tests)
+        target.start(params=job['qemuparams'], runqemuparams=job['runqemuparams'])
+        try:
+            results = collect_results(tc.runTests())
+        finally:
+            target.stop()
+    except Exception:
+        # 创建 overlay、分配 CID 或客户机启动失败等：该分片的测试全部记为 ERROR，不影响其他分片
+        log = traceback.format_exc()
+        logger.error(log)
+        results = {test: {'status': 'ERROR', 'log': log} for test in tests}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results, target.trace_files if target else None
+
+
+def _run_pool(shards, job, logger):
+    """在子进程中运行各分片，返回 (合并的结果, 各客户机导出的命令计时文件)"""
+    merged = {}
+    exports = []
+    # fork 方式启动子进程，继承已加载的 OEQA 模块和 BitBake 环境
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as pool:
+        futures = [pool.submit(run_shard, i, tests, job) for i, tests in enumerate(shards)]
+        for index, future in enumerate(futures):
+            results, trace_files = future.result()
+            if trace_files:
+                exports.append(trace_files)
+            passed = sum(1 for r in results.values() if r['status'] == 'PASSED')
+            logger.info(f"Shard {index}: {passed}/{len(results)} passed")
+            merged.update(results)
+    return merged, exports
+
+
+def run_shards(shards, job, logger):
+    """并行运行全部分片，返回合并后的结果
+
+    各客户机的 vsock 命令计时合并为 log_dir 下的 vsock-trace.json 与 vsock-summary.csv。
+    就绪通知端口只能由一个进程监听，由父进程的 ReadyRelay 接收后按 CID 转发给各分片。
+    """
+    from oeqa.controllers.vsocktarget import READY_PORT
+    from oeqa.controllers.vsocktarget import ReadyRelay
+    from oeqa.controllers.vsocktrace import merge_exports
+
+    relay = None
+    port = job['target_kwargs'].get('ready_port', READY_PORT)
+    if port:
+        try:
+            relay = ReadyRelay(port)
+            job = dict(job, target_kwargs=dict(job['target_kwargs'], ready_relay=relay.directory))
+        except OSError as e:
+            logger.info(f"vsock ready relay on port {port} unavailable ({e}), shards will probe")
+
+    try:
+        merged, exports = _run_pool(shards, job, logger)
+    finally:
+        if relay:
+            relay.close()
+
+    if exports:
+        try:
+            trace_path, summary_path = merge_exports(exports, job['log_dir'])
+            logger.info(f"vsock command trace: {trace_path}, per-test summary: {summary_path}")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Failed to merge vsock command traces: {e}")
+    return merged
+
+
+def testimage_shard_main(d, module_paths, boot_patterns, configuration):
+    """do_testimage_shard 任务的实现（由 testimage-shard.bbclass 调用）
+
+    module_paths、boot_patterns、configuration 分别来自 testimage.bbclass 的
+    get_runtime_paths()、get_testimage_boot_patterns() 与
+    get_testimage_configuration()。
+    """
+    import bb
+    import oe.types
+    from oeqa.core.runner import OETestResultJSONHelper
+    from oeqa.runtime.context import OERuntimeTestContext
+    from oeqa.runtime.context import OERuntimeTestContextExecutor
+    from oeqa.controllers.vsocktarget import OEQemuVsockTarget
+
+    logger = logging.getLogger('BitBake')
+    image_name = os.path.join(d.getVar('DEPLOY_DIR_IMAGE'), d.getVar('IMAGE_LINK_NAME'))
+    with open(f"{image_name}.testdata.json") as f:
+        td = json.load(f)
+    packages = OERuntimeTestContextExecutor.readPackagesManifest(f"{image_name}.manifest")
+
+    rootfs = None
+    for fstype in d.getVar('IMAGE_FSTYPES').split():
+        if fstype in OEQemuVsockTarget.supported_fstypes and os.path.exists(f"{image_name}.{fstype}"):
+            rootfs = f"{image_name}.{fstype}"
+            break
+    if not rootfs:
+        bb.fatal(f"No rootfs found for {image_name} (supported: {OEQemuVsockTarget.supported_fstypes})")
+
+    # 先加载一次测试（不启动客户机），得到需要分配的用例列表
+    modules = (d.getVar('TEST_SUITES') or '').split()
+    tc = OERuntimeTestContext(td, logger, None, packages, d.getVar('TEST_EXTRACTED_DIR'))
+    tc.loadTests(module_paths, modules=modules)
+    tests = [test.id() for test in iter_tests(tc.suites)]
+    if not tests:
+        bb.fatal("No runtime tests selected (check TEST_SUITES)")
+
+    history = DurationHistory(d.getVar('TESTIMAGE_SHARD_HISTORY'))
+    count = int(d.getVar('TESTIMAGE_SHARDS') or 0)
+    if count <= 0:
+        # 自动：每个客户机占用 ARCEOS_SMP 个 CPU
+        smp = int(d.getVar('ARCEOS_SMP') or 1)
+        count = min(MAX_SHARDS, max(1, (os.cpu_count() or 1) // smp))
+    shards = plan_shards(tests, history, count)
+    for i, shard in enumerate(shards):
+        estimate = sum(history.estimate(t) for t in shard)
+        logger.info(f"Shard {i}: {len(shard)} tests, estimated {estimate:.0f}s")
+
+    log_dir = d.getVar('TEST_LOG_DIR')
+    os.makedirs(log_dir, exist_ok=True)
+    runqemuparams = d.getVar('TEST_RUNQEMUPARAMS') or ''
+    job = {
+        'td': td,
+        'packages': packages,
+        'extract_dir': d.getVar('TEST_EXTRACTED_DIR'),
+        'module_paths': module_paths,
+        'modules': modules,
+        'server_ip': d.getVar('TEST_SERVER_IP'),
+        'log_dir': log_dir,
+        'work_dir': d.getVar('T'),
+        'qemuparams': d.getVar('TEST_QEMUPARAMS') or '',
+        'runqemuparams': runqemuparams,
+        'target_kwargs': {
+            'machine': d.getVar('MACHINE'),
+            'rootfs': rootfs,
+            'tmpdir': d.getVar('TMPDIR'),
+            'dir_image': d.getVar('DEPLOY_DIR_IMAGE'),
+            'display': d.getVar('BB_ORIGENV', False).getVar('DISPLAY'),
+            'boottime': int(d.getVar('TEST_QEMUBOOT_TIMEOUT')),
+            'kvm': oe.types.qemu_use_kvm(d.getVar('QEMU_USE_KVM'), d.getVar('TARGET_ARCH')),
+            'slirp': 'slirp' in runqemuparams,
+            'dump_dir': d.getVar('TESTIMAGE_DUMP_DIR'),
+            'serial_ports': len(d.getVar('SERIAL_CONSOLES').split()),
+            'boot_patterns': boot_patterns,
+            'tmpfsdir': d.getVar('RUNQEMU_TMPFS_DIR'),
+        },
+    }
+
+    starttime = time.time()
+    results = run_shards(shards, job, logger)
+    logger.info(f"Ran {len(results)} tests on {len(shards)} guests in {time.time() - starttime:.1f}s")
+
+    history.update(results)
+    history.save()
+
+    result_id = 'runtime_%s_%s_%s_%s' % (configuration['IMAGE_BASENAME'], configuration['MACHINE'],
+                                         configuration['IMAGE_PKGTYPE'], configuration['STARTTIME'])
+    OETestResultJSONHelper().dump_testresult_file(d.getVar('TEST_LOG_DIR'), configuration,
+                                                  result_id, results)
+
+    failed = sorted(t for t, r in results.items() if r['status'] in ('FAILED', 'ERROR'))
+    for test in failed:
+        logger.error(f"{test}: {results[test]['status']}\n{results[test]['log']}")
+    if failed:
+        bb.fatal(f"{d.getVar('PN')} - FAILED - {len(failed)} of {len(results)} tests failed, "
+                 f"also check the logs in {log_dir}", forcelog=True)
@@ -0,0 +1,365 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS QEMU 快照（OEQemuVsockTarget 的热启动与崩溃后快速恢复）
+
+import os
+import re
+import json
+import fcntl
+import time
+import shlex
+import shutil
+import socket
+import hashlib
+
+# ==================== 快照缓存 ====================
+# 每个 (machine, rootfs) 对应一个缓存目录：
+#   state      QMP migrate 导出的虚拟机状态（内存 + 设备）
+#   disk.img   快照时刻的根文件系统（drive-backup 全量导出，raw 格式）
+#   meta.json  QEMU 命令行、工作目录以及内核/rootfs 的 SHA-256
+# 恢复时以 -incoming defer 启动同样的 QEMU 命令行并 migrate-incoming，
+# disk.img 以 -snapshot 方式挂载，恢复过程不会修改缓存。
+
+# QB_ROOTFS_OPT 中根文件系统的 drive id
+ROOTFS_DRIVE = 'disk0'
+
+# 快照/恢复的 QMP 操作超时（秒）
+SNAPSHOT_TIMEOUT = 300
+
+HASH_CHUNK = 1024 * 1024
+
+
+class SnapshotError(Exception):
+    """快照保存或恢复失败"""
+
+
+class QmpError(SnapshotError):
+    """QMP 命令返回错误"""
+
+
+def unwrap_qmp(reply):
+    """从 QMP 应答中取出 return 字段，错误时抛出 QmpError"""
+    if reply is None:
+        raise QmpError("no reply from QEMU monitor")
+    if 'error' in reply:
+        error = reply['error']
+        raise QmpError(f"{error.get('class', 'Error')}: {error.get('desc', error)}")
+    return reply.get('return', reply)
+
+
+class QmpClient(object):
+    """最小的 QMP 客户端（unix socket，一问一答，忽略异步事件）"""
+
+    def __init__(self, path, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                break
+            except OSError:
+                sock.close()
+                # QEMU 启动后才会创建 socket
+                if time.time() >= deadline:
+                    raise SnapshotError(f"QMP socket {path} not available after {timeout}s")
+                time.sleep(0.01)
+        sock.settimeout(SNAPSHOT_TIMEOUT)
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self._read_reply(greeting=True)
+        self.cmd('qmp_capabilities')
+
+    def _read_reply(self, greeting=False):
+        while True:
+            line = self.reader.readline()
+            if not line:
+                raise SnapshotError("QMP connection closed by QEMU")
+            msg = json.loads(line)
+            if greeting and 'QMP' in msg:
+                return msg
+            if 'return' in msg or 'error' in msg:
+                return msg
+
+    def cmd(self, command, args=None):
+        request = {'execute': command}
+        if args:
+            request['arguments'] = args
+        self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        return unwrap_qmp(self._read_reply())
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def file_sha256(path, memo=None):
+    """流式计算文件 SHA-256；memo 为 {realpath: [size, mtime_ns, sha]}，未变化的文件直接复用"""
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    cached = memo.get(path) if memo is not None else None
+    if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+        return cached[2]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNK)
+            if not data:
+                break
+            sha.update(data)
+    digest = sha.hexdigest()
+    if memo is not None:
+        memo[path] = [st.st_size, st.st_mtime_ns, digest]
+    return digest
+
+
+def wait_migration(monitor, timeout=SNAPSHOT_TIMEOUT):
+    """轮询 query-migrate 直到迁移完成"""
+    deadline = time.time() + timeout
+    interval = 0.01
+    while time.time() < deadline:
+        info = monitor('query-migrate')
+        status = info.get('status')
+        if status == 'completed':
+            return info
+        if status in ('failed', 'cancelled'):
+            raise SnapshotError(f"migration {status}: {info.get('error-desc', '')}")
+        time.sleep(interval)
+        interval = min(interval * 2, 0.2)
+    raise SnapshotError(f"migration not completed after {timeout}s")
+
+
+def wait_block_jobs(monitor, timeout=SNAPSHOT_TIMEOUT):
+    """轮询 query-block-jobs 直到没有进行中的块任务"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not monitor('query-block-jobs'):
+            return
+        time.sleep(0.1)
+    raise SnapshotError(f"block job not completed after {timeout}s")
+
+
+def _option_value(argv, option):
+    """返回命令行中 option 的参数值，不存在返回 None"""
+    for i, arg in enumerate(argv[:-1]):
+        if arg == option:
+            return argv[i + 1]
+    return None
+
+
+def restore_argv(argv, rootfs, disk, qmp_path, serial_log, pidfile, cid=None):
+    """由冷启动时的 QEMU 命令行生成恢复用的命令行
+
+    - 根文件系统替换为缓存的 disk.img，并强制 -snapshot
+    - vsock 设备的 guest-cid 改为本次分配的 CID（迁移后客户机收到 transport
+      reset 事件，按 virtio 规范会重新读取 guest_cid）
+    - QemuRunner 的串口（tcp）改为写入文件，QMP 改为新的 unix socket
+    - 追加 -incoming defer，由 QMP migrate-incoming 载入状态
+    """
+    result = []
+    serials = 0
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        value = argv[i + 1] if i + 1 < len(argv) else None
+        if arg == '-serial' and value is not None:
+            result += ['-serial', f'file:{serial_log}' if serials == 0 else 'null']
+            serials += 1
+            i += 2
+            continue
+        if arg == '-qmp' and value is not None:
+            i += 2
+            continue
+        if arg == '-pidfile' and value is not None:
+            result += ['-pidfile', pidfile]
+            i += 2
+            continue
+        if arg in ('-S', '-incoming'):
+            i += 2 if arg == '-incoming' else 1
+            continue
+        if rootfs:
+            arg = arg.replace(rootfs, disk)
+        if cid is not None:
+            arg = re.sub(r'guest-cid=\d+', f'guest-cid={cid}', arg)
+        result.append(arg)
+        i += 1
+
+    if '-snapshot' not in result:
+        result.append('-snapshot')
+    result += ['-qmp', f'unix:{qmp_path},server=on,wait=off', '-S', '-incoming', 'defer']
+    return result
+
+
+class SnapshotCache(object):
+    """QEMU 热启动快照缓存
+
+    内核或根文件系统内容变化（SHA-256 不同）时缓存自动失效。
+    rootfs 为 QEMU 实际使用的根文件系统；image 为其来源镜像（分片执行时 rootfs
+    是每次运行临时创建的 overlay），缓存按 image 定位与校验，不同的运行可以共用。
+    """
+
+    def __init__(self, root, machine, rootfs, logger, image=None):
+        self.root = root
+        self.machine = machine
+        self.rootfs = os.path.realpath(rootfs) if rootfs else ''
+        self.rootfs_arg = rootfs
+        self.image = os.path.realpath(image) if image else self.rootfs
+        self.logger = logger
+        key = hashlib.sha1(f"{machine}:{self.image}".encode('utf-8')).hexdigest()[:16]
+        self.dir = os.path.join(root, f"{machine or 'qemu'}-{key}")
+        self.state = os.path.join(self.dir, 'state')
+        self.disk = os.path.join(self.dir, 'disk.img')
+        self.meta_path = os.path.join(self.dir, 'meta.json')
+        self._memo_path = os.path.join(root, 'hashes.json')
+        self._memo = None
+
+    # ==================== 内容哈希 ====================
+
+    def _hash(self, path):
+        if self._memo is None:
+            try:
+                with open(self._memo_path) as f:
+                    self._memo = json.load(f)
+            except (OSError, ValueError):
+                self._memo = {}
+        return file_sha256(path, self._memo)
+
+    def _save_memo(self):
+        if self._memo is None:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        # 缓存目录由并行的客户机共用：加锁后与磁盘上的内容合并再写回
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self._memo_path) as f:
+                    memo = json.load(f)
+            except (OSError, ValueError):
+                memo = {}
+            memo.update(self._memo)
+            tmp = f'{self._memo_path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(memo, f)
+            os.replace(tmp, self._memo_path)
+
+    def _inputs(self, argv, cwd):
+        """快照依赖的输入文件：根文件系统与 QEMU 命令行中的 -kernel/-initrd"""
+        paths = [self.image]
+        for option in ('-kernel', '-initrd'):
+            value = _option_value(argv, option)
+            if value:
+                paths.append(os.path.realpath(os.path.join(cwd, value)))
+        return {path: self._hash(path) for path in paths if path and os.path.exists(path)}
+
+    # ==================== 读写 ====================
+
+    def load(self):
+        """返回有效的快照元数据；不存在或已失效返回 None（失效时删除缓存）"""
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not (os.path.exists(self.state) and os.path.exists(self.disk)):
+            self.invalidate("incomplete snapshot")
+            return None
+        try:
+            inputs = self._inputs(meta['argv'], meta['cwd'])
+        finally:
+            self._save_memo()
+        if inputs != meta.get('inputs'):
+            self.invalidate("kernel or rootfs changed")
+            return None
+        return meta
+
+    def _lock(self):
+        """尝试获取该快照的 flock，已被其他客户机持有时返回 None"""
+        os.makedirs(self.root, exist_ok=True)
+        lock = open(self.dir + '.lock', 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        return lock
+
+    def invalidate(self, reason):
+        """删除快照；其他客户机正在保存时跳过，由保存方替换整个目录"""
+        lock = self._lock()
+        if lock is None:
+            return
+        with lock:
+            self._discard(reason)
+
+    def _discard(self, reason):
+        if os.path.isdir(self.dir):
+            self.logger.info(f"Discarding QEMU snapshot {self.dir}: {reason}")
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+    def save(self, monitor, qemupid, before=None):
+        """保存正在运行的虚拟机
+
+        monitor(command, args=None) 执行 QMP 命令并返回 return 字段；
+        before 在暂停虚拟机之前调用（例如让客户机 sync）。
+        其他客户机正在保存同一个快照时返回 None；保存失败时删除不完整的快照并抛出异常。
+        """
+        with open(f'/proc/{qemupid}/cmdline', 'rb') as f:
+            argv = [a.decode('utf-8') for a in f.read().split(b'\0') if a]
+        cwd = os.readlink(f'/proc/{qemupid}/cwd')
+
+        # 并行运行的多个客户机可能同时尝试保存同一个快照，只允许一个
+        lock = self._lock()
+        if lock is None:
+            self.logger.info(f"QEMU snapshot {self.dir} is being saved by another guest")
+            return None
+        with lock:
+            try:
+                return self._save(monitor, argv, cwd, before)
+            except (SnapshotError, OSError):
+                self._discard("save failed")
+                raise
+
+    def _save(self, monitor, argv, cwd, before):
+        self._discard("replacing snapshot")
+        os.makedirs(self.dir)
+        state_tmp = self.state + '.tmp'
+        disk_tmp = self.disk + '.tmp'
+
+        if before:
+            before()
+        starttime = time.time()
+        monitor('stop')
+        try:
+            # 先导出磁盘再导出内存状态，两者都在虚拟机暂停期间完成，保证一致
+            monitor('drive-backup', {'job-id': 'vsock-snapshot', 'device': ROOTFS_DRIVE,
+                                     'sync': 'full', 'target': disk_tmp, 'format': 'raw'})
+            wait_block_jobs(monitor)
+            monitor('migrate', {'uri': f'exec:cat > {shlex.quote(state_tmp)}'})
+            wait_migration(monitor)
+        finally:
+            monitor('cont')
+
+        os.replace(disk_tmp, self.disk)
+        os.replace(state_tmp, self.state)
+        # 命令行中根文件系统的写法（可能不是 realpath），恢复时据此替换为 disk.img
+        rootfs_arg = next((r for r in (self.rootfs_arg, self.rootfs)
+                           if r and any(r in a for a in argv)), '')
+        meta = {
+            'machine': self.machine,
+            'rootfs': self.image,
+            'rootfs_arg': rootfs_arg,
+            'argv': argv,
+            'cwd': cwd,
+            'inputs': self._inputs(argv, cwd),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        self._save_memo()
+        with open(self.meta_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+        self.logger.info(f"Saved QEMU snapshot to {self.dir} in {time.time() - starttime:.2f}s")
+        return meta
@@ -0,0 +1,224 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS vsock 命令计时与 Chrome trace 导出
+#
+# OEVsockTarget 为每条命令记录一个 CommandTiming：
+#   connect   建立连接（含重试；会话模式下只有建立会话的那条命令才有）
+#   send      发送请求
+#   wait      请求发出到收到第一个输出字节（客户机执行命令的时间主要在这里）
+#   receive   第一个字节到命令结束
+# 并归属到当时正在运行的 OEQA 测试用例。target.stop() 时导出：
+#   vsock-trace-<cid>.json     Chrome trace-event 格式（chrome://tracing 或 Perfetto 打开）
+#   vsock-summary-<cid>.csv    按测试用例汇总的耗时
+# 分片执行时 vsockshard.py 再把各客户机的文件合并为 vsock-trace.json / vsock-summary.csv。
+
+import os
+import sys
+import csv
+import json
+import time
+import unittest
+import contextvars
+
+# run_many() 等 asyncio 路径无法从调用栈找到测试用例，由调用方预先设置
+CURRENT_TEST = contextvars.ContextVar('starry_vsock_current_test', default=None)
+
+# 不属于任何测试用例的命令（启动、快照等）
+NO_TEST = '(setup)'
+
+# trace 中命令名的最大长度（完整命令在 args 中）
+NAME_LENGTH = 80
+
+SUMMARY_FIELDS = ['test', 'commands', 'failed', 'total_s', 'connect_s', 'connect_retries',
+                  'send_s', 'wait_s', 'receive_s', 'bytes', 'slowest_s', 'slowest_command']
+INT_FIELDS = ('commands', 'failed', 'connect_retries', 'bytes')
+
+
+def current_test():
+    """返回正在运行的测试用例 id：沿调用栈查找 unittest.TestCase 实例"""
+    test = CURRENT_TEST.get()
+    if test:
+        return test
+    frame = sys._getframe(1)
+    while frame is not None:
+        obj = frame.f_locals.get('self')
+        if isinstance(obj, unittest.TestCase):
+            return obj.id()
+        frame = frame.f_back
+    return None
+
+
+class CommandTiming(object):
+    """一条命令的各阶段时间点（相对开始时刻的秒数）"""
+
+    def __init__(self, command, test):
+        self.command = command
+        self.test = test or NO_TEST
+        self.mode = 'oneshot'
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self.connect_retries = 0
+        self.connect_start = self.connect_end = None
+        self.send_start = self.send_end = None
+        self.first_byte = None
+        self.end = None
+        self.bytes = 0
+        self.status = None
+
+    def now(self):
+        return time.perf_counter() - self._t0
+
+    def at(self, perf_time):
+        """把 time.perf_counter() 的时间点换算为相对开始时刻的秒数"""
+        return None if perf_time is None else perf_time - self._t0
+
+    def connecting(self):
+        if self.connect_start is None:
+            self.connect_start = self.now()
+
+    def connected(self, retries):
+        self.connect_retries += retries
+        self.connect_end = self.now()
+
+    def sending(self):
+        self.send_start = self.now()
+
+    def sent(self):
+        self.send_end = self.now()
+
+    def finish(self, status, nbytes, first_data):
+        self.end = self.now()
+        self.status = status
+        self.bytes = nbytes
+        self.first_byte = self.at(first_data)
+
+    def phases(self):
+        """返回 {阶段: (开始, 时长)}，没有发生的阶段不出现"""
+        phases = {}
+        if self.connect_end is not None:
+            phases['connect'] = (self.connect_start, self.connect_end - self.connect_start)
+        if self.send_end is not None:
+            phases['send'] = (self.send_start, self.send_end - self.send_start)
+            if self.first_byte is not None:
+                phases['wait'] = (self.send_end, self.first_byte - self.send_end)
+                phases['receive'] = (self.first_byte, self.end - self.first_byte)
+            else:
+                phases['wait'] = (self.send_end, self.end - self.send_end)
+        return phases
+
+
+class CommandTrace(object):
+    """一个 target 的全部命令计时"""
+
+    def __init__(self, label):
+        self.label = label
+        self.timings = []
+
+    def begin(self, command):
+        return CommandTiming(command, current_test())
+
+    def add(self, timing):
+        self.timings.append(timing)
+
+    def trace_events(self, pid):
+        """转换为 Chrome trace 事件（X 完整事件，时间单位微秒）"""
+        events = [{'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0,
+                   'args': {'name': self.label}}]
+        threads = {}
+        for timing in self.timings:
+            if timing.test not in threads:
+                threads[timing.test] = len(threads) + 1
+                events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                               'tid': threads[timing.test], 'args': {'name': timing.test}})
+            tid = threads[timing.test]
+            ts = timing.start * 1e6
+            events.append({
+                'ph': 'X', 'cat': 'command', 'name': timing.command[:NAME_LENGTH],
+                'pid': pid, 'tid': tid, 'ts': round(ts, 1),
+                'dur': round((timing.end or 0.0) * 1e6, 1),
+                'args': {'command': timing.command, 'status': timing.status,
+                         'bytes': timing.bytes, 'mode': timing.mode,
+                         'connect_retries': timing.connect_retries},
+            })
+            for phase, (begin, duration) in timing.phases().items():
+                events.append({'ph': 'X', 'cat': phase, 'name': phase, 'pid': pid, 'tid': tid,
+                               'ts': round(ts + begin * 1e6, 1),
+                               'dur': round(max(duration, 0.0) * 1e6, 1)})
+        return events
+
+    def summary(self):
+        """按测试用例汇总，返回 SUMMARY_FIELDS 的行（按总耗时降序）"""
+        rows = {}
+        for t in self.timings:
+            row = rows.setdefault(t.test, {'test': t.test, 'commands': 0, 'failed': 0,
+                                           'total_s': 0.0, 'connect_s': 0.0, 'connect_retries': 0,
+                                           'send_s': 0.0, 'wait_s': 0.0, 'receive_s': 0.0,
+                                           'bytes': 0, 'slowest_s': 0.0, 'slowest_command': ''})
+            phases = t.phases()
+            total = t.end or 0.0
+            row['commands'] += 1
+            row['failed'] += 1 if t.status != 0 else 0
+            row['total_s'] += total
+            row['connect_retries'] += t.connect_retries
+            row['bytes'] += t.bytes
+            for phase in ('connect', 'send', 'wait', 'receive'):
+                row[f'{phase}_s'] += phases.get(phase, (0, 0.0))[1]
+            if total > row['slowest_s']:
+                row['slowest_s'] = total
+                row['slowest_command'] = t.command[:NAME_LENGTH]
+        return sorted(rows.values(), key=lambda r: -r['total_s'])
+
+    def export(self, directory, pid):
+        """写出 trace 与汇总文件，返回 (trace_path, summary_path)"""
+        os.makedirs(directory, exist_ok=True)
+        trace_path = os.path.join(directory, f'vsock-trace-{pid}.json')
+        summary_path = os.path.join(directory, f'vsock-summary-{pid}.csv')
+        write_trace(trace_path, self.trace_events(pid))
+        write_summary(summary_path, self.summary())
+        return trace_path, summary_path
+
+
+def write_trace(path, events):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def write_summary(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: round(v, 6) if isinstance(v, float) else v
+                             for k, v in row.items()})
+
+
+def merge_exports(exports, directory):
+    """合并多个客户机导出的文件为 vsock-trace.json 与 vsock-summary.csv
+
+    exports 为 CommandTrace.export() 的返回值列表；汇总按测试用例合并后重新排序。
+    """
+    events = []
+    rows = {}
+    for trace_path, summary_path in exports:
+        with open(trace_path) as f:
+            events += json.load(f)['traceEvents']
+        with open(summary_path, newline='') as f:
+            for row in csv.DictReader(f):
+                for field in SUMMARY_FIELDS[1:-1]:
+                    row[field] = (int if field in INT_FIELDS else float)(row[field])
+                merged = rows.get(row['test'])
+                if merged is None:
+                    rows[row['test']] = row
+                    continue
+                for field in SUMMARY_FIELDS[1:-2]:
+                    merged[field] += row[field]
+                if row['slowest_s'] > merged['slowest_s']:
+                    merged['slowest_s'] = row['slowest_s']
+                    merged['slowest_command'] = row['slowest_command']
+
+    trace_path = os.path.join(directory, 'vsock-trace.json')
+    summary_path = os.path.join(directory, 'vsock-summary.csv')
+    write_trace(trace_path, events)
+    write_summary(summary_path, sorted(rows.values(), key=lambda r: -r['total_s']))
+    return trace_path, summary_path
@@ -0,0 +1,302 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS vsock 文件传输（copyTo/copyFrom 的实现）
+
+import os
+import stat
+import zlib
+import struct
+from collections import deque
+
+# ==================== 传输协议 ====================
+# 与 vsock-server.c 的文件传输模式保持一致（见该文件头部的协议说明）
+XFER_HELLO = b'@xfer 1\n'
+XFER_ACK = b'XFER OK 1\n'
+
+# 分块大小，需与 vsock-server.c 的 XFER_CHUNK 一致（压缩分块不能超过该值）
+XFER_CHUNK = 256 * 1024
+CHUNK_LEN = struct.Struct('!I')
+
+# 小于该大小的文件不压缩，压缩收益抵不上开销
+COMPRESS_MIN_SIZE = 64 * 1024
+
+# 递归上传时最多允许多少个 PUT 的应答未读取（流水线）
+PUT_WINDOW = 32
+
+
+class VsockTransferError(Exception):
+    """文件传输失败"""
+
+
+class VsockTransferUnsupported(VsockTransferError):
+    """服务端不支持文件传输（旧版 vsock-server）"""
+
+
+def file_crc32(path):
+    """计算文件内容的 CRC32"""
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                return crc
+            crc = zlib.crc32(data, crc)
+
+
+class VsockTransfer(object):
+    """基于一条 vsock 连接的批量文件传输
+
+    - 上传：未压缩时用 socket.sendfile 零拷贝发送文件内容
+    - 可选 zlib 压缩（compress=True），按分块边压缩边发送
+    - 以未压缩内容的 CRC32 做端到端校验；上传时由服务端在 rename 前校验
+    - 支持目录递归传输
+    """
+
+    def __init__(self, sock, logger, compress=False, level=1):
+        self.sock = sock
+        self.logger = logger
+        self.compress = compress
+        self.level = level
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._buf = bytearray()
+        self._outstanding = deque()
+
+    @classmethod
+    def open(cls, sock, logger, timeout, compress=False):
+        """在已连接的 socket 上完成握手"""
+        sock.settimeout(timeout)
+        sock.sendall(XFER_HELLO)
+        xfer = cls(sock, logger, compress)
+        ack = xfer._read_line()
+        if ack + '\n' != XFER_ACK.decode():
+            raise VsockTransferUnsupported(
+                "vsock-server does not support file transfer: %r" % ack[:64])
+        return xfer
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    # ==================== 底层读写 ====================
+
+    def _fill(self, size=XFER_CHUNK):
+        data = self.sock.recv(size)
+        if not data:
+            raise VsockTransferError("connection closed by vsock-server")
+        self._buf += data
+
+    def _read_line(self):
+        while True:
+            idx = self._buf.find(b'\n')
+            if idx >= 0:
+                line = bytes(self._buf[:idx])
+                del self._buf[:idx + 1]
+                return line.decode('utf-8', errors='replace')
+            self._fill(4096)
+
+    def _read_exact(self, size):
+        while len(self._buf) < size:
+            self._fill(max(size - len(self._buf), 4096))
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def _read_into(self, view):
+        """读取数据填满 view（优先消费缓冲区，之后直接 recv_into）"""
+        got = min(len(self._buf), len(view))
+        if got:
+            view[:got] = self._buf[:got]
+            del self._buf[:got]
+        while got < len(view):
+            n = self.sock.recv_into(view[got:])
+            if not n:
+                raise VsockTransferError("connection closed by vsock-server")
+            got += n
+        return got
+
+    def _request(self, line):
+        self.sock.sendall(line.encode('utf-8') + b'\n')
+
+    # ==================== 远端查询 ====================
+
+    def stat(self, path):
+        """返回 ('F', mode, size) / ('D', mode, 0)；路径不存在返回 None"""
+        self._request(f"STAT {path}")
+        reply = self._read_line()
+        if reply.startswith('ERR'):
+            return None
+        fields = reply.split()
+        size = int(fields[2]) if fields[0] == 'F' else 0
+        return (fields[0], int(fields[1], 8), size)
+
+    def list(self, path):
+        """递归列出远端目录，返回 [(kind, mode, size, relpath)]"""
+        self._request(f"LIST {path}")
+        entries = []
+        while True:
+            reply = self._read_line()
+            if reply == 'END':
+                return entries
+            if reply.startswith('ERR'):
+                raise VsockTransferError(f"LIST {path}: {reply[4:]}")
+            if reply.startswith('D '):
+                _, mode, rel = reply.split(' ', 2)
+                entries.append(('D', int(mode, 8), 0, rel))
+            else:
+                _, mode, size, rel = reply.split(' ', 3)
+                entries.append(('F', int(mode, 8), int(size), rel))
+
+    def mkdir(self, path, mode=0o755):
+        self.wait_puts()
+        self._request(f"MKDIR {mode:o} {path}")
+        reply = self._read_line()
+        if reply != 'OK':
+            raise VsockTransferError(f"MKDIR {path}: {reply[4:]}")
+
+    # ==================== 上传 ====================
+
+    def _send_compressed(self, data):
+        view = memoryview(data)
+        for off in range(0, len(view), XFER_CHUNK):
+            piece = view[off:off + XFER_CHUNK]
+            self.sock.sendall(CHUNK_LEN.pack(len(piece)))
+            self.sock.sendall(piece)
+            self.bytes_sent += len(piece)
+
+    def put_file(self, local, remote, wait=True):
+        """上传单个文件；wait=False 时应答稍后由 wait_puts() 统一检查"""
+        st = os.stat(local)
+        size = st.st_size
+        crc = file_crc32(local)
+        compress = self.compress and size >= COMPRESS_MIN_SIZE
+        self._request(f"PUT {stat.S_IMODE(st.st_mode):o} {size} {crc:08x} "
+                      f"{'z' if compress else '-'} {remote}")
+
+        with open(local, 'rb') as f:
+            if compress:
+                comp = zlib.compressobj(self.level)
+                while True:
+                    data = f.read(XFER_CHUNK)
+                    if not data:
+                        break
+                    self._send_compressed(comp.compress(data))
+                self._send_compressed(comp.flush())
+                self.sock.sendall(CHUNK_LEN.pack(0))
+            elif size:
+                self.bytes_sent += self.sock.sendfile(f, 0, size)
+
+        self._outstanding.append((remote, crc))
+        if wait or len(self._outstanding) >= PUT_WINDOW:
+            self._check_put()
+
+    def _check_put(self):
+        remote, crc = self._outstanding.popleft()
+        reply = self._read_line()
+        if not reply.startswith('OK '):
+            raise VsockTransferError(f"PUT {remote}: {reply[4:] or reply}")
+        if int(reply[3:], 16) != crc:
+            raise VsockTransferError(f"PUT {remote}: checksum mismatch")
+
+    def wait_puts(self):
+        while self._outstanding:
+            self._check_put()
+
+    def put_tree(self, local, remote):
+        """递归上传目录，remote 为目标目录路径
+
+        先创建全部目录，再以流水线方式上传文件（符号链接不跟随）。
+        """
+        dirs = [(local, remote)]
+        files = []
+        for root, subdirs, names in os.walk(local):
+            rel = os.path.relpath(root, local)
+            rroot = remote if rel == '.' else f"{remote}/{rel}"
+            subdirs[:] = sorted(d for d in subdirs if not os.path.islink(os.path.join(root, d)))
+            dirs.extend((os.path.join(root, d), f"{rroot}/{d}") for d in subdirs)
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    files.append((path, f"{rroot}/{name}"))
+
+        for path, rpath in dirs:
+            self.mkdir(rpath, stat.S_IMODE(os.stat(path).st_mode))
+        for path, rpath in files:
+            self.put_file(path, rpath, wait=False)
+        self.wait_puts()
+        return len(files)
+
+    # ==================== 下载 ====================
+
+    def get_file(self, remote, local, size=None):
+        """下载单个文件，先写入临时文件，校验通过后再 rename
+
+        size 为已知的远端文件大小，用于决定小文件不压缩。
+        """
+        compress = self.compress and (size is None or size >= COMPRESS_MIN_SIZE)
+        self._request(f"GET {'z' if compress else '-'} {remote}")
+        reply = self._read_line()
+        if not reply.startswith('FILE '):
+            raise VsockTransferError(f"GET {remote}: {reply[4:] or reply}")
+        _, mode, size, enc = reply.split()
+        size = int(size)
+
+        tmp = local + '.xfer-tmp'
+        crc = 0
+        try:
+            with open(tmp, 'wb') as f:
+                if enc == 'z':
+                    decomp = zlib.decompressobj()
+                    while True:
+                        length = CHUNK_LEN.unpack(self._read_exact(CHUNK_LEN.size))[0]
+                        if length == 0:
+                            break
+                        data = decomp.decompress(self._read_exact(length))
+                        self.bytes_received += length
+                        crc = zlib.crc32(data, crc)
+                        f.write(data)
+                    data = decomp.flush()
+                    crc = zlib.crc32(data, crc)
+                    f.write(data)
+                else:
+                    buf = bytearray(min(size, XFER_CHUNK) or 1)
+                    view = memoryview(buf)
+                    remaining = size
+                    while remaining:
+                        n = self._read_into(view[:min(remaining, len(buf))])
+                        crc = zlib.crc32(view[:n], crc)
+                        f.write(view[:n])
+                        remaining -= n
+                        self.bytes_received += n
+
+            reply = self._read_line()
+            if not reply.startswith('END '):
+                raise VsockTransferError(f"GET {remote}: {reply[4:] or reply}")
+            if int(reply[4:], 16) != crc:
+                raise VsockTransferError(f"GET {remote}: checksum mismatch")
+            os.chmod(tmp, int(mode, 8))
+            os.replace(tmp, local)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def get_tree(self, remote, local):
+        """递归下载目录，local 为目标目录路径"""
+        os.makedirs(local, exist_ok=True)
+        count = 0
+        dir_modes = []
+        for kind, mode, size, rel in self.list(remote):
+            path = os.path.join(local, rel)
+            if kind == 'D':
+                os.makedirs(path, exist_ok=True)
+                dir_modes.append((path, mode))
+            else:
+                self.get_file(f"{remote.rstrip('/')}/{rel}", path, size)
+                count += 1
+        # 目录权限最后设置，避免只读目录导致其中的文件无法写入
+        for path, mode in reversed(dir_modes):
+            os.chmod(path, mode)
+        return count
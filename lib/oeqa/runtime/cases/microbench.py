@@ -0,0 +1,150 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS Kernel Microbenchmarks
+
+from oeqa.runtime.case import OERuntimeTestCase
+from oeqa.runtime.decorator.package import OEHasPackage
+from starryperf import (PerfStore, build_info, perf_dir, td_bool, td_float,
+                        summarize, compare_intervals)
+
+# 样本数不少于此值时才比较 p99
+P99_MIN_SAMPLES = 100
+
+
+def parse_microbench(output):
+    """解析 starry-microbench 的输出，返回 {name: {'unit', 'higher', 'iters', 'samples', 'error'}}"""
+    benches = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 5 and fields[0] == 'BENCH':
+            benches[fields[1]] = {'unit': fields[2], 'higher': fields[3] == 'higher',
+                                  'iters': int(fields[4]), 'samples': [], 'error': None}
+        elif len(fields) == 3 and fields[0] == 'SAMPLE' and fields[1] in benches:
+            try:
+                benches[fields[1]]['samples'].append(float(fields[2]))
+            except ValueError:
+                pass
+        elif len(fields) >= 2 and fields[0] == 'ERROR':
+            bench = benches.setdefault(fields[1], {'unit': '', 'higher': False, 'iters': 0,
+                                                   'samples': []})
+            bench['error'] = ' '.join(fields[2:])
+    return benches
+
+
+class MicroBenchTest(OERuntimeTestCase):
+    """StarryOS 内核热路径微基准
+
+    每项基准由 starry-microbench 在目标机上预热 MICROBENCH_WARMUP 次、
+    测量 MICROBENCH_REPETITIONS 次，宿主机计算中位数、p99 及置信区间
+    （MICROBENCH_CONFIDENCE），连同原始样本追加到 STARRY_PERF_DIR/microbench.jsonl。
+    与基线（microbench-baseline.json）的中位数置信区间不重叠且变差时判定为回归；
+    区间重叠视为噪声。STARRY_PERF_UPDATE_BASELINE = "1" 时以本次结果更新基线。
+    """
+
+    _build = None
+
+    def _run_bench(self, name, extra=''):
+        """运行一项基准，返回统计摘要"""
+        warmup = int(self.td.get('MICROBENCH_WARMUP') or 3)
+        reps = int(self.td.get('MICROBENCH_REPETITIONS') or 30)
+        confidence = td_float(self.td, 'MICROBENCH_CONFIDENCE', 0.95)
+
+        self.logger.info(f"=== Microbenchmark: {name} ({warmup} warmup, {reps} repetitions) ===")
+        status, output = self.target.run(
+            f'starry-microbench -w {warmup} -n {reps} {extra} {name} 2>&1',
+            timeout=60 + 10 * (warmup + reps)
+        )
+        self.logger.debug(f"{name} output:\n{output}")
+
+        if status == 254 or 'Connection lost' in output:
+            self.fail(f"StarryOS crashed during {name} microbenchmark!\n{output}")
+        elif status == 255 and 'Failed to connect' in output:
+            self.skipTest("StarryOS already crashed (cannot connect)")
+
+        bench = parse_microbench(output).get(name)
+        if bench is None:
+            self.fail(f"{name} microbenchmark produced no results (status={status}):\n{output}")
+        if bench['error']:
+            self.skipTest(f"{name} not supported on StarryOS: {bench['error']}")
+        if len(bench['samples']) < reps:
+            self.fail(f"{name}: only {len(bench['samples'])} of {reps} samples (status={status})")
+
+        stats = summarize(bench['samples'], confidence)
+        self.logger.info(
+            f"{name}: median {stats['median']:.3f} {bench['unit']} "
+            f"[{stats['median_ci'][0]:.3f}, {stats['median_ci'][1]:.3f}], "
+            f"p99 {stats['p99']:.3f} [{stats['p99_ci'][0]:.3f}, {stats['p99_ci'][1]:.3f}] "
+            f"({confidence:.0%} CI, n={stats['n']})")
+        self._record(name, bench, stats)
+        return stats
+
+    def _record(self, name, bench, stats):
+        """保存结果，与基线的置信区间比较"""
+        if MicroBenchTest._build is None:
+            MicroBenchTest._build = build_info(self.target, self.td)
+        build = MicroBenchTest._build
+        store = PerfStore(perf_dir(self.td), 'microbench')
+        store.append(dict(build, bench=name, unit=bench['unit'], iters=bench['iters'],
+                          higher_is_better=bench['higher'], samples=bench['samples'],
+                          stats=stats))
+
+        key = f"{build['machine']}/smp{build['smp']}/{name}"
+        baseline = store.baseline(key)
+        if baseline is None or td_bool(self.td, 'STARRY_PERF_UPDATE_BASELINE'):
+            store.set_baseline(key, build['build_id'], stats)
+            self.logger.info(f"{key}: baseline recorded")
+            return
+
+        base = baseline['metrics']
+        verdict = compare_intervals(stats['median_ci'], base['median_ci'], bench['higher'])
+        message = (f"{key} median {stats['median']:.3f} {bench['unit']} "
+                   f"[{stats['median_ci'][0]:.3f}, {stats['median_ci'][1]:.3f}] vs baseline "
+                   f"{base['median']:.3f} [{base['median_ci'][0]:.3f}, {base['median_ci'][1]:.3f}] "
+                   f"({baseline['build_id']})")
+        # p99 的置信区间需要足够多的样本才有意义，且只对延迟类指标比较尾部
+        if (not bench['higher'] and min(stats['n'], base['n']) >= P99_MIN_SAMPLES
+                and compare_intervals(stats['p99_ci'], base['p99_ci']) == 'regression'):
+            self.logger.warning(f"{key}: p99 tail regressed: {stats['p99']:.3f} vs {base['p99']:.3f}")
+        if verdict == 'regression':
+            self.fail(f"Microbenchmark regression: {message}")
+        elif verdict == 'improvement':
+            self.logger.info(f"Improved: {message}")
+        else:
+            self.logger.info(f"No significant change: {message}")
+
+    @OEHasPackage(['starry-microbench'])
+    def test_microbench_syscall(self):
+        """系统调用往返（getppid）"""
+        self._run_bench('syscall')
+
+    @OEHasPackage(['starry-microbench'])
+    def test_microbench_fork_exec(self):
+        """fork + exec + wait"""
+        self._run_bench('fork')
+
+    @OEHasPackage(['starry-microbench'])
+    def test_microbench_pipe(self):
+        """pipe 吞吐"""
+        self._run_bench('pipe')
+
+    @OEHasPackage(['starry-microbench'])
+    def test_microbench_unix_socket(self):
+        """AF_UNIX 流套接字吞吐"""
+        self._run_bench('unix')
+
+    @OEHasPackage(['starry-microbench'])
+    def test_microbench_context_switch(self):
+        """上下文切换延迟（两进程经 pipe 乒乓）"""
+        self._run_bench('ctxsw')
+
+    @OEHasPackage(['starry-microbench'])
+    def test_microbench_page_fault(self):
+        """匿名页缺页开销"""
+        self._run_bench('pagefault')
+
+    @OEHasPackage(['starry-microbench'])
+    def test_microbench_ext4_create_unlink(self):
+        """ext4 上的文件创建与删除"""
+        directory = self.td.get('MICROBENCH_EXT4_DIR') or '/root/.microbench'
+        self._run_bench('create', f'-d {directory}')
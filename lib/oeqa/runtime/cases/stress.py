@@ -5,6 +5,51 @@
 
 from oeqa.runtime.case import OERuntimeTestCase
 from oeqa.runtime.decorator.package import OEHasPackage
+from starryperf import (PerfStore, build_info, perf_dir, td_bool, td_float,
+                        change_percent, classify)
+
+# 参与回归判定的吞吐指标（越高越好）
+GATED_METRICS = ('bogo-ops-per-second-real-time', 'bogo-ops-per-second-usr-sys-time')
+
+# 随记录保存的 stress-ng 指标
+RECORDED_METRICS = GATED_METRICS + ('bogo-ops', 'wall-clock-time', 'user-time', 'system-time')
+
+
+def parse_stress_ng_yaml(text):
+    """解析 stress-ng --yaml 输出中的 metrics 段，返回 {stressor: {指标: 数值}}
+
+    只依赖 stress-ng 固定的输出格式（metrics 下的 "- stressor: name" 列表），
+    目标机与宿主机都不需要 YAML 模块。
+    """
+    metrics = {}
+    current = None
+    in_metrics = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped in ('---', '...'):
+            continue
+        if not line[0].isspace():
+            in_metrics = stripped == 'metrics:'
+            current = None
+            continue
+        if not in_metrics:
+            continue
+        if stripped.startswith('- '):
+            stripped = stripped[2:].strip()
+            current = None
+        key, sep, value = stripped.partition(':')
+        if not sep:
+            continue
+        key, value = key.strip(), value.strip()
+        if key == 'stressor':
+            current = metrics.setdefault(value, {})
+        elif current is not None:
+            try:
+                current[key] = float(value)
+            except ValueError:
+                pass
+    return metrics
+
 
 class StressTest(OERuntimeTestCase):
     """StarryOS 压力测试套件
@@ -14,8 +59,74 @@ class StressTest(OERuntimeTestCase):
     - 内存压力测试
     - IO 压力测试
     - 上下文切换压力测试
+
+    每个用例通过 --yaml 收集 bogo ops、bogo ops/s（real 与 usr+sys）及耗时，
+    按内核构建（Build ID）保存到 STARRY_PERF_DIR/stress-ng.jsonl，
+    并与基线（stress-ng-baseline.json）比较吞吐：
+    - STARRY_STRESS_WARN_THRESHOLD: 下降超过该百分比时告警（默认 10）
+    - STARRY_STRESS_FAIL_THRESHOLD: 下降超过该百分比时失败（默认 25，0 表示只告警）
+    - STARRY_PERF_UPDATE_BASELINE = "1": 以本次结果更新基线
+    没有基线时以首次结果作为基线。
     """
-    
+
+    _build = None
+
+    def _stress_ng(self, name, args, timeout=30):
+        """运行 stress-ng，YAML 指标写入目标机上的 /tmp/stress-ng-<name>.yaml"""
+        yaml_file = f'/tmp/stress-ng-{name}.yaml'
+        return self.target.run(
+            f'rm -f {yaml_file}; stress-ng {args} --metrics --yaml {yaml_file} 2>&1 | head -100',
+            timeout=timeout
+        )
+
+    def _check_metrics(self, name):
+        """收集并保存 name 用例的指标，吞吐相对基线下降超过阈值时告警或失败"""
+        status, output = self.target.run(f'cat /tmp/stress-ng-{name}.yaml', timeout=10)
+        metrics = parse_stress_ng_yaml(output) if status == 0 else {}
+        if not metrics:
+            self.logger.warning(f"No stress-ng metrics for {name}, skipping regression check")
+            return
+
+        if StressTest._build is None:
+            StressTest._build = build_info(self.target, self.td)
+        build = StressTest._build
+        store = PerfStore(perf_dir(self.td), 'stress-ng')
+        warn_pct = td_float(self.td, 'STARRY_STRESS_WARN_THRESHOLD', 10)
+        fail_pct = td_float(self.td, 'STARRY_STRESS_FAIL_THRESHOLD', 25)
+        update = td_bool(self.td, 'STARRY_PERF_UPDATE_BASELINE')
+
+        failures = []
+        for stressor, values in sorted(metrics.items()):
+            values = {k: values[k] for k in RECORDED_METRICS if k in values}
+            store.append(dict(build, test=name, stressor=stressor, metrics=values))
+
+            key = f"{build['machine']}/smp{build['smp']}/{name}/{stressor}"
+            baseline = store.baseline(key)
+            if baseline is None or update:
+                store.set_baseline(key, build['build_id'], values)
+                self.logger.info(f"{key}: baseline recorded "
+                                 f"({values.get(GATED_METRICS[0], 0):.2f} bogo ops/s)")
+                continue
+
+            for metric in GATED_METRICS:
+                base = baseline['metrics'].get(metric)
+                change = change_percent(values.get(metric), base)
+                if change is None:
+                    continue
+                verdict = classify(change, warn_pct, fail_pct)
+                message = (f"{key} {metric}: {values[metric]:.2f} vs {base:.2f} "
+                           f"(baseline {baseline['build_id']}, {change:+.1f}%)")
+                if verdict == 'fail':
+                    failures.append(message)
+                elif verdict == 'warn':
+                    self.logger.warning(f"Throughput regression: {message}")
+                else:
+                    self.logger.info(message)
+
+        if failures:
+            self.fail(f"stress-ng throughput regressed more than {fail_pct:g}%:\n"
+                      + "\n".join(failures))
+
     @OEHasPackage(['stress-ng'])
     def test_starry_stress_ng_quick(self):
         """运行 stress-ng 快速压力测试
@@ -31,10 +142,7 @@ class StressTest(OERuntimeTestCase):
         
         # 运行 CPU 压力测试（4核心，10秒）
         self.logger.info("Running stress-ng CPU test...")
-        status, output = self.target.run(
-            'stress-ng --cpu 4 --timeout 10s --metrics-brief 2>&1 | head -100',
-            timeout=30
-        )
+        status, output = self._stress_ng('quick', '--cpu 4 --timeout 10s')
         
         self.logger.info(f"stress-ng output:\n{output}")
         
@@ -45,6 +153,7 @@ class StressTest(OERuntimeTestCase):
         # 测试成功
         elif 'stress-ng' in output or 'cpu' in output.lower() or status == 0:
             self.logger.info("stress-ng quick test PASSED")
+            self._check_metrics('quick')
         else:
             self.logger.warning(f"stress-ng output unexpected: status={status}, output={output[:200]}")
     
@@ -55,10 +164,7 @@ class StressTest(OERuntimeTestCase):
         测试 StarryOS 在 CPU 高负载下的稳定性。
         """
         self.logger.info("=== CPU 压力测试 ===")
-        status, output = self.target.run(
-            'stress-ng --cpu 2 --cpu-method all --timeout 5s --metrics-brief 2>&1',
-            timeout=30
-        )
+        status, output = self._stress_ng('cpu', '--cpu 2 --cpu-method all --timeout 5s')
         self.logger.info(f"CPU stress output:\n{output}")
         
         # 检查 vsock 连接失败（StarryOS 崩溃）
@@ -68,6 +174,7 @@ class StressTest(OERuntimeTestCase):
         # 检查是否执行成功
         if status == 0 or 'stress-ng' in output:
             self.logger.info("CPU stress test PASSED")
+            self._check_metrics('cpu')
         else:
             self.fail(f"CPU stress test failed: status={status}, output={output}")
     
@@ -80,10 +187,7 @@ class StressTest(OERuntimeTestCase):
         """
         self.logger.info("=== 内存压力测试 ===")
         # 使用较小的内存（16M）和较短时间（3s），避免 StarryOS OOM
-        status, output = self.target.run(
-            'stress-ng --vm 1 --vm-bytes 16M --vm-keep --timeout 3s --metrics-brief 2>&1',
-            timeout=30
-        )
+        status, output = self._stress_ng('memory', '--vm 1 --vm-bytes 16M --vm-keep --timeout 3s')
         self.logger.info(f"Memory stress output:\n{output}")
         
         if status == 254 or 'Connection lost' in output:
@@ -92,6 +196,7 @@ class StressTest(OERuntimeTestCase):
             self.skipTest("StarryOS already crashed (cannot connect)")
         elif status == 0 or 'stress-ng' in output:
             self.logger.info("Memory stress test PASSED")
+            self._check_metrics('memory')
         else:
             self.logger.warning(f"Memory stress test issue: status={status}")
             self.skipTest("Memory stress test not fully supported on StarryOS")
@@ -104,10 +209,7 @@ class StressTest(OERuntimeTestCase):
         """
         self.logger.info("=== IO 压力测试 ===")
         # 使用简单的 IO 测试
-        status, output = self.target.run(
-            'stress-ng --iomix 1 --timeout 3s --metrics-brief 2>&1',
-            timeout=30
-        )
+        status, output = self._stress_ng('io', '--iomix 1 --timeout 3s')
         self.logger.info(f"IO stress output:\n{output}")
         
         if status == 254 or 'Connection lost' in output:
@@ -117,6 +219,7 @@ class StressTest(OERuntimeTestCase):
         # 测试成功
         elif status == 0 or 'stress-ng' in output:
             self.logger.info("IO stress test PASSED")
+            self._check_metrics('io')
         else:
             self.logger.warning(f"IO stress test issue: status={status}")
             self.skipTest("IO stress test not fully supported on StarryOS")
@@ -128,10 +231,7 @@ class StressTest(OERuntimeTestCase):
         测试 StarryOS 的浮点运算性能。
         """
         self.logger.info("=== 矩阵运算压力测试 ===")
-        status, output = self.target.run(
-            'stress-ng --matrix 1 --timeout 3s --metrics-brief 2>&1',
-            timeout=30
-        )
+        status, output = self._stress_ng('matrix', '--matrix 1 --timeout 3s')
         self.logger.info(f"Matrix stress output:\n{output}")
         
         if status == 254 or 'Connection lost' in output:
@@ -140,6 +240,7 @@ class StressTest(OERuntimeTestCase):
             self.skipTest("StarryOS already crashed (cannot connect)")
         elif status == 0 or 'stress-ng' in output:
             self.logger.info("Matrix stress test PASSED")
+            self._check_metrics('matrix')
         else:
             self.skipTest("Matrix stress test not supported")
     
@@ -158,10 +259,7 @@ class StressTest(OERuntimeTestCase):
             self.skipTest("vsock connection unavailable")
         
         # 使用更温和的参数：1个实例，2秒超时
-        status, output = self.target.run(
-            'stress-ng --switch 1 --timeout 2s --metrics-brief 2>&1',
-            timeout=30
-        )
+        status, output = self._stress_ng('context_switch', '--switch 1 --timeout 2s')
         self.logger.info(f"Context switch stress output:\n{output}")
         
         if status == 254 or 'Connection lost' in output:
@@ -170,6 +268,7 @@ class StressTest(OERuntimeTestCase):
             self.skipTest("StarryOS already crashed (cannot connect)")
         elif status == 0 or 'stress-ng' in output:
             self.logger.info("Context switch stress test PASSED")
+            self._check_metrics('context_switch')
         else:
             self.skipTest("Context switch stress test not supported")
 
@@ -0,0 +1,62 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS vsock Transport Benchmark
+
+import os
+import json
+
+from oeqa.runtime.case import OERuntimeTestCase
+from oeqa.controllers.vsockbench import (VsockBenchmark, VsockBenchmarkError, DEFAULT_SIZES,
+                                         format_report)
+from starryperf import PerfStore, build_info, perf_dir
+
+
+class VsockTransportTest(OERuntimeTestCase):
+    """OEQA 与客户机之间 vsock 命令通道的基准测试
+
+    测量空命令往返延迟、连接耗时与 1 KB - 100 MB 输出的吞吐，
+    用于区分测试耗时中传输与负载各占多少，并跟踪 virtio-vsock 驱动的性能：
+    - VSOCK_BENCH_ROUNDTRIPS: 每种模式的空命令次数（默认 200）
+    - VSOCK_BENCH_CONNECTS:   连接次数（默认 50）
+    - VSOCK_BENCH_SIZES:      吞吐测试的负载大小（默认 1K 64K 1M 10M 100M）
+    - VSOCK_BENCH_REPEATS:    每个负载的重复次数（默认 3）
+    结果按内核构建追加到 STARRY_PERF_DIR/vsock-transport.jsonl，
+    报告写入日志与 STARRY_PERF_DIR/vsock-transport-report.txt。
+    """
+
+    def test_vsock_transport(self):
+        if not hasattr(self.target, 'run_stream'):
+            self.skipTest("Target is not a vsock target")
+
+        status, output = self.target.run('true', timeout=10)
+        if status == 255 and 'Failed to connect' in output:
+            self.skipTest("StarryOS already crashed (cannot connect)")
+
+        bench = VsockBenchmark(self.target, self.logger)
+        try:
+            results = bench.run(
+                roundtrips=int(self.td.get('VSOCK_BENCH_ROUNDTRIPS') or 200),
+                connects=int(self.td.get('VSOCK_BENCH_CONNECTS') or 50),
+                sizes=(self.td.get('VSOCK_BENCH_SIZES') or ' '.join(DEFAULT_SIZES)).split(),
+                repeats=int(self.td.get('VSOCK_BENCH_REPEATS') or 3))
+        except VsockBenchmarkError as e:
+            self.fail(f"vsock transport benchmark failed: {e}")
+
+        build = build_info(self.target, self.td)
+        directory = perf_dir(self.td)
+        store = PerfStore(directory, 'vsock-transport')
+        history = store.records(machine=build['machine'], smp=build['smp'])
+        previous = history[-1]['results'] if history else None
+        store.append(dict(build, results=results))
+
+        title = (f"vsock transport: {build['machine']} smp{build['smp']}, "
+                 f"kernel {build['kernel_commit']} (build {build['build_id']})")
+        if history:
+            title += f", vs previous {history[-1]['kernel_commit']}"
+        report = '\n'.join(format_report(results, previous, title))
+        self.logger.info(report)
+        with open(os.path.join(directory, 'vsock-transport-report.txt'), 'w') as f:
+            f.write(report + '\n')
+        with open(os.path.join(directory, 'vsock-transport-latest.json'), 'w') as f:
+            json.dump(dict(build, results=results), f, indent=2, sort_keys=True)
@@ -3,44 +3,194 @@
 #
 # StarryOS UnixBench Benchmark Test
 
+import os
+import re
+
 from oeqa.runtime.case import OERuntimeTestCase
 from oeqa.runtime.decorator.package import OEHasPackage
+from starryperf import PerfStore, build_info, perf_dir, change_percent
+
+# ==================== 结果解析 ====================
+# ./Run 每个并行份数输出一段报告：
+#   Benchmark Run: ...
+#   4 CPUs in system; running 4 parallel copies of tests
+#   Execl Throughput                               1234.5 lps   (29.9 s, 2 samples)
+#   ...
+#   System Benchmarks Index Values               BASELINE       RESULT    INDEX
+#   Execl Throughput                                 43.0     1234.5    287.1
+#                                                                      ========
+#   System Benchmarks Index Score                                         287.1
+# 只运行部分测试时标题为 "System Benchmarks Partial Index"，
+# 总分为 "System Benchmarks Index Score (Partial Only)"
+
+PASS_RE = re.compile(r'running (\d+) parallel cop(?:y|ies) of tests')
+RAW_RE = re.compile(r'^(\S.*?)\s{2,}([\d.]+) (\S+)\s+\(([\d.]+) s, (\d+) samples?\)\s*$')
+INDEX_HEADER_RE = re.compile(r'^System Benchmarks (?:Index Values|Partial Index)\s')
+INDEX_RE = re.compile(r'^(\S.*?)\s{2,}([\d.]+)\s+([\d.]+)\s+([\d.]+)\s*$')
+SCORE_RE = re.compile(r'^System Benchmarks Index Score.*?([\d.]+)\s*$')
+
+
+def parse_unixbench(output):
+    """解析 ./Run 的输出，返回每个并行份数一项的列表
+
+    [{'copies': n, 'score': x 或 None,
+      'tests': {名称: {'result', 'unit', 'time', 'samples', 'baseline', 'index'}}}]
+    不计入指数的测试只有原始结果，没有 baseline 与 index。
+    """
+    passes = []
+    current = None
+    in_index = False
+    for line in output.splitlines():
+        line = line.rstrip()
+        m = PASS_RE.search(line)
+        if m:
+            current = {'copies': int(m.group(1)), 'score': None, 'tests': {}}
+            passes.append(current)
+            in_index = False
+            continue
+        if current is None:
+            continue
+        if INDEX_HEADER_RE.match(line):
+            in_index = True
+            continue
+        m = SCORE_RE.match(line)
+        if m:
+            current['score'] = float(m.group(1))
+            in_index = False
+            continue
+        if in_index:
+            m = INDEX_RE.match(line)
+            if m:
+                test = current['tests'].setdefault(m.group(1), {})
+                test['baseline'] = float(m.group(2))
+                test['index'] = float(m.group(4))
+            continue
+        m = RAW_RE.match(line)
+        if m:
+            current['tests'][m.group(1)] = {'result': float(m.group(2)), 'unit': m.group(3),
+                                            'time': float(m.group(4)),
+                                            'samples': int(m.group(5))}
+    return passes
+
+
+# ==================== 历史比较 ====================
+
+def _figure(test):
+    """用于比较的数值：有指数时取指数，否则取原始结果"""
+    return test.get('index', test.get('result'))
+
+
+def compare_report(result, history):
+    """生成本次结果与历史运行（同一 MACHINE/SMP/并行份数）的比较报告，返回文本行"""
+    lines = [f"UnixBench {result['copies']} parallel cop{'y' if result['copies'] == 1 else 'ies'}: "
+             f"kernel {result['kernel_commit']} vs previous {len(history)} run(s)"]
+    if history:
+        commits = ', '.join(dict.fromkeys(r['kernel_commit'] for r in history))
+        lines.append(f"  history: {commits}")
+    lines.append(f"  {'Test':<42} {'Current':>12} {'Mean':>12} {'Min':>12} {'Max':>12} {'Change':>8}")
+
+    rows = [(name, _figure(test), [_figure(r['tests'][name]) for r in history
+                                   if name in r['tests']])
+            for name, test in result['tests'].items()]
+    rows.append(('System Benchmarks Index Score', result.get('score'),
+                 [r['score'] for r in history if r.get('score') is not None]))
+    for name, value, previous in rows:
+        previous = [v for v in previous if v is not None]
+        if value is None:
+            continue
+        if not previous:
+            lines.append(f"  {name:<42} {value:>12.1f} {'-':>12} {'-':>12} {'-':>12} {'new':>8}")
+            continue
+        mean = sum(previous) / len(previous)
+        change = change_percent(value, mean)
+        change = f"{change:+.1f}%" if change is not None else '-'
+        lines.append(f"  {name:<42} {value:>12.1f} {mean:>12.1f} {min(previous):>12.1f} "
+                     f"{max(previous):>12.1f} {change:>8}")
+    return lines
+
 
 class UnixBenchTest(OERuntimeTestCase):
-    """StarryOS UnixBench benchmark test suite"""
+    """StarryOS UnixBench benchmark test suite
+
+    子测试与并行份数由 UNIXBENCH_TESTS / UNIXBENCH_COPIES 配置，
+    解析出的原始结果、指数与总分按内核提交、MACHINE 与 SMP 数追加到
+    STARRY_PERF_DIR/unixbench.jsonl，并与最近 UNIXBENCH_HISTORY_RUNS 次运行比较，
+    报告写入日志与 STARRY_PERF_DIR/unixbench-report.txt。
+    """
+
+    def _copies(self, smp):
+        copies = (self.td.get('UNIXBENCH_COPIES') or '').split()
+        if not copies:
+            copies = ['1', str(smp)]
+        return list(dict.fromkeys(c for c in copies if c.isdigit() and int(c) > 0))
 
     @OEHasPackage(['unixbench'])
     def test_unixbench(self):
         """Run UnixBench system benchmark
-        
+
         UnixBench is a comprehensive benchmark suite for Unix systems,
         testing CPU, memory, file I/O, and process creation performance.
         """
         self.logger.info("=== UnixBench System Benchmark ===")
-        
+
         # Check if UnixBench directory exists
         status, output = self.target.run('test -d /usr/share/unixbench && test -x /usr/share/unixbench/Run', timeout=10)
         if status != 0:
             self.skipTest(f"UnixBench directory or Run script not found")
-        
+
+        build = build_info(self.target, self.td)
+        tests = (self.td.get('UNIXBENCH_TESTS') or 'execl').split()
+        copies = self._copies(build['smp'])
+        iterations = self.td.get('UNIXBENCH_ITERATIONS') or '3'
+        args = f"-i {iterations} " + ' '.join(f'-c {c}' for c in copies) + ' ' + ' '.join(tests)
+        self.logger.info(f"UnixBench: {' '.join(tests)} with {', '.join(copies)} copies "
+                         f"(kernel {build['kernel_commit']}, smp {build['smp']})")
+
         # Check current directory and run test
-        status, output = self.target.run('cd /usr/share/unixbench && ./Run execl', timeout=500)
-        
+        status, output = self.target.run(f'cd /usr/share/unixbench && ./Run {args}',
+                                         timeout=int(self.td.get('UNIXBENCH_TIMEOUT') or 1800))
+
         self.logger.info(f"UnixBench status={status}, output length={len(output)}")
         self.logger.info(f"UnixBench output:\n{output}")
-        
+
         # Check for crashes
         if status == 254 or 'Connection lost' in output:
             self.fail(f"StarryOS crashed during UnixBench!\n{output}")
-        
+
         # Check for command not found
         elif status == 127:
             self.skipTest(f"UnixBench command not found (status=127): {output}")
-        
+
         # Success: exit code 0 or benchmark score present
         elif status == 0 or 'System Benchmarks Index Score' in output or 'BASELINE' in output:
             self.logger.info("✅ UnixBench PASSED")
-        
+
         # Unexpected failure
         else:
             self.fail(f"UnixBench failed (status={status}):\n{output}")
+
+        passes = parse_unixbench(output)
+        if not passes:
+            self.logger.warning("No UnixBench results found in output, nothing recorded")
+            return
+        self._record(build, tests, passes)
+
+    def _record(self, build, tests, passes):
+        """保存结果并输出与历史运行的比较报告"""
+        directory = perf_dir(self.td)
+        store = PerfStore(directory, 'unixbench')
+        limit = int(self.td.get('UNIXBENCH_HISTORY_RUNS') or 5)
+
+        report = []
+        for result in passes:
+            record = dict(build, copies=result['copies'], subtests=tests,
+                          score=result['score'], tests=result['tests'])
+            history = store.records(machine=build['machine'], smp=build['smp'],
+                                    copies=result['copies'])
+            history = [r for r in history if r.get('subtests') == tests][-limit:] if limit > 0 else []
+            report += compare_report(record, history) + ['']
+            store.append(record)
+
+        self.logger.info("UnixBench comparison:\n" + '\n'.join(report))
+        with open(os.path.join(directory, 'unixbench-report.txt'), 'w') as f:
+            f.write('\n'.join(report))
@@ -0,0 +1,32 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS vsock Target Tests
+
+from oeqa.runtime.case import OERuntimeTestCase
+
+
+class VsockTargetTest(OERuntimeTestCase):
+    """OEQemuVsockTarget 自身的行为（连接数上限、并发执行）"""
+
+    def test_vsock_run_many_with_session(self):
+        """长连接会话打开时，run_many 以默认并发数执行不会超出 vsock-server 的连接上限"""
+        if not hasattr(self.target, 'run_many'):
+            self.skipTest("Target is not a vsock target")
+
+        # 先经长连接会话执行一条命令，使其占用服务端的一个连接
+        status, output = self.target.run('true', timeout=10)
+        if status == 255 and 'Failed to connect' in output:
+            self.skipTest("StarryOS already crashed (cannot connect)")
+        self.assertEqual(status, 0, output)
+
+        # 每条命令都持续一段时间，保证 max_concurrency 个连接同时存在
+        count = self.target.max_concurrency
+        commands = [f'sleep 1; echo run-many-{i}' for i in range(count)]
+        results = self.target.run_many(commands, timeout=30)
+        for i, (status, output) in enumerate(results):
+            self.assertEqual(status, 0, f"command {i} failed: {output}")
+            self.assertIn(f'run-many-{i}', output)
+
+        status, output = self.target.run('true', timeout=10)
+        self.assertEqual(status, 0, output)
@@ -0,0 +1,54 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS vsock 控制器的单元测试（oe-selftest -r starryvsock）
+
+import unittest
+
+from oeqa.core.runner import OETestResult
+from oeqa.selftest.case import OESelftestTestCase
+from oeqa.controllers.vsockshard import collect_results
+
+
+class ShardResultTests(OESelftestTestCase):
+
+    def test_collect_results(self):
+        """真实的 OETestResult 经 collect_results 转换后，各类结果的状态正确"""
+        # 放在函数内定义，避免被 oe-selftest 当作用例加载
+        class Cases(unittest.TestCase):
+            def test_pass(self):
+                pass
+
+            def test_fail(self):
+                self.fail('boom')
+
+            def test_error(self):
+                raise RuntimeError('boom')
+
+            def test_skip(self):
+                self.skipTest('not here')
+
+            @unittest.expectedFailure
+            def test_xfail(self):
+                self.fail('known')
+
+            @unittest.expectedFailure
+            def test_xpass(self):
+                pass
+
+        result = OETestResult(self.tc)
+        unittest.TestLoader().loadTestsFromTestCase(Cases).run(result)
+        results = collect_results(result)
+
+        statuses = {test_id.rsplit('.', 1)[-1]: entry['status'] for test_id, entry in results.items()}
+        self.assertEqual(statuses, {
+            'test_pass': 'PASSED',
+            'test_fail': 'FAILED',
+            'test_error': 'ERROR',
+            'test_skip': 'SKIPPED',
+            'test_xfail': 'EXPECTEDFAIL',
+            'test_xpass': 'UNEXPECTEDSUCCESS',
+        })
+        passed = next(entry for test_id, entry in results.items() if test_id.endswith('.test_pass'))
+        self.assertEqual(passed['log'], '')
+        self.assertIn('duration', passed)
@@ -0,0 +1,241 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# StarryOS 性能数据：被测构建的标识、结果持久化与基线比较
+# 供 runtime/cases 中的性能类用例共用
+
+import os
+import json
+import math
+import time
+import fcntl
+
+# STARRY_PERF_DIR 未设置时，在 TOPDIR 下保存（不随 TMPDIR 清理丢失）
+DEFAULT_PERF_DIR = 'starry-perf'
+
+
+def perf_dir(td):
+    """返回性能数据目录（STARRY_PERF_DIR），不存在时创建"""
+    path = td.get('STARRY_PERF_DIR') or os.path.join(td.get('TOPDIR') or os.getcwd(),
+                                                     DEFAULT_PERF_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def td_float(td, name, default):
+    """读取数值型配置变量，未设置或无法解析时返回 default"""
+    try:
+        return float(td.get(name) or default)
+    except (TypeError, ValueError):
+        return float(default)
+
+
+def td_bool(td, name):
+    return (td.get(name) or '0').strip().lower() in ('1', 'yes', 'true')
+
+
+# ==================== 构建标识 ====================
+
+# /etc/starry-release 中的字段 -> build_info() 的键
+RELEASE_FIELDS = {'Build ID': 'build_id', 'Kernel Commit': 'kernel_commit'}
+
+
+def build_info(target, td):
+    """返回标识被测构建的 {'build_id', 'kernel_commit', 'machine', 'smp'}
+
+    build_id 与 kernel_commit 取 /etc/starry-release 中的 Build ID（内核镜像哈希）
+    与 Kernel Commit（内核源码的 git 提交），
+    smp 优先取 ARCEOS_SMP，未设置时在目标机上执行 nproc。
+    """
+    info = {'build_id': 'unknown', 'kernel_commit': 'unknown',
+            'machine': td.get('MACHINE') or 'unknown', 'smp': 1}
+
+    status, output = target.run('cat /etc/starry-release', timeout=10)
+    if status == 0:
+        for line in output.splitlines():
+            key, sep, value = line.partition(':')
+            if sep and key.strip() in RELEASE_FIELDS and value.strip():
+                info[RELEASE_FIELDS[key.strip()]] = value.strip()
+
+    smp = td.get('ARCEOS_SMP')
+    if not smp:
+        status, output = target.run('nproc', timeout=10)
+        smp = output.strip() if status == 0 else ''
+    try:
+        info['smp'] = max(1, int(smp))
+    except ValueError:
+        pass
+    return info
+
+
+# ==================== 结果持久化 ====================
+
+class PerfStore(object):
+    """一个测试套件的性能记录与基线
+
+    <dir>/<suite>.jsonl           每次运行追加一条记录（JSON Lines）
+    <dir>/<suite>-baseline.json   {key: {'build_id': ..., 'metrics': {...}}}
+
+    分片并行执行时多个进程会同时写入，写操作都在 flock 下进行。
+    """
+
+    def __init__(self, directory, suite):
+        self.path = os.path.join(directory, f'{suite}.jsonl')
+        self.baseline_path = os.path.join(directory, f'{suite}-baseline.json')
+        self._lock_path = os.path.join(directory, f'.{suite}.lock')
+
+    def _locked(self):
+        fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def append(self, record):
+        """追加一条记录，自动补充 timestamp"""
+        record = dict(record)
+        record.setdefault('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S'))
+        fd = self._locked()
+        try:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        finally:
+            os.close(fd)
+
+    def records(self, **match):
+        """按写入顺序返回字段与 match 全部相等的记录"""
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        result = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 被中断的写入
+                continue
+            if all(record.get(k) == v for k, v in match.items()):
+                result.append(record)
+        return result
+
+    def _load_baselines(self):
+        try:
+            with open(self.baseline_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def baseline(self, key):
+        return self._load_baselines().get(key)
+
+    def set_baseline(self, key, build_id, metrics):
+        fd = self._locked()
+        try:
+            baselines = self._load_baselines()
+            baselines[key] = {'build_id': build_id, 'metrics': metrics,
+                              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            tmp = f'{self.baseline_path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(baselines, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.baseline_path)
+        finally:
+            os.close(fd)
+
+
+# ==================== 回归判定 ====================
+
+def change_percent(current, baseline):
+    """current 相对 baseline 的变化百分比，无法比较时返回 None"""
+    if current is None or not baseline:
+        return None
+    return (current - baseline) / baseline * 100.0
+
+
+def classify(change, warn_pct, fail_pct, higher_is_better=True):
+    """按阈值判定一个指标的变化：'ok'、'warn' 或 'fail'
+
+    阈值为允许的最大劣化百分比，0 表示不检查该级别。
+    """
+    if change is None:
+        return 'ok'
+    loss = -change if higher_is_better else change
+    if fail_pct > 0 and loss > fail_pct:
+        return 'fail'
+    if warn_pct > 0 and loss > warn_pct:
+        return 'warn'
+    return 'ok'
+
+
+# ==================== 统计 ====================
+# 置信区间采用与分布无关的次序统计量区间：样本中低于真实 q 分位数的个数服从
+# Binomial(n, q)，取使覆盖概率不低于 confidence 的最窄秩区间 [X(l), X(u)]
+
+def percentile(sorted_values, q):
+    """已排序样本的 q 分位数（0 <= q <= 1，线性插值）"""
+    if not sorted_values:
+        return None
+    pos = (len(sorted_values) - 1) * q
+    lo = math.floor(pos)
+    hi = math.ceil(pos)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def _binom_cdf(n, q):
+    """返回 Binomial(n, q) 的累积分布 [P(B <= k) for k in 0..n]（对数空间计算，n 较大也不下溢）"""
+    cdf = []
+    total = 0.0
+    log_q, log_1q = math.log(q), math.log1p(-q)
+    for k in range(n + 1):
+        total += math.exp(math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+                          + k * log_q + (n - k) * log_1q)
+        cdf.append(min(total, 1.0))
+    return cdf
+
+
+def quantile_ci(sorted_values, q, confidence=0.95):
+    """q 分位数的置信区间 (low, high)；样本太少时退化为 (最小值, 最大值)"""
+    n = len(sorted_values)
+    if n == 0:
+        return (None, None)
+    alpha = (1.0 - confidence) / 2
+    cdf = _binom_cdf(n, q)
+    # 秩从 1 开始：下界取 P(B <= l-1) <= alpha 的最大 l，上界取 P(B <= u-1) >= 1-alpha 的最小 u
+    low = 1
+    for rank in range(1, n + 1):
+        if cdf[rank - 1] <= alpha:
+            low = rank
+        else:
+            break
+    high = n
+    for rank in range(1, n + 1):
+        if cdf[rank - 1] >= 1.0 - alpha:
+            high = rank
+            break
+    return (sorted_values[low - 1], sorted_values[max(low, high) - 1])
+
+
+def summarize(values, confidence=0.95):
+    """样本的统计摘要：n、mean、stdev、min、max、median/p99 及其置信区间"""
+    data = sorted(values)
+    n = len(data)
+    if n == 0:
+        return {'n': 0}
+    mean = sum(data) / n
+    stdev = math.sqrt(sum((v - mean) ** 2 for v in data) / (n - 1)) if n > 1 else 0.0
+    return {
+        'n': n, 'mean': mean, 'stdev': stdev, 'min': data[0], 'max': data[-1],
+        'median': percentile(data, 0.5), 'median_ci': list(quantile_ci(data, 0.5, confidence)),
+        'p99': percentile(data, 0.99), 'p99_ci': list(quantile_ci(data, 0.99, confidence)),
+        'confidence': confidence,
+    }
+
+
+def compare_intervals(current, baseline, higher_is_better=False):
+    """比较两个置信区间：不重叠时返回 'regression' 或 'improvement'，重叠时返回 None"""
+    if None in current or None in baseline:
+        return None
+    if current[1] < baseline[0]:
+        return 'improvement' if not higher_is_better else 'regression'
+    if current[0] > baseline[1]:
+        return 'regression' if not higher_is_better else 'improvement'
+    return None
@@ -6,11 +6,14 @@ Module Installer for StarryOS Test Harness
 
 import sys
 import os
-import shutil
+import json
+import hashlib
 import argparse
 from pathlib import Path
 import re
 
+from install_sync import FileSyncer
+
 try:
     import toml
 except ImportError:
@@ -18,25 +21,53 @@ except ImportError:
     sys.exit(1)
 
 
+# cargo test 生成的测试二进制: <name>-<16 位 hash>
+RUST_TEST_BINARY = re.compile(r'^(.+)-([0-9a-f]{16})$')
+
+# 预编译索引的格式版本，需与 test-runner 的 INDEX_VERSION 一致
+INDEX_VERSION = 1
+
+
+def compile_index(manifest_path, manifest):
+    """把 manifest 编译为 test-runner 直接加载的索引
+
+    套件按名称索引，测试列表已展开；source_sha256 用于在运行时判断索引是否过期。
+    """
+    with open(manifest_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    suites = {}
+    for ts in manifest.get('test_suite', []):
+        if ts.get('name') and ts['name'] not in suites:
+            suites[ts['name']] = ts
+    return {'version': INDEX_VERSION, 'source_sha256': digest, 'suites': suites}
+
+
+def write_index(index, index_path):
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = index_path.with_name(index_path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, separators=(',', ':'), sort_keys=True)
+    os.replace(tmp, index_path)
+    print(f"Wrote manifest index: {index_path} ({len(index['suites'])} suites)", file=sys.stderr)
+
+
 class ModuleInstaller:
     """模块安装器 - 根据 manifest.toml 安装测试"""
     
-    def __init__(self, manifest_path, source_dir, dest_dir, target_arch):
+    def __init__(self, manifest_path, source_dir, dest_dir, target_arch, store=None):
         with open(manifest_path, 'r') as f:
             self.manifest = toml.load(f)
+        self.index = compile_index(manifest_path, self.manifest)
         self.source_dir = Path(source_dir)
         self.dest_dir = Path(dest_dir)
         self.target_arch = target_arch
         self.installed_count = 0
+        self.syncer = FileSyncer(store)
     
     def install_all(self, suite_name='ci'):
         """安装指定套件的所有测试"""
-        # 查找对应的 test_suite
-        suite = None
-        for ts in self.manifest.get('test_suite', []):
-            if ts.get('name') == suite_name:
-                suite = ts
-                break
+        suite = self.index['suites'].get(suite_name)
         
         if not suite:
             print(f"Error: Test suite '{suite_name}' not found in manifest", file=sys.stderr)
@@ -59,6 +90,9 @@ class ModuleInstaller:
         if libc_tests:
             self._install_libc_tests(libc_tests)
         
+        self.syncer.finish()
+        print(f"Install backend: {self.syncer.summary() or 'nothing to do'}", file=sys.stderr)
+        
         if self.installed_count == 0:
             print("Warning: No test modules were installed!", file=sys.stderr)
             return False
@@ -79,27 +113,46 @@ class ModuleInstaller:
             print(f"Error: Rust deps directory not found: {deps_dir}", file=sys.stderr)
             return
         
+        candidates = self._index_rust_binaries(deps_dir)
+        
         for test in tests:
             test_name = test['name']
-            # 测试二进制文件名格式: test_name-{16位hash}
-            # 例如: file_io_basic-1234567890abcdef
-            pattern = re.compile(f"^{test_name}-[0-9a-f]{{16}}$")
-            
-            found = False
-            for binary in deps_dir.iterdir():
-                if binary.is_file() and pattern.match(binary.name):
-                    # 确认是可执行文件
-                    if os.access(binary, os.X_OK):
-                        dest = dest_dir / test_name
-                        shutil.copy2(binary, dest)
-                        dest.chmod(0o755)
-                        print(f"  ✓ Installed: {test_name}", file=sys.stderr)
-                        self.installed_count += 1
-                        found = True
-                        break
-            
+            found = candidates.get(test_name)
             if not found:
                 print(f"  ✗ Warning: Binary not found for test '{test_name}'", file=sys.stderr)
+                continue
+            
+            # 多次构建会留下多个 hash 不同的二进制，取最新的一个
+            found.sort(key=lambda e: (e[1], e[0].name), reverse=True)
+            binary = found[0][0]
+            if len(found) > 1:
+                others = ", ".join(e[0].name for e in found[1:])
+                print(f"  ! Ambiguous: {test_name} has {len(found)} candidates, "
+                      f"using newest {binary.name} (ignored: {others})", file=sys.stderr)
+            
+            self.syncer.sync_file(binary, dest_dir / test_name, 0o755)
+            print(f"  ✓ Installed: {test_name}", file=sys.stderr)
+            self.installed_count += 1
+    
+    @staticmethod
+    def _index_rust_binaries(deps_dir):
+        """扫描一次 deps 目录，返回 {测试名: [(路径, mtime_ns), ...]}
+        
+        测试二进制文件名格式: test_name-{16位hash}，例如 file_io_basic-1234567890abcdef；
+        .d/.rlib 等带扩展名的文件不匹配该格式。
+        """
+        candidates = {}
+        with os.scandir(deps_dir) as entries:
+            for entry in entries:
+                match = RUST_TEST_BINARY.match(entry.name)
+                if not match or not entry.is_file():
+                    continue
+                # 确认是可执行文件
+                if not os.access(entry.path, os.X_OK):
+                    continue
+                candidates.setdefault(match.group(1), []).append(
+                    (Path(entry.path), entry.stat().st_mtime_ns))
+        return candidates
     
     def _install_libc_tests(self, tests):
         """安装 libc-test 测试套件"""
@@ -118,8 +171,7 @@ class ModuleInstaller:
         # 安装 run 脚本
         run_script = libc_harness / "run"
         if run_script.exists():
-            shutil.copy2(run_script, dest_dir / "run")
-            (dest_dir / "run").chmod(0o755)
+            self.syncer.sync_file(run_script, dest_dir / "run", 0o755)
             print("  ✓ Installed: run script", file=sys.stderr)
         else:
             print(f"  ✗ Error: run script not found at {run_script}", file=sys.stderr)
@@ -128,19 +180,18 @@ class ModuleInstaller:
         # 安装 src/ 目录（包含所有测试二进制）
         src_dir = libc_harness / "libc-test-bins" / "src"
         if src_dir.exists():
-            dest_src = dest_dir / "src"
-            if dest_src.exists():
-                shutil.rmtree(dest_src)
-            shutil.copytree(src_dir, dest_src)
-            
-            # 确保所有 .exe 文件可执行
+            # 增量同步：未变化的文件跳过，确保所有 .exe 文件可执行
             exe_count = 0
-            for root, _, files in os.walk(dest_src):
-                for f in files:
-                    if f.endswith('.exe'):
-                        exe_path = Path(root) / f
-                        exe_path.chmod(0o755)
-                        exe_count += 1
+            
+            def exe_mode(rel, mode):
+                nonlocal exe_count
+                if rel.name.endswith('.exe'):
+                    exe_count += 1
+                    return 0o755
+                return mode
+            
+            self.syncer.sync_tree(src_dir, dest_dir / "src", exe_mode,
+                                  keep=["common/runtest.exe"])
             
             print(f"  ✓ Installed: {exe_count} test binaries", file=sys.stderr)
             self.installed_count += 1
@@ -151,10 +202,7 @@ class ModuleInstaller:
         # 安装 runtest.exe (在 src/common/ 目录下)
         runtest_exe = libc_harness / "libc-test-bins" / "runtest.exe"
         if runtest_exe.exists():
-            common_dir = dest_dir / "src" / "common"
-            common_dir.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(runtest_exe, common_dir / "runtest.exe")
-            (common_dir / "runtest.exe").chmod(0o755)
+            self.syncer.sync_file(runtest_exe, dest_dir / "src" / "common" / "runtest.exe", 0o755)
             print("  ✓ Installed: runtest.exe", file=sys.stderr)
         else:
             print(f"  ✗ Warning: runtest.exe not found at {runtest_exe}", file=sys.stderr)
@@ -173,6 +221,11 @@ def main():
                         help='Rust target architecture (e.g., aarch64-unknown-linux-musl)')
     parser.add_argument('--suite', default='ci',
                         help='Test suite to install (default: ci)')
+    parser.add_argument('--index',
+                        help='Also write the precompiled manifest index for test-runner')
+    parser.add_argument('--store',
+                        help='Content-addressed store shared between recipes; installed '
+                             'files are reflinked or copied from it')
     
     args = parser.parse_args()
     
@@ -180,9 +233,13 @@ def main():
         manifest_path=args.manifest,
         source_dir=args.source,
         dest_dir=args.dest,
-        target_arch=args.target
+        target_arch=args.target,
+        store=args.store
     )
     
+    if args.index:
+        write_index(installer.index, args.index)
+    
     success = installer.install_all(suite_name=args.suite)
     sys.exit(0 if success else 1)
 
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Incremental Install Backend for StarryOS Test Recipes
+测试二进制的增量安装：未变化的文件跳过，变化的文件经内容寻址存储 reflink/复制
+
+starry-ci-tests 的 install_modules.py 与 starry-daily-tests 的 do_install 共用：
+  install_sync.py --store DIR [--mode 0755] SRC... DEST_DIR
+"""
+
+import sys
+import os
+import json
+import stat
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+
+
+# ==================== 内容寻址存储 ====================
+# 存储目录布局（STARRY_TEST_STORE，默认 ${TMPDIR}/starry-test-store）：
+#   objects/<sha[:2]>/<sha>.<mode>   文件内容，按 SHA-256 与权限位寻址
+#   hashes.json                      {源文件 realpath: [size, mtime_ns, sha]}
+#   .lock                            写 hashes.json 与清理对象时的 flock
+# 存储只作为复制源：安装目标由对象 reflink（支持的文件系统上共享数据块）或复制得到，
+# 从不 hardlink。${D} 中的文件会在 do_package 中被原地 strip / 修改权限，共享 inode
+# 会破坏以内容哈希命名的对象以及另一个配方已安装的文件。镜像中内容相同的二进制
+# 由 starry-test-image 的 dedupe_starry_test_binaries 合并。
+
+HASH_CHUNK = 1024 * 1024
+
+# linux/fs.h: FICLONE = _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# 对象多久未被使用（mtime 在每次 put 时刷新）后清理（秒）
+PRUNE_AGE = 7 * 24 * 3600
+
+
+def reflink(src, dst):
+    """以 reflink（写时复制）创建 dst；文件系统不支持时抛出 OSError"""
+    with open(src, 'rb') as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+        except OSError:
+            os.close(fd)
+            os.unlink(dst)
+            raise
+        os.close(fd)
+
+
+def clone_file(src, dst):
+    """复制文件内容：优先 reflink，失败时退回普通复制"""
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except OSError:
+        shutil.copyfile(src, dst)
+        return 'copy'
+
+
+class ContentStore:
+    """按内容寻址的文件存储"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.objects = self.root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self._memo_path = self.root / "hashes.json"
+        self._lock_path = self.root / ".lock"
+        try:
+            with open(self._memo_path) as f:
+                self._memo = json.load(f)
+        except (OSError, ValueError):
+            self._memo = {}
+        self._memo_dirty = False
+
+    def digest(self, path):
+        """文件 SHA-256；大小与 mtime 未变的源文件直接复用上次的结果"""
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        cached = self._memo.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(HASH_CHUNK)
+                if not data:
+                    break
+                sha.update(data)
+        digest = sha.hexdigest()
+        self._memo[path] = [st.st_size, st.st_mtime_ns, digest]
+        self._memo_dirty = True
+        return digest
+
+    def put(self, path, mode):
+        """把文件放入存储，返回对象路径（已存在则不复制）"""
+        digest = self.digest(path)
+        obj = self.objects / digest[:2] / f"{digest}.{mode:o}"
+        if obj.exists():
+            # 刷新 mtime，正在被使用的对象不会被 prune 清理
+            os.utime(obj)
+            return obj
+        obj.parent.mkdir(exist_ok=True)
+        # 源文件可能被后续构建原地改写，对象不与源文件共享 inode
+        tmp = obj.with_name(f"{obj.name}.{os.getpid()}.tmp")
+        clone_file(path, tmp)
+        os.chmod(tmp, mode)
+        os.replace(tmp, obj)
+        return obj
+
+    def save(self):
+        """写回哈希缓存；并行的 do_install 在 flock 下先合并对方写入的条目"""
+        if not self._memo_dirty:
+            return
+        with open(self._lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self._memo_path) as f:
+                    memo = json.load(f)
+            except (OSError, ValueError):
+                memo = {}
+            memo.update(self._memo)
+            tmp = self._memo_path.with_name(f"hashes.json.{os.getpid()}.tmp")
+            with open(tmp, 'w') as f:
+                json.dump(memo, f, separators=(',', ':'))
+            os.replace(tmp, self._memo_path)
+            self._memo = memo
+        self._memo_dirty = False
+
+    def prune(self, min_age=PRUNE_AGE):
+        """删除长时间未被使用的对象"""
+        removed = 0
+        now = time.time()
+        with open(self._lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for obj in self.objects.glob("*/*"):
+                try:
+                    st = obj.lstat()
+                except OSError:
+                    continue
+                if now - st.st_mtime > min_age and not obj.name.endswith('.tmp'):
+                    obj.unlink()
+                    removed += 1
+        return removed
+
+
+# ==================== 增量同步 ====================
+
+class FileSyncer:
+    """把文件同步到安装目录
+
+    - 目标与源的大小、mtime、权限位一致时跳过
+    - 否则由存储对象（有存储时）或源文件 reflink，不支持时复制；目标总是独立的 inode
+    """
+
+    def __init__(self, store=None):
+        self.store = ContentStore(store) if store else None
+        self.stats = {'unchanged': 0, 'reflink': 0, 'copy': 0, 'symlink': 0, 'removed': 0}
+
+    def sync_file(self, src, dest, mode=None):
+        """同步单个文件，mode 为 None 时沿用源文件的权限位"""
+        src = Path(src)
+        dest = Path(dest)
+        src_st = src.stat()
+        if mode is None:
+            mode = stat.S_IMODE(src_st.st_mode)
+
+        try:
+            dest_st = dest.lstat()
+        except FileNotFoundError:
+            dest_st = None
+
+        if (dest_st is not None and stat.S_ISREG(dest_st.st_mode)
+                and dest_st.st_size == src_st.st_size
+                and dest_st.st_mtime_ns == src_st.st_mtime_ns
+                and stat.S_IMODE(dest_st.st_mode) == mode):
+            self.stats['unchanged'] += 1
+            return
+
+        origin = self.store.put(src, mode) if self.store else src
+
+        def create(tmp):
+            method = clone_file(origin, tmp)
+            os.chmod(tmp, mode)
+            os.utime(tmp, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+            return method
+        self._replace(dest, create)
+
+    @staticmethod
+    def _symlink(target, tmp):
+        os.symlink(target, tmp)
+        return 'symlink'
+
+    def _replace(self, dest, create):
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.sync-tmp")
+        if os.path.lexists(tmp):
+            tmp.unlink()
+        try:
+            self.stats[create(tmp)] += 1
+            if dest.is_dir() and not dest.is_symlink():
+                shutil.rmtree(dest)
+            os.replace(tmp, dest)
+        finally:
+            if os.path.lexists(tmp):
+                tmp.unlink()
+
+    def sync_tree(self, src_dir, dest_dir, mode_for=None, keep=()):
+        """增量同步目录树：更新变化的文件，删除源中已不存在的文件
+
+        mode_for(relpath, mode) 返回目标文件的权限位，用于统一调整（例如 .exe 可执行）；
+        keep 为不在源目录中但需要保留的相对路径（由调用方另行安装）。
+        符号链接按链接本身同步。返回同步的文件数。
+        """
+        src_dir = Path(src_dir)
+        dest_dir = Path(dest_dir)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        wanted = {Path(p) for p in keep}
+        for p in keep:
+            wanted.update(Path(p).parents)
+        count = 0
+
+        for root, dirs, files in os.walk(src_dir):
+            rel_root = Path(root).relative_to(src_dir)
+            for name in dirs + files:
+                src = Path(root) / name
+                rel = rel_root / name
+                dest = dest_dir / rel
+                wanted.add(rel)
+                if src.is_symlink():
+                    target = os.readlink(src)
+                    if not (dest.is_symlink() and os.readlink(dest) == target):
+                        self._replace(dest, lambda tmp: self._symlink(target, tmp))
+                    continue
+                if name in dirs:
+                    if dest.is_symlink() or (dest.exists() and not dest.is_dir()):
+                        dest.unlink()
+                    dest.mkdir(exist_ok=True)
+                    continue
+                mode = stat.S_IMODE(src.stat().st_mode)
+                if mode_for:
+                    mode = mode_for(rel, mode)
+                self.sync_file(src, dest, mode)
+                count += 1
+
+        # 删除源目录中已不存在的文件（自底向上）
+        for root, dirs, files in os.walk(dest_dir, topdown=False):
+            rel_root = Path(root).relative_to(dest_dir)
+            for name in files + dirs:
+                rel = rel_root / name
+                if rel in wanted:
+                    continue
+                path = Path(root) / name
+                if path.is_dir() and not path.is_symlink():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+                self.stats['removed'] += 1
+        return count
+
+    def finish(self):
+        if self.store:
+            self.store.save()
+            self.store.prune()
+
+    def summary(self):
+        return ", ".join(f"{v} {k}" for k, v in self.stats.items() if v)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Install files incrementally through a content-addressed store")
+    parser.add_argument('--store',
+                        help='Content-addressed store directory (shared between recipes)')
+    parser.add_argument('--mode', type=lambda s: int(s, 8),
+                        help='Permission bits of installed files (octal, e.g. 0755)')
+    parser.add_argument('sources', nargs='+', help='Files to install')
+    parser.add_argument('dest', help='Destination directory')
+
+    args = parser.parse_args()
+
+    syncer = FileSyncer(args.store)
+    dest_dir = Path(args.dest)
+    for src in args.sources:
+        syncer.sync_file(src, dest_dir / Path(src).name, args.mode)
+    syncer.finish()
+    print(f"Installed {len(args.sources)} files to {dest_dir} ({syncer.summary()})", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
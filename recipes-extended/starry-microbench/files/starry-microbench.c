@@ -0,0 +1,335 @@
+/*
+ * starry-microbench.c - StarryOS 内核热路径微基准
+ *
+ * 由 OEQA 用例 microbench.py 通过 vsock 调用，每个基准先预热若干次，
+ * 再重复 N 次测量，每次测量输出一个样本，统计（中位数、p99、置信区间）在宿主机上完成。
+ *
+ * 用法: starry-microbench [-w warmup] [-n reps] [-d dir] BENCH[:iters]...
+ *   syscall    getppid() 往返                       ns/op    越低越好
+ *   fork       fork + exec + wait                   us/op    越低越好
+ *   pipe       pipe 单向吞吐（64 KiB 写）           MB/s     越高越好
+ *   unix       AF_UNIX 流套接字单向吞吐             MB/s     越高越好
+ *   ctxsw      两进程经 pipe 乒乓的单次切换延迟     ns/op    越低越好
+ *   pagefault  匿名映射首次写入的缺页开销           ns/op    越低越好
+ *   create     -d 目录下 open(O_CREAT)+close+unlink ns/op    越低越好
+ *   iters 为每次测量的操作数，省略时使用各基准的默认值
+ *
+ * 输出（每行一条，便于宿主机解析）:
+ *   BENCH <name> <unit> <higher|lower> <iters>
+ *   SAMPLE <name> <value>          每次测量一行（预热不输出）
+ *   ERROR <name> <message>         基准无法运行（例如系统调用不支持）
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <time.h>
+#include <signal.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include <sys/wait.h>
+
+#define DEFAULT_WARMUP 3
+#define DEFAULT_REPS 30
+#define DEFAULT_DIR "/root/.microbench"
+#define STREAM_CHUNK (64 * 1024)
+
+static const char *self_path;
+static const char *bench_dir = DEFAULT_DIR;
+
+/* 返回测量值；失败时返回负数并设置 errno */
+typedef double (*bench_fn)(long iters);
+
+struct bench {
+    const char *name;
+    const char *unit;
+    int higher_is_better;
+    long default_iters;
+    bench_fn fn;
+};
+
+static double now_ns(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (double)ts.tv_sec * 1e9 + (double)ts.tv_nsec;
+}
+
+/* ==================== 基准实现 ==================== */
+
+static double bench_syscall(long iters)
+{
+    double start = now_ns();
+    for (long i = 0; i < iters; i++)
+        syscall(SYS_getppid);
+    return (now_ns() - start) / iters;
+}
+
+static double bench_fork(long iters)
+{
+    double start = now_ns();
+    for (long i = 0; i < iters; i++) {
+        int status;
+        pid_t pid = fork();
+        if (pid < 0)
+            return -1;
+        if (pid == 0) {
+            execl(self_path, self_path, "--noop", (char *)NULL);
+            _exit(127);
+        }
+        if (waitpid(pid, &status, 0) < 0)
+            return -1;
+        if (!WIFEXITED(status) || WEXITSTATUS(status) != 0) {
+            errno = ENOEXEC;
+            return -1;
+        }
+    }
+    return (now_ns() - start) / iters / 1000.0;
+}
+
+/* 子进程从 fds[0] 读到 EOF，父进程向 fds[1] 写 iters 个块，返回 MB/s */
+static double stream_throughput(int fds[2], long iters)
+{
+    static char buf[STREAM_CHUNK];
+    pid_t pid = fork();
+    if (pid < 0)
+        return -1;
+    if (pid == 0) {
+        close(fds[1]);
+        while (read(fds[0], buf, sizeof(buf)) > 0)
+            ;
+        _exit(0);
+    }
+    close(fds[0]);
+
+    double start = now_ns();
+    for (long i = 0; i < iters; i++) {
+        size_t off = 0;
+        while (off < sizeof(buf)) {
+            ssize_t n = write(fds[1], buf + off, sizeof(buf) - off);
+            if (n < 0) {
+                if (errno == EINTR)
+                    continue;
+                close(fds[1]);
+                waitpid(pid, NULL, 0);
+                return -1;
+            }
+            off += n;
+        }
+    }
+    close(fds[1]);
+    waitpid(pid, NULL, 0);
+    double elapsed = now_ns() - start;
+    return (double)iters * STREAM_CHUNK / (elapsed / 1e9) / (1024.0 * 1024.0);
+}
+
+static double bench_pipe(long iters)
+{
+    int fds[2];
+    if (pipe(fds) < 0)
+        return -1;
+    return stream_throughput(fds, iters);
+}
+
+static double bench_unix(long iters)
+{
+    int fds[2];
+    if (socketpair(AF_UNIX, SOCK_STREAM, 0, fds) < 0)
+        return -1;
+    /* socketpair 两端均可读写，与 pipe 一样由 fds[0] 读、fds[1] 写 */
+    return stream_throughput(fds, iters);
+}
+
+static double bench_ctxsw(long iters)
+{
+    int ping[2], pong[2];
+    char c = 0;
+    if (pipe(ping) < 0)
+        return -1;
+    if (pipe(pong) < 0) {
+        close(ping[0]);
+        close(ping[1]);
+        return -1;
+    }
+
+    pid_t pid = fork();
+    if (pid < 0)
+        return -1;
+    if (pid == 0) {
+        close(ping[1]);
+        close(pong[0]);
+        while (read(ping[0], &c, 1) == 1)
+            if (write(pong[1], &c, 1) != 1)
+                break;
+        _exit(0);
+    }
+    close(ping[0]);
+    close(pong[1]);
+
+    double start = now_ns();
+    long done;
+    for (done = 0; done < iters; done++) {
+        if (write(ping[1], &c, 1) != 1 || read(pong[0], &c, 1) != 1)
+            break;
+    }
+    double elapsed = now_ns() - start;
+    close(ping[1]);
+    close(pong[0]);
+    waitpid(pid, NULL, 0);
+    if (done < iters) {
+        errno = EPIPE;
+        return -1;
+    }
+    /* 每次往返包含两次切换 */
+    return elapsed / (2.0 * iters);
+}
+
+static double bench_pagefault(long iters)
+{
+    long page = sysconf(_SC_PAGESIZE);
+    size_t len = (size_t)iters * page;
+    char *p = mmap(NULL, len, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (p == MAP_FAILED)
+        return -1;
+
+    double start = now_ns();
+    for (long i = 0; i < iters; i++)
+        p[i * page] = 1;
+    double elapsed = now_ns() - start;
+    munmap(p, len);
+    return elapsed / iters;
+}
+
+static double bench_create(long iters)
+{
+    char path[4096];
+    if (mkdir(bench_dir, 0755) < 0 && errno != EEXIST)
+        return -1;
+
+    double start = now_ns();
+    for (long i = 0; i < iters; i++) {
+        snprintf(path, sizeof(path), "%s/f%ld", bench_dir, i);
+        int fd = open(path, O_CREAT | O_WRONLY | O_TRUNC, 0644);
+        if (fd < 0)
+            return -1;
+        close(fd);
+        if (unlink(path) < 0)
+            return -1;
+    }
+    double elapsed = now_ns() - start;
+    rmdir(bench_dir);
+    return elapsed / iters;
+}
+
+static const struct bench benches[] = {
+    { "syscall",   "ns/op", 0, 100000, bench_syscall },
+    { "fork",      "us/op", 0, 50,     bench_fork },
+    { "pipe",      "MB/s",  1, 1024,   bench_pipe },
+    { "unix",      "MB/s",  1, 1024,   bench_unix },
+    { "ctxsw",     "ns/op", 0, 10000,  bench_ctxsw },
+    { "pagefault", "ns/op", 0, 4096,   bench_pagefault },
+    { "create",    "ns/op", 0, 1000,   bench_create },
+};
+
+#define NUM_BENCHES (sizeof(benches) / sizeof(benches[0]))
+
+/* ==================== 主程序 ==================== */
+
+static int run_bench(const struct bench *b, long iters, int warmup, int reps)
+{
+    printf("BENCH %s %s %s %ld\n", b->name, b->unit,
+           b->higher_is_better ? "higher" : "lower", iters);
+    fflush(stdout);
+
+    for (int i = 0; i < warmup + reps; i++) {
+        double value = b->fn(iters);
+        if (value < 0) {
+            printf("ERROR %s %s\n", b->name, strerror(errno));
+            fflush(stdout);
+            return 1;
+        }
+        if (i >= warmup) {
+            printf("SAMPLE %s %.3f\n", b->name, value);
+            fflush(stdout);
+        }
+    }
+    return 0;
+}
+
+static void usage(const char *prog)
+{
+    fprintf(stderr, "Usage: %s [-w warmup] [-n reps] [-d dir] BENCH[:iters]...\n", prog);
+    fprintf(stderr, "Benchmarks:");
+    for (size_t i = 0; i < NUM_BENCHES; i++)
+        fprintf(stderr, " %s", benches[i].name);
+    fprintf(stderr, " all\n");
+}
+
+int main(int argc, char *argv[])
+{
+    int warmup = DEFAULT_WARMUP;
+    int reps = DEFAULT_REPS;
+    int failed = 0;
+    int opt;
+
+    /* fork 基准 exec 的目标 */
+    if (argc == 2 && strcmp(argv[1], "--noop") == 0)
+        return 0;
+
+    while ((opt = getopt(argc, argv, "w:n:d:h")) != -1) {
+        switch (opt) {
+        case 'w':
+            warmup = atoi(optarg);
+            break;
+        case 'n':
+            reps = atoi(optarg);
+            break;
+        case 'd':
+            bench_dir = optarg;
+            break;
+        default:
+            usage(argv[0]);
+            return opt == 'h' ? 0 : 2;
+        }
+    }
+    if (optind >= argc || warmup < 0 || reps < 1) {
+        usage(argv[0]);
+        return 2;
+    }
+
+    /* fork 基准需要可 exec 的路径，argv[0] 不含 '/' 时在 PATH 中的默认安装位置 */
+    self_path = strchr(argv[0], '/') ? argv[0] : "/usr/bin/starry-microbench";
+    signal(SIGPIPE, SIG_IGN);
+
+    for (int i = optind; i < argc; i++) {
+        char name[64];
+        long iters = 0;
+        const char *colon = strchr(argv[i], ':');
+        size_t len = colon ? (size_t)(colon - argv[i]) : strlen(argv[i]);
+        if (len >= sizeof(name))
+            len = sizeof(name) - 1;
+        memcpy(name, argv[i], len);
+        name[len] = '\0';
+        if (colon)
+            iters = atol(colon + 1);
+
+        int found = 0;
+        for (size_t j = 0; j < NUM_BENCHES; j++) {
+            if (strcmp(name, "all") != 0 && strcmp(name, benches[j].name) != 0)
+                continue;
+            found = 1;
+            failed |= run_bench(&benches[j], iters > 0 ? iters : benches[j].default_iters,
+                                warmup, reps);
+        }
+        if (!found) {
+            printf("ERROR %s unknown benchmark\n", name);
+            failed = 1;
+        }
+    }
+    return failed;
+}
@@ -3,25 +3,186 @@
 
 import sys
 import os
+import re
+import gzip
+import json
+import hashlib
+import signal
 import argparse
+import collections
 import subprocess
 import time
+import queue
+import threading
 from pathlib import Path
 
-try:
-    import toml
-except ImportError:
-    print("Error: python3-toml not installed", file=sys.stderr)
-    sys.exit(1)
-
-
 # ==================== 配置 ====================
 DEFAULT_MANIFEST = "/usr/lib/starry-tests/manifest.toml"
 DEFAULT_TEST_DIR = "/usr/lib/starry-tests"
+DEFAULT_RESULTS_DIR = "/var/log/starry-tests"
+
+
+# ==================== Manifest 加载 ====================
+# starry-ci-tests 构建时把 manifest.toml 预编译为同目录下的 manifest.index.json
+# （套件按名称索引），启动时直接加载，不必 import toml；索引缺失或与
+# manifest 内容不符（source_sha256 不同）时才回退到解析 TOML。
+INDEX_VERSION = 1
+
+
+def index_path(manifest_path):
+    return os.path.join(os.path.dirname(manifest_path), "manifest.index.json")
+
+
+def load_index(manifest_path, content):
+    try:
+        with open(index_path(manifest_path)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (index.get('version') != INDEX_VERSION or
+            index.get('source_sha256') != hashlib.sha256(content).hexdigest()):
+        return None
+    return index
+
+
+def load_suites(manifest_path):
+    """返回 {套件名: 套件}"""
+    with open(manifest_path, 'rb') as f:
+        content = f.read()
+    index = load_index(manifest_path, content)
+    if index:
+        return index['suites']
+    
+    try:
+        import toml
+    except ImportError:
+        print("Error: python3-toml not installed", file=sys.stderr)
+        sys.exit(1)
+    suites = {}
+    for ts in toml.loads(content.decode('utf-8')).get('test_suite', []):
+        suites.setdefault(ts.get('name'), ts)
+    return suites
+
+
+# ==================== 输出捕获 ====================
+# 子进程输出按行流式读取：内存中只保留开头和结尾若干行用于摘要，
+# 完整日志以 gzip 写入结果目录，通过/失败计数随读随统计，
+# 无论测试输出多少，内存占用都不随之增长。
+HEAD_LINES = 20
+TAIL_LINES = 100
+MAX_LINE = 4096
+
+# 计数规则：Rust 测试（libtest）的 "test xxx ... ok/FAILED/ignored"，
+# libc-test 的 "PASS xxx" / "FAIL xxx"
+COUNT_RULES = [
+    (re.compile(rb'^test .* \.\.\. ok$'), 'passed'),
+    (re.compile(rb'^test .* \.\.\. FAILED$'), 'failed'),
+    (re.compile(rb'^test .* \.\.\. ignored'), 'skipped'),
+    (re.compile(rb'^PASS '), 'passed'),
+    (re.compile(rb'^FAIL '), 'failed'),
+]
+
+
+class OutputCapture:
+    """子进程输出的有界捕获"""
+
+    def __init__(self, log_path=None):
+        self.head = []
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+        self.lines = 0
+        self.counts = {'passed': 0, 'failed': 0, 'skipped': 0}
+        self.log_path = log_path
+        self._log = None
+        if log_path:
+            try:
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+                self._log = gzip.open(log_path, 'wb', compresslevel=1)
+            except OSError:
+                self.log_path = None
+
+    def feed(self, line):
+        if self._log:
+            self._log.write(line)
+        line = line.rstrip(b'\r\n')
+        for pattern, key in COUNT_RULES:
+            if pattern.match(line):
+                self.counts[key] += 1
+                break
+
+        line = line[:MAX_LINE]
+        self.lines += 1
+        if len(self.head) < HEAD_LINES:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+
+    def summary(self):
+        """开头与结尾的输出（中间省略的行数会注明）"""
+        lines = list(self.head)
+        omitted = self.lines - len(self.head) - len(self.tail)
+        if omitted > 0:
+            lines.append(f"... ({omitted} lines omitted, see {self.log_path or 'full log'}) ...".encode())
+        lines.extend(self.tail)
+        return b'\n'.join(lines).decode('utf-8', errors='replace')
+
+
+def capture_command(argv, timeout, log_path=None, cwd=None):
+    """运行命令并流式捕获输出（stdout 与 stderr 合并）
+
+    返回 (returncode, capture)，超时时 returncode 为 None。
+    """
+    capture = OutputCapture(log_path)
+    # 独立进程组：超时时连同孙进程一起结束，否则它们持有的管道会让读取一直阻塞
+    proc = subprocess.Popen(argv, cwd=cwd, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        for line in proc.stdout:
+            capture.feed(line)
+        returncode = proc.wait()
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+        capture.close()
+    return (None if timed_out.is_set() else returncode), capture
+
+
+def test_log_path(log_dir, name):
+    return os.path.join(log_dir, f"{name}.log.gz") if log_dir else None
+
+
+def captured_result(name, returncode, capture, duration, timeout):
+    """由捕获结果生成测试结果"""
+    result = {"name": name, "duration": duration, "counts": capture.counts,
+              "output": capture.summary()}
+    if capture.log_path:
+        result["log"] = capture.log_path
+    if returncode is None:
+        result["status"] = "fail"
+        result["output"] = f"Timeout ({timeout}s)\n" + result["output"]
+    else:
+        result["status"] = "pass" if returncode == 0 else "fail"
+    return result
 
 
 # ==================== 测试执行 ====================
-def run_rust_test(test_dir, test_config, verbose=False):
+def run_rust_test(test_dir, test_config, verbose=False, log_dir=None):
     """运行单个 Rust 测试"""
     name = test_config['name']
     rust_dir = Path(test_dir) / "rust-tests"
@@ -32,20 +193,15 @@ def run_rust_test(test_dir, test_config, verbose=False):
     
     try:
         start = time.time()
-        result = subprocess.run([str(binary)], capture_output=True, text=True, timeout=60)
+        returncode, capture = capture_command([str(binary)], 60, test_log_path(log_dir, name))
         duration = time.time() - start
         
-        status = "pass" if result.returncode == 0 else "fail"
-        output = result.stdout + result.stderr
-        
-        return {"name": name, "status": status, "duration": duration, "output": output}
-    except subprocess.TimeoutExpired:
-        return {"name": name, "status": "fail", "output": "Timeout (60s)"}
+        return captured_result(name, returncode, capture, duration, 60)
     except Exception as e:
         return {"name": name, "status": "error", "output": str(e)}
 
 
-def run_libc_test(test_dir, test_config, verbose=False):
+def run_libc_test(test_dir, test_config, verbose=False, log_dir=None):
     """运行 libc-test 模块"""
     name = test_config['name']
     module = test_config.get('module', 'functional')
@@ -60,26 +216,319 @@ def run_libc_test(test_dir, test_config, verbose=False):
     try:
         start = time.time()
         # 运行: ./run src/functional dynamic
-        result = subprocess.run(
+        returncode, capture = capture_command(
             [str(run_script), f"src/{module}", mode],
-            cwd=str(libc_dir),
-            capture_output=True,
-            text=True,
-            timeout=600
+            600,
+            test_log_path(log_dir, name),
+            cwd=str(libc_dir)
         )
         duration = time.time() - start
         
-        # 解析输出获取统计
-        output = result.stdout + result.stderr
-        status = "pass" if result.returncode == 0 else "fail"
-        
-        return {"name": name, "status": status, "duration": duration, "output": output}
-    except subprocess.TimeoutExpired:
-        return {"name": name, "status": "fail", "output": "Timeout (600s)"}
+        return captured_result(name, returncode, capture, duration, 600)
     except Exception as e:
         return {"name": name, "status": "error", "output": str(e)}
 
 
+def run_test(test_dir, test, verbose=False, log_dir=None):
+    """根据类型运行测试"""
+    test_type = test.get('type', 'rust')
+    if test_type == 'rust':
+        return run_rust_test(test_dir, test, verbose, log_dir)
+    elif test_type == 'libc':
+        return run_libc_test(test_dir, test, verbose, log_dir)
+    return {"name": test['name'], "status": "skip", "output": f"Unknown type: {test_type}"}
+
+
+# ==================== 并行调度 ====================
+# manifest 中每个测试可选的调度字段：
+#   cpus      = N        需要的 CPU 数（默认 1，超过 --jobs 时按 --jobs 计）
+#   exclusive = true     必须单独运行（如 multi_processors）
+#   serial    = "组名"   同组测试依次运行，不同组之间可以并行
+def test_cpus(test, jobs):
+    return max(1, min(int(test.get('cpus', 1)), jobs))
+
+
+def run_tests(tests, jobs, execute):
+    """在 jobs 个 CPU 的工作池上运行测试，按 manifest 顺序逐个返回 (test, result)
+
+    调度按 manifest 顺序进行，空闲 CPU 不足的测试可以被后面的测试越过；
+    独占测试不会被越过，它会等待正在运行的测试结束后单独运行。
+    """
+    results = [None] * len(tests)
+    pending = list(range(len(tests)))
+    done = queue.Queue()
+    free = jobs
+    running = 0
+    groups = set()
+    exclusive = False
+    next_out = 0
+
+    def worker(index):
+        try:
+            result = execute(tests[index])
+        except Exception as e:
+            result = {"name": tests[index]['name'], "status": "error", "output": str(e)}
+        done.put((index, result))
+
+    def launch(index):
+        pending.remove(index)
+        threading.Thread(target=worker, args=(index,), daemon=True).start()
+
+    while next_out < len(tests):
+        for index in list(pending):
+            test = tests[index]
+            if exclusive:
+                break
+            if test.get('exclusive'):
+                if running == 0:
+                    exclusive = True
+                    free -= jobs
+                    running += 1
+                    launch(index)
+                break
+            cpus = test_cpus(test, jobs)
+            group = test.get('serial')
+            if cpus > free or (group and group in groups):
+                continue
+            free -= cpus
+            running += 1
+            if group:
+                groups.add(group)
+            launch(index)
+
+        index, result = done.get()
+        test = tests[index]
+        running -= 1
+        if test.get('exclusive'):
+            exclusive = False
+            free += jobs
+        else:
+            free += test_cpus(test, jobs)
+            groups.discard(test.get('serial'))
+        results[index] = result
+
+        while next_out < len(tests) and results[next_out] is not None:
+            yield tests[next_out], results[next_out]
+            next_out += 1
+
+
+# ==================== 结果缓存 ====================
+# --incremental：以 (测试输入内容的哈希, /etc/starry-release 的 Build ID, manifest 条目)
+# 为键缓存结果，三者都没变且上次通过的测试直接报告缓存结果，不再执行
+DEFAULT_CACHE = "/var/cache/starry-tests/results.json"
+RELEASE_FILE = "/etc/starry-release"
+HASH_CHUNK = 1024 * 1024
+
+
+def read_build_id(path=RELEASE_FILE):
+    """读取 Build ID；旧镜像没有该字段时使用整个文件的哈希"""
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except OSError:
+        return "unknown"
+    for line in content.decode('utf-8', errors='replace').splitlines():
+        if line.startswith('Build ID:'):
+            return line.split(':', 1)[1].strip()
+    return hashlib.sha256(content).hexdigest()[:16]
+
+
+def test_inputs(test_dir, test):
+    """测试依赖的文件：Rust 测试为二进制本身，libc-test 为 run 脚本和模块目录"""
+    test_type = test.get('type', 'rust')
+    if test_type == 'rust':
+        return [Path(test_dir) / "rust-tests" / test['name']]
+    if test_type == 'libc':
+        libc_dir = Path(test_dir) / "libc-test"
+        module_dir = libc_dir / "src" / test.get('module', 'functional')
+        files = sorted(p for p in module_dir.rglob('*') if p.is_file()) if module_dir.is_dir() else []
+        return [libc_dir / "run"] + files
+    return []
+
+
+class ResultCache:
+    """持久化的测试结果缓存，同时记忆文件哈希（按 size/mtime 判断是否变化）"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {'version': 1, 'results': {}, 'digests': {}}
+        if path:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                if data.get('version') == 1:
+                    self.data = data
+            except (OSError, ValueError):
+                pass
+
+    def _file_digest(self, path):
+        st = path.stat()
+        memo = self.data['digests'].get(str(path))
+        if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            return memo[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(HASH_CHUNK)
+                if not data:
+                    break
+                sha.update(data)
+        digest = sha.hexdigest()
+        self.data['digests'][str(path)] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def digest(self, paths):
+        """多个文件合并的内容哈希；有文件不存在时返回 None"""
+        if not paths:
+            return None
+        sha = hashlib.sha256()
+        for path in paths:
+            if not path.exists():
+                return None
+            sha.update(f"{path.name}:{self._file_digest(path)}\n".encode())
+        return "sha256:" + sha.hexdigest()
+
+    @staticmethod
+    def key(digest, build_id, test):
+        return hashlib.sha256(json.dumps([digest, build_id, test], sort_keys=True).encode()).hexdigest()
+
+    def lookup(self, name, key):
+        entry = self.data['results'].get(name)
+        if entry and entry['key'] == key and entry['status'] == 'pass':
+            return entry
+        return None
+
+    def store(self, name, key, result):
+        self.data['results'][name] = {
+            'key': key,
+            'status': result['status'],
+            'duration': result.get('duration'),
+            'counts': result.get('counts'),
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Warning: cannot save result cache {self.path}: {e}", file=sys.stderr)
+
+
+# ==================== 结果输出 ====================
+class HumanReporter:
+    """默认的彩色文本输出"""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+
+    def start(self, suite_name, suite, tests, jobs):
+        print("=" * 50)
+        print(f"StarryOS Test Runner - Suite: {suite_name}")
+        print(f"Description: {suite.get('description', '')}")
+        if jobs > 1:
+            print(f"Jobs: {jobs}")
+        print("=" * 50)
+        print()
+
+    def result(self, number, result):
+        if result['status'] == 'pass':
+            status_str = "\033[32m✓ PASS\033[0m"
+        elif result['status'] == 'fail':
+            status_str = "\033[31m✗ FAIL\033[0m"
+        elif result['status'] == 'skip':
+            status_str = "\033[33m○ SKIP\033[0m"
+        else:
+            status_str = "\033[31m✗ ERROR\033[0m"
+        if result.get('cached'):
+            status_str += " (cached)"
+        
+        print(f"Running: {result['name']}")
+        print(f"  {status_str}")
+        
+        if self.verbose and result.get('output'):
+            for line in result['output'].splitlines()[:10]:
+                print(f"    {line}")
+            counts = result.get('counts')
+            if counts and any(counts.values()):
+                print(f"    cases: {counts['passed']} passed, {counts['failed']} failed, "
+                      f"{counts['skipped']} skipped")
+            if result.get('log'):
+                print(f"    log: {result['log']}")
+        print()
+
+    def finish(self, summary):
+        print("=" * 50)
+        print("Test Results Summary")
+        print("=" * 50)
+        print(f"Total:   {summary['total']}")
+        print(f"Passed:  \033[32m{summary['passed']}\033[0m")
+        print(f"Failed:  \033[31m{summary['failed']}\033[0m")
+        if summary['skipped'] > 0:
+            print(f"Skipped: \033[33m{summary['skipped']}\033[0m")
+        if summary['cached'] > 0:
+            print(f"Cached:  {summary['cached']}")
+        print("=" * 50)
+
+
+class TapReporter:
+    """TAP version 13 输出，每个测试附带 YAML 诊断块"""
+
+    def start(self, suite_name, suite, tests, jobs):
+        print("TAP version 13")
+        print(f"# StarryOS Test Runner - Suite: {suite_name}")
+        print(f"1..{len(tests)}", flush=True)
+
+    def result(self, number, result):
+        status = result['status']
+        line = f"{'ok' if status in ('pass', 'skip') else 'not ok'} {number} - {result['name']}"
+        if status == 'skip':
+            line += f" # SKIP {result.get('output', '').splitlines()[0] if result.get('output') else ''}"
+        print(line)
+        print("  ---")
+        print(f"  status: {status}")
+        if result.get('duration') is not None:
+            print(f"  duration_ms: {int(result['duration'] * 1000)}")
+        print(f"  digest: {result.get('digest') or '~'}")
+        print(f"  cached: {'true' if result.get('cached') else 'false'}")
+        if status in ('fail', 'error') and result.get('output'):
+            print("  output: |")
+            for out in result['output'].splitlines():
+                print(f"    {out}")
+        print("  ...", flush=True)
+
+    def finish(self, summary):
+        print(f"# total {summary['total']}, passed {summary['passed']}, "
+              f"failed {summary['failed']}, skipped {summary['skipped']}, cached {summary['cached']}")
+
+
+class JsonReporter:
+    """结束时输出一个 JSON 文档"""
+
+    def __init__(self, build_id):
+        self.build_id = build_id
+        self.results = []
+
+    def start(self, suite_name, suite, tests, jobs):
+        self.suite = suite_name
+
+    def result(self, number, result):
+        entry = {key: result.get(key) for key in ('name', 'status', 'duration', 'digest', 'counts', 'log')}
+        entry['cached'] = bool(result.get('cached'))
+        if result['status'] in ('fail', 'error'):
+            entry['output'] = result.get('output')
+        self.results.append(entry)
+
+    def finish(self, summary):
+        json.dump({'suite': self.suite, 'build_id': self.build_id,
+                   'summary': summary, 'tests': self.results}, sys.stdout, indent=2)
+        print()
+
+
 # ==================== 主程序 ====================
 def main():
     parser = argparse.ArgumentParser(description='StarryOS Test Runner')
@@ -88,22 +537,23 @@ def main():
     parser.add_argument('--test-dir', default=DEFAULT_TEST_DIR, help='Test directory')
     parser.add_argument('--format', choices=['human', 'tap', 'json'], default='human')
     parser.add_argument('--verbose', '-v', action='store_true')
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR,
+                        help='Directory for full per-test logs (empty to disable)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of CPUs to run tests on concurrently (0 = all CPUs)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Report unchanged passing tests from the result cache')
+    parser.add_argument('--cache', default=DEFAULT_CACHE, help='Result cache file')
     args = parser.parse_args()
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
     
     # 加载 manifest
     if not os.path.exists(args.manifest):
         print(f"Error: Manifest not found: {args.manifest}", file=sys.stderr)
         sys.exit(1)
     
-    with open(args.manifest) as f:
-        manifest = toml.load(f)
-    
     # 查找测试套件
-    suite = None
-    for ts in manifest.get('test_suite', []):
-        if ts.get('name') == args.suite:
-            suite = ts
-            break
+    suite = load_suites(args.manifest).get(args.suite)
     
     if not suite:
         print(f"Error: Suite '{args.suite}' not found", file=sys.stderr)
@@ -113,64 +563,56 @@ def main():
         print(f"Suite '{args.suite}' is disabled", file=sys.stderr)
         sys.exit(0)
     
-    # 输出头部
-    print("=" * 50)
-    print(f"StarryOS Test Runner - Suite: {args.suite}")
-    print(f"Description: {suite.get('description', '')}")
-    print("=" * 50)
-    print()
+    build_id = read_build_id()
+    if args.format == 'tap':
+        reporter = TapReporter()
+    elif args.format == 'json':
+        reporter = JsonReporter(build_id)
+    else:
+        reporter = HumanReporter(args.verbose)
     
     # 运行测试
     tests = suite.get('tests', [])
-    total, passed, failed, skipped = 0, 0, 0, 0
+    reporter.start(args.suite, suite, tests, jobs)
+    summary = {'total': 0, 'passed': 0, 'failed': 0, 'skipped': 0, 'cached': 0}
+    log_dir = os.path.join(args.results_dir, args.suite) if args.results_dir else None
+    cache = ResultCache(args.cache if args.incremental else None)
+    # 文本输出且非增量模式时不需要摘要，省去哈希计算
+    need_digest = args.incremental or args.format != 'human'
     
-    for test in tests:
-        total += 1
-        test_type = test.get('type', 'rust')
-        
-        # 根据类型运行测试
-        if test_type == 'rust':
-            result = run_rust_test(args.test_dir, test, args.verbose)
-        elif test_type == 'libc':
-            result = run_libc_test(args.test_dir, test, args.verbose)
-        else:
-            result = {"name": test['name'], "status": "skip", "output": f"Unknown type: {test_type}"}
+    def execute(test):
+        digest = cache.digest(test_inputs(args.test_dir, test)) if need_digest else None
+        key = ResultCache.key(digest, build_id, test)
+        if args.incremental and digest:
+            entry = cache.lookup(test['name'], key)
+            if entry:
+                return {"name": test['name'], "status": entry['status'], "digest": digest,
+                        "duration": entry['duration'], "counts": entry['counts'], "cached": True}
+        result = run_test(args.test_dir, test, args.verbose, log_dir)
+        result['digest'] = digest
+        if args.incremental and digest:
+            cache.store(test['name'], key, result)
+        return result
+    
+    for test, result in run_tests(tests, jobs, execute):
+        summary['total'] += 1
         
         # 统计
         if result['status'] == 'pass':
-            passed += 1
-            status_str = "\033[32m✓ PASS\033[0m"
-        elif result['status'] == 'fail':
-            failed += 1
-            status_str = "\033[31m✗ FAIL\033[0m"
+            summary['passed'] += 1
         elif result['status'] == 'skip':
-            skipped += 1
-            status_str = "\033[33m○ SKIP\033[0m"
+            summary['skipped'] += 1
         else:
-            failed += 1
-            status_str = "\033[31m✗ ERROR\033[0m"
+            summary['failed'] += 1
+        if result.get('cached'):
+            summary['cached'] += 1
         
-        # 输出结果
-        print(f"Running: {result['name']}")
-        print(f"  {status_str}")
-        
-        if args.verbose and result.get('output'):
-            for line in result['output'].splitlines()[:10]:
-                print(f"    {line}")
-        print()
+        reporter.result(summary['total'], result)
+    
+    cache.save()
+    reporter.finish(summary)
     
-    # 输出统计
-    print("=" * 50)
-    print("Test Results Summary")
-    print("=" * 50)
-    print(f"Total:   {total}")
-    print(f"Passed:  \033[32m{passed}\033[0m")
-    print(f"Failed:  \033[31m{failed}\033[0m")
-    if skipped > 0:
-        print(f"Skipped: \033[33m{skipped}\033[0m")
-    print("=" * 50)
-    
-    sys.exit(0 if failed == 0 else 1)
+    sys.exit(0 if summary['failed'] == 0 else 1)
 
 
 if __name__ == '__main__':
@@ -5,73 +5,777 @@
  * 1. 监听 vsock 端口 5555
  * 2. 接收 OEQA 发送的命令
  * 3. 执行命令并返回输出和退出码
+ * 4. 每个连接由独立子进程处理，可同时服务多个连接（-m 设置上限）
+ * 5. 开始监听后主动连接宿主机（CID 2）的就绪端口，通知 OEQA 服务已可用
+ *
+ * 就绪通知（-r 设置端口，0 表示关闭）：
+ * - 服务连接 CID=2 PORT=<ready_port>，发送 "READY <cid> <port> <uptime_ms>\n" 后关闭
+ * - 宿主机未监听时连接失败，服务照常运行，OEQA 会退回到主动探测
  * 
- * 协议：
+ * 协议（短连接模式）：
  * - 宿主机发送: "命令\n"
  * - 服务返回: "输出内容\nEXIT_CODE: N\n"
+ *
+ * 协议（会话模式，一条连接执行多条命令）：
+ * - 宿主机发送握手行 "@session 1\n"，服务返回 "SESSION OK 1\n"
+ * - 之后双方交换帧：[req_id:u32][type:u8][length:u32] + payload（网络字节序）
+ *   FRAME_EXEC  宿主机 -> 服务: payload 为命令
+ *   FRAME_DATA  服务 -> 宿主机: 命令输出片段（流式发送）
+ *   FRAME_EXIT  服务 -> 宿主机: payload 为 int32 退出码
+ * - 宿主机可以连续发送多个请求（流水线），服务按顺序执行并以 req_id 应答
+ *
+ * 协议（文件传输模式，用于 copyTo/copyFrom）：
+ * - 宿主机发送握手行 "@xfer 1\n"，服务返回 "XFER OK 1\n"
+ * - 之后每个请求为一行文本，文件内容紧随其后：
+ *   STAT <path>                          -> "F <mode> <size>" | "D <mode>" | "ERR <msg>"
+ *   LIST <dir>                           -> 若干 "D <mode> <rel>" / "F <mode> <size> <rel>"，以 "END" 结尾
+ *   MKDIR <mode> <path>                  -> "OK" | "ERR <msg>"
+ *   PUT <mode> <size> <crc32> <z|-> <path> + 内容  -> "OK <crc32>" | "ERR <msg>"
+ *   GET <z|-> <path>                     -> "FILE <mode> <size> <z|->" + 内容 + "END <crc32>"
+ *                                           | "ERR <msg>"
+ * - 内容编码："-" 为 size 字节原始数据；"z" 为若干 [len:u32][zlib 数据] 分块，len=0 结束
+ * - crc32 为未压缩内容的校验值，PUT 先写临时文件，校验通过后才 rename 到目标路径
  */
 
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <stdint.h>
 #include <unistd.h>
 #include <errno.h>
+#include <fcntl.h>
 #include <sys/socket.h>
+#include <sys/wait.h>
+#include <sys/stat.h>
+#include <dirent.h>
+#include <limits.h>
+#include <stdarg.h>
+#include <arpa/inet.h>
 #include <linux/vm_sockets.h>
+#include <zlib.h>
 
 #define VSOCK_PORT 5555
 #define BUFFER_SIZE 4096
+#define DEFAULT_MAX_CLIENTS 8
+#define DEFAULT_READY_PORT 5556
 
-/* 执行命令并捕获输出 */
-int execute_command(const char *command, char *output, size_t output_size) {
-    FILE *fp;
-    char buffer[1024];
+/* 会话模式 */
+#define SESSION_HELLO "@session 1"
+#define SESSION_ACK "SESSION OK 1\n"
+#define FRAME_HDR_SIZE 9
+#define FRAME_EXEC 1
+#define FRAME_DATA 2
+#define FRAME_EXIT 3
+#define MAX_COMMAND_SIZE (1024 * 1024)
+
+/* 文件传输模式 */
+#define XFER_HELLO "@xfer 1"
+#define XFER_ACK "XFER OK 1\n"
+#define XFER_CHUNK (256 * 1024)
+#define XFER_LINE_SIZE (PATH_MAX + 128)
+
+/* 带缓冲的连接读取器（握手行之后可能紧跟流水线请求）*/
+struct conn {
+    int fd;
+    char buf[BUFFER_SIZE];
+    size_t pos;
+    size_t len;
+};
+
+static int conn_fill(struct conn *c) {
+    ssize_t n;
+
+    do {
+        n = recv(c->fd, c->buf, sizeof(c->buf), 0);
+    } while (n < 0 && errno == EINTR);
+    if (n <= 0) {
+        return (int)n;
+    }
+    c->pos = 0;
+    c->len = (size_t)n;
+    return 1;
+}
+
+/* 读取恰好 size 字节，成功返回 1，对端关闭返回 0，出错返回 -1 */
+static int conn_read_exact(struct conn *c, void *dst, size_t size) {
+    char *out = dst;
+
+    while (size > 0) {
+        if (c->pos == c->len) {
+            int ret = conn_fill(c);
+            if (ret <= 0) {
+                return ret;
+            }
+        }
+        size_t take = c->len - c->pos;
+        if (take > size) {
+            take = size;
+        }
+        memcpy(out, c->buf + c->pos, take);
+        c->pos += take;
+        out += take;
+        size -= take;
+    }
+    return 1;
+}
+
+/* 读取一行（不含换行符），返回读到的字节数，对端关闭且无数据返回 0 */
+static ssize_t conn_read_line(struct conn *c, char *dst, size_t size) {
     size_t offset = 0;
-    int exit_code = 0;
+
+    while (offset < size - 1) {
+        if (c->pos == c->len) {
+            int ret = conn_fill(c);
+            if (ret < 0) {
+                return -1;
+            }
+            if (ret == 0) {
+                break;
+            }
+        }
+        char ch = c->buf[c->pos++];
+        if (ch == '\n') {
+            break;
+        }
+        dst[offset++] = ch;
+    }
+    dst[offset] = '\0';
+    return (ssize_t)offset;
+}
+
+/* 读取最多 size 字节：优先取缓冲区中的数据，缓冲区为空时直接 recv 到 dst */
+static ssize_t conn_read_some(struct conn *c, void *dst, size_t size) {
+    ssize_t n;
+
+    if (c->pos < c->len) {
+        size_t take = c->len - c->pos;
+        if (take > size) {
+            take = size;
+        }
+        memcpy(dst, c->buf + c->pos, take);
+        c->pos += take;
+        return (ssize_t)take;
+    }
+    do {
+        n = recv(c->fd, dst, size, 0);
+    } while (n < 0 && errno == EINTR);
+    return n;
+}
+
+/* 发送全部数据；MSG_NOSIGNAL 避免宿主机断开时 SIGPIPE 杀死服务 */
+static int send_all(int fd, const void *buf, size_t len) {
+    const char *p = buf;
+
+    while (len > 0) {
+        ssize_t sent = send(fd, p, len, MSG_NOSIGNAL);
+        if (sent < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            return -1;
+        }
+        p += sent;
+        len -= (size_t)sent;
+    }
+    return 0;
+}
+
+static void put_frame_header(char *hdr, uint32_t req_id, uint8_t type, uint32_t len) {
+    uint32_t be_id = htonl(req_id);
+    uint32_t be_len = htonl(len);
+
+    memcpy(hdr, &be_id, 4);
+    hdr[4] = (char)type;
+    memcpy(hdr + 5, &be_len, 4);
+}
+
+static int exit_status_of(int status) {
+    if (status != -1 && WIFEXITED(status)) {
+        return WEXITSTATUS(status);
+    }
+    return 127;
+}
+
+/* 短连接模式：执行命令，输出边读边发送，最后发送 "EXIT_CODE: N\n"
+ * （不再缓存整段输出，长输出不会被截断）*/
+static int execute_command(int fd, const char *command) {
+    char buffer[BUFFER_SIZE];
+    char trailer[64];
+    int exit_code;
+    FILE *fp;
     
     /* 使用 popen 执行命令 */
     fp = popen(command, "r");
     if (fp == NULL) {
-        snprintf(output, output_size, "ERROR: Failed to execute command\n");
-        return 127;
+        const char *msg = "ERROR: Failed to execute command\n";
+        send_all(fd, msg, strlen(msg));
+        exit_code = 127;
+    } else {
+        int out_fd = fileno(fp);
+        ssize_t n;
+
+        /* 读取输出并立即转发 */
+        for (;;) {
+            n = read(out_fd, buffer, sizeof(buffer));
+            if (n < 0 && errno == EINTR) {
+                continue;
+            }
+            if (n <= 0) {
+                break;
+            }
+            if (send_all(fd, buffer, (size_t)n) < 0) {
+                perror("[vsock-server] send failed");
+                break;
+            }
+        }
+
+        /* 获取退出码 */
+        exit_code = exit_status_of(pclose(fp));
     }
-    
-    /* 读取输出 */
-    while (fgets(buffer, sizeof(buffer), fp) != NULL && offset < output_size - 1) {
-        size_t len = strlen(buffer);
-        if (offset + len < output_size) {
-            memcpy(output + offset, buffer, len);
-            offset += len;
+
+    snprintf(trailer, sizeof(trailer), "EXIT_CODE: %d\n", exit_code);
+    if (send_all(fd, trailer, strlen(trailer)) < 0) {
+        perror("[vsock-server] send failed");
+    }
+    return exit_code;
+}
+
+/* 会话模式：执行命令，输出以 FRAME_DATA 流式发送，最后发送 FRAME_EXIT */
+static int session_execute(int fd, uint32_t req_id, const char *command) {
+    char frame[FRAME_HDR_SIZE + BUFFER_SIZE];
+    char exit_frame[FRAME_HDR_SIZE + 4];
+    int send_failed = 0;
+    int exit_code;
+    FILE *fp;
+
+    printf("[vsock-server] Executing #%u: %s\n", req_id, command);
+
+    fp = popen(command, "r");
+    if (fp == NULL) {
+        const char *msg = "ERROR: Failed to execute command\n";
+        size_t len = strlen(msg);
+        put_frame_header(frame, req_id, FRAME_DATA, (uint32_t)len);
+        memcpy(frame + FRAME_HDR_SIZE, msg, len);
+        send_failed = send_all(fd, frame, FRAME_HDR_SIZE + len) < 0;
+        exit_code = 127;
+    } else {
+        int out_fd = fileno(fp);
+        ssize_t n;
+
+        for (;;) {
+            n = read(out_fd, frame + FRAME_HDR_SIZE, BUFFER_SIZE);
+            if (n < 0 && errno == EINTR) {
+                continue;
+            }
+            if (n <= 0) {
+                break;
+            }
+            put_frame_header(frame, req_id, FRAME_DATA, (uint32_t)n);
+            if (send_all(fd, frame, FRAME_HDR_SIZE + (size_t)n) < 0) {
+                /* 宿主机已断开：停止读取，pclose 关闭管道后子进程收到 SIGPIPE */
+                send_failed = 1;
+                break;
+            }
         }
+        exit_code = exit_status_of(pclose(fp));
     }
-    output[offset] = '\0';
-    
-    /* 获取退出码 */
-    exit_code = pclose(fp);
-    if (WIFEXITED(exit_code)) {
-        exit_code = WEXITSTATUS(exit_code);
+
+    if (send_failed) {
+        perror("[vsock-server] send failed");
+        return -1;
+    }
+
+    uint32_t be_code = htonl((uint32_t)exit_code);
+    put_frame_header(exit_frame, req_id, FRAME_EXIT, 4);
+    memcpy(exit_frame + FRAME_HDR_SIZE, &be_code, 4);
+    if (send_all(fd, exit_frame, sizeof(exit_frame)) < 0) {
+        perror("[vsock-server] send failed");
+        return -1;
+    }
+
+    printf("[vsock-server] Command #%u completed (exit code: %d)\n", req_id, exit_code);
+    return 0;
+}
+
+/* 会话模式主循环：连接保持打开，直到宿主机关闭或协议出错 */
+static void handle_session(struct conn *c) {
+    char hdr[FRAME_HDR_SIZE];
+    uint32_t req_id, len;
+    uint8_t type;
+
+    if (send_all(c->fd, SESSION_ACK, strlen(SESSION_ACK)) < 0) {
+        perror("[vsock-server] send failed");
+        return;
+    }
+    printf("[vsock-server] Session established\n");
+
+    for (;;) {
+        int ret = conn_read_exact(c, hdr, sizeof(hdr));
+        if (ret <= 0) {
+            if (ret < 0) {
+                perror("[vsock-server] recv failed");
+            }
+            break;
+        }
+
+        memcpy(&req_id, hdr, 4);
+        req_id = ntohl(req_id);
+        type = (uint8_t)hdr[4];
+        memcpy(&len, hdr + 5, 4);
+        len = ntohl(len);
+
+        if (len > MAX_COMMAND_SIZE) {
+            fprintf(stderr, "[vsock-server] Frame too large (%u bytes), closing session\n", len);
+            break;
+        }
+
+        char *payload = malloc(len + 1);
+        if (payload == NULL) {
+            perror("[vsock-server] malloc failed");
+            break;
+        }
+        if (len > 0 && conn_read_exact(c, payload, len) <= 0) {
+            free(payload);
+            break;
+        }
+        payload[len] = '\0';
+
+        if (type != FRAME_EXEC) {
+            fprintf(stderr, "[vsock-server] Unknown frame type %u, closing session\n", type);
+            free(payload);
+            break;
+        }
+
+        ret = session_execute(c->fd, req_id, payload);
+        free(payload);
+        if (ret < 0) {
+            break;
+        }
+    }
+
+    printf("[vsock-server] Session closed\n");
+}
+
+/* ==================== 文件传输模式 ==================== */
+
+static char xfer_in[XFER_CHUNK];
+static char xfer_out[XFER_CHUNK];
+
+static int send_line(int fd, const char *fmt, ...) {
+    char line[XFER_LINE_SIZE];
+    va_list ap;
+    int len;
+
+    va_start(ap, fmt);
+    len = vsnprintf(line, sizeof(line) - 1, fmt, ap);
+    va_end(ap);
+    if (len < 0) {
+        return -1;
+    }
+    if ((size_t)len > sizeof(line) - 2) {
+        len = (int)sizeof(line) - 2;
+    }
+    line[len++] = '\n';
+    return send_all(fd, line, (size_t)len);
+}
+
+static int write_all(int fd, const char *buf, size_t len) {
+    while (len > 0) {
+        ssize_t n = write(fd, buf, len);
+        if (n < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            return -1;
+        }
+        buf += n;
+        len -= (size_t)n;
+    }
+    return 0;
+}
+
+static int send_chunk(int fd, const char *data, uint32_t len) {
+    uint32_t be_len = htonl(len);
+
+    if (send_all(fd, &be_len, 4) < 0) {
+        return -1;
+    }
+    return len ? send_all(fd, data, len) : 0;
+}
+
+static int xfer_stat(int fd, const char *path) {
+    struct stat st;
+
+    if (stat(path, &st) < 0) {
+        return send_line(fd, "ERR %s", strerror(errno));
+    }
+    if (S_ISDIR(st.st_mode)) {
+        return send_line(fd, "D %o", (unsigned)(st.st_mode & 07777));
+    }
+    if (S_ISREG(st.st_mode)) {
+        return send_line(fd, "F %o %llu", (unsigned)(st.st_mode & 07777),
+                         (unsigned long long)st.st_size);
+    }
+    return send_line(fd, "ERR not a regular file or directory");
+}
+
+/* 递归列出目录；path 为绝对路径缓冲区，rel_off 为相对路径在 path 中的起始位置 */
+static int xfer_list_dir(int fd, char *path, size_t rel_off) {
+    size_t base_len = strlen(path);
+    struct dirent *ent;
+    struct stat st;
+    DIR *dir;
+    int ret = 0;
+
+    dir = opendir(path);
+    if (dir == NULL) {
+        return 0;
+    }
+    while (ret == 0 && (ent = readdir(dir)) != NULL) {
+        if (strcmp(ent->d_name, ".") == 0 || strcmp(ent->d_name, "..") == 0) {
+            continue;
+        }
+        if (base_len + 1 + strlen(ent->d_name) >= PATH_MAX) {
+            continue;
+        }
+        snprintf(path + base_len, PATH_MAX - base_len, "/%s", ent->d_name);
+        if (lstat(path, &st) < 0) {
+            continue;
+        }
+        /* 符号链接和特殊文件不传输 */
+        if (S_ISDIR(st.st_mode)) {
+            ret = send_line(fd, "D %o %s", (unsigned)(st.st_mode & 07777), path + rel_off);
+            if (ret == 0) {
+                ret = xfer_list_dir(fd, path, rel_off);
+            }
+        } else if (S_ISREG(st.st_mode)) {
+            ret = send_line(fd, "F %o %llu %s", (unsigned)(st.st_mode & 07777),
+                            (unsigned long long)st.st_size, path + rel_off);
+        }
+        path[base_len] = '\0';
+    }
+    closedir(dir);
+    return ret;
+}
+
+static int xfer_list(int fd, const char *root) {
+    char path[PATH_MAX];
+    size_t len = strlen(root);
+
+    if (len == 0 || len >= PATH_MAX - 1) {
+        return send_line(fd, "ERR invalid path");
+    }
+    memcpy(path, root, len + 1);
+    while (len > 1 && path[len - 1] == '/') {
+        path[--len] = '\0';
+    }
+    if (xfer_list_dir(fd, path, len + 1) < 0) {
+        return -1;
+    }
+    return send_line(fd, "END");
+}
+
+static int xfer_mkdir(int fd, char *args) {
+    unsigned mode;
+    int off = 0;
+    struct stat st;
+
+    if (sscanf(args, "%o %n", &mode, &off) < 1 || off == 0) {
+        return send_line(fd, "ERR bad MKDIR request");
+    }
+    if (mkdir(args + off, mode) < 0) {
+        if (errno != EEXIST || stat(args + off, &st) < 0 || !S_ISDIR(st.st_mode)) {
+            return send_line(fd, "ERR %s", strerror(errno));
+        }
+    }
+    chmod(args + off, mode);
+    return send_line(fd, "OK");
+}
+
+/* 接收文件：无论本地写入是否出错都要读完内容，保持请求流同步。
+ * 返回 -1 表示连接已不可用 */
+static int xfer_put(struct conn *c, char *args) {
+    unsigned mode;
+    unsigned long long size, received = 0;
+    unsigned long crc_expect;
+    char enc;
+    int off = 0;
+    char tmp[PATH_MAX];
+    const char *path;
+    const char *err = NULL;
+    uLong crc = crc32(0L, Z_NULL, 0);
+    int out_fd;
+
+    if (sscanf(args, "%o %llu %lx %c %n", &mode, &size, &crc_expect, &enc, &off) < 4 || off == 0 ||
+        (enc != '-' && enc != 'z')) {
+        /* 无法得知内容长度，只能断开连接 */
+        send_line(c->fd, "ERR bad PUT request");
+        return -1;
+    }
+    path = args + off;
+    if ((size_t)snprintf(tmp, sizeof(tmp), "%s.xfer-tmp", path) >= sizeof(tmp)) {
+        err = "path too long";
+        out_fd = -1;
     } else {
-        exit_code = 127;
+        out_fd = open(tmp, O_WRONLY | O_CREAT | O_TRUNC, 0600);
+        if (out_fd < 0) {
+            err = strerror(errno);
+        }
     }
-    
-    return exit_code;
+
+    if (enc == '-') {
+        while (received < size) {
+            size_t want = size - received < XFER_CHUNK ? (size_t)(size - received) : XFER_CHUNK;
+            ssize_t n = conn_read_some(c, xfer_in, want);
+            if (n <= 0) {
+                goto broken;
+            }
+            crc = crc32(crc, (const Bytef *)xfer_in, (uInt)n);
+            if (out_fd >= 0 && !err && write_all(out_fd, xfer_in, (size_t)n) < 0) {
+                err = strerror(errno);
+            }
+            received += (unsigned long long)n;
+        }
+    } else {
+        z_stream zs;
+        int zret = Z_OK;
+
+        memset(&zs, 0, sizeof(zs));
+        if (inflateInit(&zs) != Z_OK) {
+            goto broken;
+        }
+        for (;;) {
+            uint32_t len;
+
+            if (conn_read_exact(c, &len, 4) <= 0) {
+                inflateEnd(&zs);
+                goto broken;
+            }
+            len = ntohl(len);
+            if (len == 0) {
+                break;
+            }
+            if (len > XFER_CHUNK || conn_read_exact(c, xfer_in, len) <= 0) {
+                inflateEnd(&zs);
+                goto broken;
+            }
+            if (zret == Z_STREAM_END) {
+                continue;
+            }
+            zs.next_in = (Bytef *)xfer_in;
+            zs.avail_in = len;
+            do {
+                zs.next_out = (Bytef *)xfer_out;
+                zs.avail_out = XFER_CHUNK;
+                zret = inflate(&zs, Z_NO_FLUSH);
+                if (zret != Z_OK && zret != Z_STREAM_END && zret != Z_BUF_ERROR) {
+                    if (!err) {
+                        err = "corrupt compressed data";
+                    }
+                    zs.avail_in = 0;
+                    break;
+                }
+                size_t have = XFER_CHUNK - zs.avail_out;
+                crc = crc32(crc, (const Bytef *)xfer_out, (uInt)have);
+                if (out_fd >= 0 && !err && write_all(out_fd, xfer_out, have) < 0) {
+                    err = strerror(errno);
+                }
+                received += have;
+            } while (zs.avail_out == 0 && zret != Z_STREAM_END);
+        }
+        inflateEnd(&zs);
+    }
+
+    if (!err && received != size) {
+        err = "size mismatch";
+    }
+    if (!err && crc != crc_expect) {
+        err = "checksum mismatch";
+    }
+    if (out_fd >= 0) {
+        if (!err && fchmod(out_fd, mode) < 0) {
+            err = strerror(errno);
+        }
+        if (close(out_fd) < 0 && !err) {
+            err = strerror(errno);
+        }
+        if (!err && rename(tmp, path) < 0) {
+            err = strerror(errno);
+        }
+        if (err) {
+            unlink(tmp);
+        }
+    }
+    if (err) {
+        return send_line(c->fd, "ERR %s", err);
+    }
+    return send_line(c->fd, "OK %08lx", (unsigned long)crc);
+
+broken:
+    if (out_fd >= 0) {
+        close(out_fd);
+        unlink(tmp);
+    }
+    return -1;
 }
 
-/* 处理客户端连接（短连接模式：每次连接只处理一个命令）*/
+/* 发送文件；读取出错时用 0 补齐声明的长度，以 "ERR" 代替 "END" 结尾 */
+static int xfer_get(int fd, char *args) {
+    unsigned long long size, sent = 0;
+    uLong crc = crc32(0L, Z_NULL, 0);
+    const char *err = NULL;
+    struct stat st;
+    char enc = args[0];
+    const char *path;
+    int in_fd;
+
+    if ((enc != '-' && enc != 'z') || args[1] != ' ') {
+        return send_line(fd, "ERR bad GET request");
+    }
+    path = args + 2;
+    in_fd = open(path, O_RDONLY);
+    if (in_fd < 0) {
+        return send_line(fd, "ERR %s", strerror(errno));
+    }
+    if (fstat(in_fd, &st) < 0 || !S_ISREG(st.st_mode)) {
+        close(in_fd);
+        return send_line(fd, "ERR not a regular file");
+    }
+    size = (unsigned long long)st.st_size;
+    if (send_line(fd, "FILE %o %llu %c", (unsigned)(st.st_mode & 07777), size, enc) < 0) {
+        close(in_fd);
+        return -1;
+    }
+
+    if (enc == '-') {
+        while (sent < size) {
+            size_t want = size - sent < XFER_CHUNK ? (size_t)(size - sent) : XFER_CHUNK;
+            ssize_t n = err ? 0 : read(in_fd, xfer_in, want);
+            if (n < 0 && errno == EINTR) {
+                continue;
+            }
+            if (n <= 0) {
+                if (!err) {
+                    err = n < 0 ? strerror(errno) : "file shrank while reading";
+                }
+                memset(xfer_in, 0, want);
+                n = (ssize_t)want;
+            } else {
+                crc = crc32(crc, (const Bytef *)xfer_in, (uInt)n);
+            }
+            if (send_all(fd, xfer_in, (size_t)n) < 0) {
+                close(in_fd);
+                return -1;
+            }
+            sent += (unsigned long long)n;
+        }
+    } else {
+        z_stream zs;
+        int flush;
+
+        memset(&zs, 0, sizeof(zs));
+        if (deflateInit(&zs, 1) != Z_OK) {
+            close(in_fd);
+            return -1;
+        }
+        do {
+            size_t want = size - sent < XFER_CHUNK ? (size_t)(size - sent) : XFER_CHUNK;
+            ssize_t n = 0;
+
+            if (want > 0) {
+                do {
+                    n = read(in_fd, xfer_in, want);
+                } while (n < 0 && errno == EINTR);
+                if (n <= 0) {
+                    err = n < 0 ? strerror(errno) : "file shrank while reading";
+                    n = 0;
+                }
+            }
+            crc = crc32(crc, (const Bytef *)xfer_in, (uInt)n);
+            sent += (unsigned long long)n;
+            flush = (sent >= size || err) ? Z_FINISH : Z_NO_FLUSH;
+            zs.next_in = (Bytef *)xfer_in;
+            zs.avail_in = (uInt)n;
+            do {
+                zs.next_out = (Bytef *)xfer_out;
+                zs.avail_out = XFER_CHUNK;
+                deflate(&zs, flush);
+                uint32_t have = XFER_CHUNK - zs.avail_out;
+                if (have && send_chunk(fd, xfer_out, have) < 0) {
+                    deflateEnd(&zs);
+                    close(in_fd);
+                    return -1;
+                }
+            } while (zs.avail_out == 0);
+        } while (flush != Z_FINISH);
+        deflateEnd(&zs);
+        if (send_chunk(fd, NULL, 0) < 0) {
+            close(in_fd);
+            return -1;
+        }
+    }
+    close(in_fd);
+
+    if (err) {
+        return send_line(fd, "ERR %s", err);
+    }
+    return send_line(fd, "END %08lx", (unsigned long)crc);
+}
+
+/* 文件传输主循环：按行读取请求，直到宿主机关闭连接 */
+static void handle_transfer(struct conn *c) {
+    char line[XFER_LINE_SIZE];
+    ssize_t n;
+    int ret;
+
+    if (send_all(c->fd, XFER_ACK, strlen(XFER_ACK)) < 0) {
+        perror("[vsock-server] send failed");
+        return;
+    }
+    printf("[vsock-server] Transfer session established\n");
+
+    for (;;) {
+        n = conn_read_line(c, line, sizeof(line));
+        if (n <= 0) {
+            break;
+        }
+        if (strncmp(line, "PUT ", 4) == 0) {
+            ret = xfer_put(c, line + 4);
+        } else if (strncmp(line, "GET ", 4) == 0) {
+            ret = xfer_get(c->fd, line + 4);
+        } else if (strncmp(line, "STAT ", 5) == 0) {
+            ret = xfer_stat(c->fd, line + 5);
+        } else if (strncmp(line, "LIST ", 5) == 0) {
+            ret = xfer_list(c->fd, line + 5);
+        } else if (strncmp(line, "MKDIR ", 6) == 0) {
+            ret = xfer_mkdir(c->fd, line + 6);
+        } else {
+            ret = send_line(c->fd, "ERR unknown request");
+        }
+        if (ret < 0) {
+            break;
+        }
+    }
+
+    printf("[vsock-server] Transfer session closed\n");
+}
+
+/* 处理客户端连接（短连接模式：每次连接只处理一个命令；握手后进入会话模式）*/
 void handle_client(int client_fd) {
+    struct conn c = { .fd = client_fd, .pos = 0, .len = 0 };
     char recv_buffer[BUFFER_SIZE];
-    char output_buffer[BUFFER_SIZE * 4];
-    char response[BUFFER_SIZE * 4 + 64];
     ssize_t n;
     int exit_code;
     
     printf("[vsock-server] Client connected\n");
+
+    /* popen 的子进程不应继承客户端连接 */
+    fcntl(client_fd, F_SETFD, FD_CLOEXEC);
     
-    /* 接收命令 */
-    memset(recv_buffer, 0, sizeof(recv_buffer));
-    n = recv(client_fd, recv_buffer, sizeof(recv_buffer) - 1, 0);
+    /* 接收命令（第一行）*/
+    n = conn_read_line(&c, recv_buffer, sizeof(recv_buffer));
     
-    if (n <= 0) {
+    if (n < 0 || (n == 0 && c.len == 0)) {
         if (n < 0) {
             perror("[vsock-server] recv failed");
         } else {
@@ -80,52 +784,40 @@ void handle_client(int client_fd) {
         close(client_fd);
         return;
     }
-    
-    recv_buffer[n] = '\0';
-    
-    /* 移除换行符 */
-    char *newline = strchr(recv_buffer, '\n');
-    if (newline) {
-        *newline = '\0';
+
+    /* 会话模式握手 */
+    if (strcmp(recv_buffer, SESSION_HELLO) == 0) {
+        handle_session(&c);
+        close(client_fd);
+        return;
+    }
+
+    /* 文件传输模式握手 */
+    if (strcmp(recv_buffer, XFER_HELLO) == 0) {
+        handle_transfer(&c);
+        close(client_fd);
+        return;
     }
     
     /* 处理特殊命令 */
     if (strcmp(recv_buffer, "QUIT") == 0 || strcmp(recv_buffer, "EXIT") == 0) {
         const char *msg = "OK\nEXIT_CODE: 0\n";
-        send(client_fd, msg, strlen(msg), 0);
+        send_all(client_fd, msg, strlen(msg));
         close(client_fd);
         return;
     }
     
     if (strlen(recv_buffer) == 0) {
         const char *msg = "EXIT_CODE: 0\n";
-        send(client_fd, msg, strlen(msg), 0);
+        send_all(client_fd, msg, strlen(msg));
         close(client_fd);
         return;
     }
     
     printf("[vsock-server] Executing: %s\n", recv_buffer);
     
-    /* 执行命令 */
-    memset(output_buffer, 0, sizeof(output_buffer));
-    exit_code = execute_command(recv_buffer, output_buffer, sizeof(output_buffer));
-    
-    /* 构造响应（输出 + 退出码）*/
-    snprintf(response, sizeof(response), "%sEXIT_CODE: %d\n", 
-             output_buffer, exit_code);
-    
-    /* 发送响应 */
-    size_t total_sent = 0;
-    size_t response_len = strlen(response);
-    while (total_sent < response_len) {
-        ssize_t sent = send(client_fd, response + total_sent, 
-                           response_len - total_sent, 0);
-        if (sent < 0) {
-            perror("[vsock-server] send failed");
-            break;
-        }
-        total_sent += sent;
-    }
+    /* 执行命令并流式发送响应（输出 + 退出码）*/
+    exit_code = execute_command(client_fd, recv_buffer);
     
     printf("[vsock-server] Command completed (exit code: %d)\n", exit_code);
     
@@ -133,17 +825,176 @@ void handle_client(int client_fd) {
     close(client_fd);
 }
 
-int main(int argc, char *argv[]) {
-    int server_fd, client_fd;
-    struct sockaddr_vm server_addr, client_addr;
+/* 回收已退出的连接子进程，返回回收数量；block 为真时至少等待一个 */
+static int reap_children(int block) {
+    int reaped = 0;
+    int status;
+    pid_t pid;
+
+    for (;;) {
+        pid = waitpid(-1, &status, (block && reaped == 0) ? 0 : WNOHANG);
+        if (pid > 0) {
+            reaped++;
+            continue;
+        }
+        if (pid < 0 && errno == EINTR) {
+            continue;
+        }
+        return reaped;
+    }
+}
+
+/* 接受连接循环：每个连接 fork 一个子进程处理，最多 max_clients 个并发连接。
+ * 达到上限时暂停 accept，直到有连接结束（新连接在 backlog 中排队）。
+ * max_clients <= 1 时退化为单进程同步处理。*/
+void serve_clients(int server_fd, int max_clients) {
+    int active = 0;
+    int client_fd;
+    struct sockaddr_vm client_addr;
     socklen_t client_len;
+    pid_t pid;
+
+    while (1) {
+        active -= reap_children(0);
+        while (max_clients > 1 && active >= max_clients) {
+            active -= reap_children(1);
+        }
+
+        client_len = sizeof(client_addr);
+        client_fd = accept(server_fd, (struct sockaddr *)&client_addr, &client_len);
+        
+        if (client_fd < 0) {
+            if (errno != EINTR) {
+                perror("[vsock-server] accept() failed");
+            }
+            continue;
+        }
+        
+        printf("[vsock-server] Connection from CID=%u PORT=%u\n",
+               client_addr.svm_cid, client_addr.svm_port);
+
+        if (max_clients <= 1) {
+            handle_client(client_fd);
+            continue;
+        }
+
+        /* 子进程会继承 stdio 缓冲区，fork 前先冲刷，避免日志重复 */
+        fflush(stdout);
+        fflush(stderr);
+        pid = fork();
+        if (pid == 0) {
+            close(server_fd);
+            handle_client(client_fd);
+            fflush(stdout);
+            _exit(0);
+        }
+        if (pid < 0) {
+            /* fork 失败时在当前进程同步处理，保证请求不丢失 */
+            perror("[vsock-server] fork() failed");
+            handle_client(client_fd);
+            continue;
+        }
+        close(client_fd);
+        active++;
+    }
+}
+
+/* 读取系统运行时间（毫秒），读取失败返回 0 */
+static unsigned long uptime_ms(void) {
+    FILE *f = fopen("/proc/uptime", "r");
+    double up = 0;
+
+    if (f) {
+        if (fscanf(f, "%lf", &up) != 1) {
+            up = 0;
+        }
+        fclose(f);
+    }
+    return (unsigned long)(up * 1000);
+}
+
+/* 通知宿主机服务已就绪；失败不影响服务运行 */
+static void notify_ready(int ready_port) {
+    struct sockaddr_vm addr;
+    socklen_t len = sizeof(addr);
+    char line[128];
+    int fd, n;
+
+    fd = socket(AF_VSOCK, SOCK_STREAM, 0);
+    if (fd < 0) {
+        return;
+    }
+
+    memset(&addr, 0, sizeof(addr));
+    addr.svm_family = AF_VSOCK;
+    addr.svm_cid = VMADDR_CID_HOST;
+    addr.svm_port = ready_port;
+    if (connect(fd, (struct sockaddr *)&addr, sizeof(addr)) < 0) {
+        printf("[vsock-server] Ready notification not delivered: %s\n", strerror(errno));
+        close(fd);
+        return;
+    }
+
+    /* 本机 CID 取自连接的本端地址，宿主机据此区分多个客户机 */
+    len = sizeof(addr);
+    if (getsockname(fd, (struct sockaddr *)&addr, &len) < 0) {
+        addr.svm_cid = VMADDR_CID_ANY;
+    }
+    n = snprintf(line, sizeof(line), "READY %u %d %lu\n",
+                 addr.svm_cid, VSOCK_PORT, uptime_ms());
+    send_all(fd, line, n);
+    close(fd);
+    printf("[vsock-server] Ready notification sent to host port %d\n", ready_port);
+}
+
+static void usage(const char *prog) {
+    fprintf(stderr, "Usage: %s [-m max_clients] [-r ready_port]\n", prog);
+    fprintf(stderr, "  -m N  maximum concurrent connections (default %d, 1 = serial)\n",
+            DEFAULT_MAX_CLIENTS);
+    fprintf(stderr, "  -r P  host vsock port to notify when ready (default %d, 0 = off)\n",
+            DEFAULT_READY_PORT);
+}
+
+int main(int argc, char *argv[]) {
+    int server_fd;
+    struct sockaddr_vm server_addr;
+    int max_clients = DEFAULT_MAX_CLIENTS;
+    int ready_port = DEFAULT_READY_PORT;
     int opt = 1;
+    int ch;
+
+    while ((ch = getopt(argc, argv, "m:r:h")) != -1) {
+        switch (ch) {
+        case 'm':
+            max_clients = atoi(optarg);
+            if (max_clients < 1) {
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        case 'r':
+            ready_port = atoi(optarg);
+            if (ready_port < 0) {
+                usage(argv[0]);
+                return 1;
+            }
+            break;
+        default:
+            usage(argv[0]);
+            return ch == 'h' ? 0 : 1;
+        }
+    }
+
+    /* 输出重定向到日志文件时也按行刷新 */
+    setvbuf(stdout, NULL, _IOLBF, 0);
     
     printf("===========================================\n");
     printf("  StarryOS vsock Command Execution Server\n");
     printf("===========================================\n");
     printf("Listening on CID=ANY PORT=%d\n", VSOCK_PORT);
     printf("Protocol: Send 'command\\n', receive 'output\\nEXIT_CODE: N\\n'\n");
+    printf("Session:  Send '%s\\n' for framed multi-command mode\n", SESSION_HELLO);
+    printf("Max concurrent connections: %d\n", max_clients);
     printf("===========================================\n\n");
     
     /* 创建 vsock socket */
@@ -173,32 +1024,21 @@ int main(int argc, char *argv[]) {
     }
     
     /* 开始监听 */
-    if (listen(server_fd, 5) < 0) {
+    if (listen(server_fd, 16) < 0) {
         perror("[vsock-server] listen() failed");
         close(server_fd);
         return 1;
     }
     
     printf("[vsock-server] Ready to accept connections\n\n");
-    
-    /* 接受连接循环 */
-    while (1) {
-        client_len = sizeof(client_addr);
-        client_fd = accept(server_fd, (struct sockaddr *)&client_addr, &client_len);
-        
-        if (client_fd < 0) {
-            perror("[vsock-server] accept() failed");
-            continue;
-        }
-        
-        printf("[vsock-server] Connection from CID=%u PORT=%u\n",
-               client_addr.svm_cid, client_addr.svm_port);
-        
-        /* 处理客户端（单线程，同步处理）*/
-        handle_client(client_fd);
+
+    if (ready_port > 0) {
+        notify_ready(ready_port);
     }
     
+    /* 接受连接循环（每个连接一个子进程）*/
+    serve_clients(server_fd, max_clients);
+    
     close(server_fd);
     return 0;
 }
-
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Crate Mirror Tool for StarryOS Builds
+维护本地 crate 镜像（crate:///<root>/NAME/VERSION 或 CRATE_MIRROR_DIR），供离线构建使用
+
+  crate-mirror.py populate --mirror ROOT --dl-dir DL_DIR [--lock Cargo.lock ...]
+  crate-mirror.py trim     --mirror ROOT --lock Cargo.lock [--lock ...] [--dry-run]
+  crate-mirror.py prefetch --mirror ROOT --dl-dir DL_DIR --lock Cargo.lock [--lock ...]
+  crate-mirror.py verify   --mirror ROOT
+"""
+
+import os
+import re
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lib'))
+
+from crate_mirror import CrateMirror, MirrorError, parse_cargo_lock, sha256_file
+
+
+# DL_DIR 中 crate:// fetcher 下载的文件名: NAME-VERSION.crate
+CRATE_FILE = re.compile(r'^(.+?)-(\d+\.\d+\.\d+(?:[-+][0-9A-Za-z.+-]*)?)\.crate$')
+
+
+def lock_packages(lockfiles):
+    """返回 {(name, version): checksum}，合并多个 Cargo.lock"""
+    packages = {}
+    for lockfile in lockfiles or []:
+        for name, version, checksum, _ in parse_cargo_lock(lockfile):
+            packages[(name, version)] = checksum
+    return packages
+
+
+def cmd_populate(mirror, args):
+    """把 DL_DIR 中的 .crate 加入镜像；给出 --lock 时只加入锁文件引用的 crate 并校验"""
+    wanted = lock_packages(args.lock)
+    added = skipped = 0
+    for filename in sorted(os.listdir(args.dl_dir)):
+        match = CRATE_FILE.match(filename)
+        if not match:
+            continue
+        key = (match.group(1), match.group(2))
+        if wanted and key not in wanted:
+            continue
+        if mirror.add(os.path.join(args.dl_dir, filename), *key, checksum=wanted.get(key)):
+            added += 1
+        else:
+            skipped += 1
+
+    missing = [k for k in wanted if mirror.lookup(*k) is None]
+    for name, version in missing:
+        print(f"  ✗ Missing: {name} {version} (not in {args.dl_dir})", file=sys.stderr)
+    print(f"Mirror {mirror.root}: {added} added, {skipped} already present", file=sys.stderr)
+    return 1 if missing else 0
+
+
+def cmd_trim(mirror, args):
+    """删除不被任何 --lock 引用的 crate"""
+    wanted = lock_packages(args.lock)
+    removed = 0
+    for name, version in list(mirror.all_crates()):
+        if (name, version) in wanted:
+            continue
+        print(f"  - {name} {version}", file=sys.stderr)
+        if not args.dry_run:
+            mirror.remove(name, version)
+        removed += 1
+    print(f"Mirror {mirror.root}: {removed} crates {'would be ' if args.dry_run else ''}removed",
+          file=sys.stderr)
+    return 0
+
+
+def cmd_prefetch(mirror, args):
+    """按 Cargo.lock 把 crate 放入 DL_DIR，之后的 do_fetch 不需要网络"""
+    missing = []
+    for lockfile in args.lock:
+        missing += mirror.prefetch_lockfile(lockfile, args.dl_dir)
+    for name, version in missing:
+        print(f"  ✗ Missing: {name} {version}", file=sys.stderr)
+    count = len(lock_packages(args.lock)) - len(set(missing))
+    print(f"Prefetched {count} crates into {args.dl_dir}", file=sys.stderr)
+    return 1 if missing else 0
+
+
+def cmd_verify(mirror, args):
+    """校验镜像中每个 .crate 与索引中的 cksum 一致"""
+    bad = 0
+    total = 0
+    for name, version in mirror.all_crates():
+        total += 1
+        entry = mirror.lookup(name, version)
+        if entry is None:
+            print(f"  ✗ {name} {version}: blob missing", file=sys.stderr)
+            bad += 1
+        elif sha256_file(mirror.crate_path(name, version)) != entry.get('cksum'):
+            print(f"  ✗ {name} {version}: checksum mismatch", file=sys.stderr)
+            bad += 1
+    print(f"Verified {total} crates, {bad} bad", file=sys.stderr)
+    return 1 if bad else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Populate, trim and use a local crate registry mirror")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    populate = sub.add_parser('populate', help='Add .crate files from DL_DIR to the mirror')
+    populate.add_argument('--dl-dir', required=True, help='BitBake DL_DIR')
+    populate.add_argument('--lock', action='append',
+                          help='Only add (and verify) crates locked by this Cargo.lock')
+
+    trim = sub.add_parser('trim', help='Remove crates not locked by any given Cargo.lock')
+    trim.add_argument('--lock', action='append', required=True, help='Cargo.lock to keep')
+    trim.add_argument('--dry-run', action='store_true', help='Only list what would be removed')
+
+    prefetch = sub.add_parser('prefetch', help='Place the crates of a Cargo.lock into DL_DIR')
+    prefetch.add_argument('--dl-dir', required=True, help='BitBake DL_DIR')
+    prefetch.add_argument('--lock', action='append', required=True, help='Cargo.lock to fetch')
+
+    sub.add_parser('verify', help='Check every mirrored crate against the index')
+
+    for p in sub.choices.values():
+        p.add_argument('--mirror', required=True, help='Mirror root directory')
+
+    args = parser.parse_args()
+    mirror = CrateMirror(args.mirror)
+    commands = {'populate': cmd_populate, 'trim': cmd_trim,
+                'prefetch': cmd_prefetch, 'verify': cmd_verify}
+    try:
+        sys.exit(commands[args.command](mirror, args))
+    except (OSError, MirrorError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()